@@ -128,3 +128,12 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/2.0/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Cache of generated Excel files of apps, see base/filecache.py
+# Files are kept by the version ids of the app's tables, and the least
+# recently downloaded files are deleted when they take more than the size
+
+XLS_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'xls')
+
+XLS_CACHE_SIZE = 1024 * 1024 * 1024
@@ -1,119 +1,393 @@
+import tempfile
+import zipfile
+from itertools import islice
+
+import openpyxl
 import pandas
+import xlsxwriter
+# Parquet files need pyarrow, which is optional
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import FileResponse
 from django.apps import apps
-from django.db.models import Max, F
+from django.db.models import Max
 
-from . version import Version
+from . version import Version, VersionHead
+from . filecache import FileCache
+from . codec import NumberCodec
 from . tableIO import AssessTableIO
 from . table import AssessTable
 
 
 class XlsIO():
     """Read/write the tables of an app from/to Excel 2007+."""
+
+    # Rows fetched from the database at a time when writing Excel files
+    batch_size = 10000
+
     def __init__(self, app_name: str, delimiters: dict, ver_str: str) -> None:
         """Initialise from the name of the app."""
         self.app_name = app_name
         self.version = Version()                # Version object
         self.version.set_version_id(ver_str)
-        self.models = apps.get_app_config(app_name).get_models() # Model list
+        # Model list, of the app's Assess models (not e.g. Version)
+        self.models = [model for model in apps.get_app_config(app_name).get_models()
+                       if hasattr(model, 'model_type')]
         self.dataframes = []                    # Dataframes model equivalents
         self.delimiters = delimiters            # Expected Excel delimiters
         self.metadata = []                      # List of dicts for meta-data
 
     def get_response(self) -> object:
-        """Write app's database tables to Excel file returning Excel file."""
+        """Return response with Excel file of app's tables, cached if possible."""
+        # The Excel file of the app's tables is fully determined by the
+        # version id of each table, so files are cached by these ids, and
+        # current resolves to the ids of the current versions. Proposed
+        # versions may change, and are not cached
+        cache = FileCache(settings.XLS_CACHE_DIR, settings.XLS_CACHE_SIZE, '.xlsx')
+        version_ids = self.get_version_ids()
+        cached = self.version.status != 'proposed'
+        excel_file = None
+        if cached:
+            key = cache.get_key(self.app_name, sorted(version_ids.items()))
+            excel_file = cache.get(key)
+        if excel_file is None:
+            excel_file = self.write_excel(version_ids)
+            # A version committed while writing may have gone into the file
+            if cached and version_ids == self.get_version_ids():
+                cache.put(key, excel_file)
         # Create HTTP response for downloading Excel file
         ct = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        response = HttpResponse(content_type=ct)
-        response['Content-Disposition'] = "attachment; filename=" + self.app_name + ".xlsx"
-        # Link xlswriter to write to the response
-        o = {'remove_timezone': True }
-        writer = pandas.ExcelWriter(response, engine='xlsxwriter', options=o)
-        # Get a dataframe from each of the app's models and write xls sheets
-        error = ""
+        return FileResponse(excel_file, as_attachment=True,
+                            filename=self.app_name + '.xlsx', content_type=ct)
+
+    def get_version_ids(self) -> dict:
+        """Return {model_name: version id} of app's tables at the version."""
+        # Proposed is written as the current tables, see write_excel()
+        model_names = [Version.get_model_name(model) for model in self.models]
+        if self.version.status == 'archived':
+            found_ids = self.get_latest_ids(model_names, self.version.version_id)
+        else:
+            query = VersionHead.objects.filter(model_name__in=model_names) \
+                                       .values_list('model_name', 'version_id')
+            found_ids = dict(query)
+            # Tables with versions made before heads were kept have no head
+            # yet (or have no versions at all), so find and keep the heads
+            missing = [n for n in model_names if n not in found_ids]
+            if missing:
+                for (model_name, version_id) in self.get_latest_ids(missing).items():
+                    VersionHead.set_head(model_name, version_id)
+                    found_ids[model_name] = version_id
+        return dict((n, found_ids.get(n, 0)) for n in model_names)
+
+    def get_latest_ids(self, model_names: list, version_id=None) -> dict:
+        """Return {model_name: latest version id}, at or before version_id."""
+        # One grouped query, using the index of versions by model_name, id
+        versions = Version.objects.filter(model_name__in=model_names)
+        if version_id is not None:
+            versions = versions.filter(id__lte=version_id)
+        query = versions.values('model_name').annotate(version_id=Max('id')) \
+                        .values_list('model_name', 'version_id')
+        return dict(query)
+
+    def get_item_rows(self, model: object) -> object:
+        """Return iterator of label tuples of item model at the version."""
+        # As AssessTableIO.get_rows() for data and mappings models
+        if self.version.status == 'archived':
+            query = model.objects.filter(**self.version.kwargs_filter_load(False)) \
+                                 .exclude(**self.version.kwargs_exclude_load(False))
+        else:
+            query = model.objects.filter(**self.version.kwargs_filter('current'))
+        return query.values_list('label').iterator(chunk_size=self.batch_size)
+
+    def get_metadata(self, version_ids: dict) -> list:
+        """Return list of metadata dicts of app's tables at version_ids."""
+        # The metadata of a table is that of its version, where the size,
+        # cells and metric of the table were stored when committed, so
+        # the metadata is one query, not an aggregate over the tables
+        versions = Version.objects.in_bulk([i for i in version_ids.values() if i > 0])
+        metadata = []
         for model in self.models:
             name = model.__name__
-            if model.model_type in ['data_model','mappings_model']:
-                tIO = AssessTableIO(model, self.delimiters)
-                model_df = tIO.get_dataframe(self.version)
-            if model.model_type == 'item_model':
-                query = model.objects.values('label')
-                items = []
-                for record in query:
-                    items.append(record['label'])
-                model_df = pandas.DataFrame(items)
-            if model.model_type == 'data_model':
-                # xlswriter needs converting value column from Decimal to float
-                if model.value_field in model_df:
-                    vf = model.value_field
-                    model_df[vf] = model_df[vf].astype(float)
-                else:
-                    error = 'No value column in data_model ' + name
-            # Write dataframe to sheet and define a named range for it
-            o = {'header': False, 'index': False, 'startrow': 0}
-            o['sheet_name'] = name
-            model_df.to_excel(writer, **o)
-            # Write column headers
-            if model.model_type != 'item_model':
-                worksheet = writer.sheets[name]
-                c = 0
-                for field in model.index_fields:
-                    worksheet.write(0,c,field)
-                    c = c+1
-            # Identify the record with the latest version for getting metadata
-            query = model.objects.annotate(latest=Max('version_first__id')) \
-                                 .filter(version_first__id=F('latest'))
-            metadata_dict = {'name': name, 'error': error }
-            # The query should hold exactly one record
-            for record in query:
+            # The error column is kept for readers of the sheet, no table
+            # is written with errors
+            metadata_dict = {'name': name, 'error': ''}
+            version = versions.get(version_ids[Version.get_model_name(model)])
+            if version is not None:
                 # TODO: Also include metadata from the metadata model
-                metadata_dict['lastuser'] = record.version_first.user
-                metadata_dict['date'] = record.version_first.date
-                metadata_dict['dimension'] = record.version_first.dimension
-                metadata_dict['size'] = record.version_first.size
-                metadata_dict['cells'] = record.version_first.cells
-                metadata_dict['changes'] = record.version_first.changes
-                if record.version_first.metric:
-                    metadata_dict['metric'] = float(record.version_first.metric)
-            self.metadata.append(metadata_dict)
-        # Load metadata dict into a dataframe and write it to Excel
-        meta_df = pandas.DataFrame(self.metadata)
-        meta_df.to_excel(writer,sheet_name='metadata')
-        # Set some reasonable formats
-        writer.book.formats[0].set_bg_color('#dddddd')
-        writer.save()
-        writer.close()
-        return response
+                metadata_dict['version'] = version.id
+                metadata_dict['label'] = version.label
+                metadata_dict['lastuser'] = version.user
+                metadata_dict['date'] = version.date
+                metadata_dict['dimension'] = version.dimension
+                metadata_dict['size'] = version.size
+                metadata_dict['cells'] = version.cells
+                metadata_dict['changes'] = version.changes
+                if version.metric is not None:
+                    metadata_dict['metric'] = float(version.metric)
+            metadata.append(metadata_dict)
+        return metadata
+
+    def write_excel(self, version_ids: dict) -> object:
+        """Write app's database tables to Excel file returning Excel file."""
+        # The workbook is written in xlsxwriter's constant memory mode, where
+        # each row is flushed to disk when the next row is written, and the
+        # table rows are fetched from the database in batches. The finished
+        # file is spooled to a temporary file, which is streamed to the
+        # user and deleted when the response is closed. Memory use is thus
+        # bounded by the batch size, not the size of the app's tables
+        excel_file = tempfile.TemporaryFile()
+        o = {'constant_memory': True, 'remove_timezone': True,
+             'default_date_format': 'yyyy-mm-dd hh:mm:ss'}
+        workbook = xlsxwriter.Workbook(excel_file, o)
+        bold = workbook.add_format({'bold': True})
+        try:
+            for model in self.models:
+                name = model.__name__
+                worksheet = workbook.add_worksheet(name)
+                # Header row and rows of labels (and values) of the sheet
+                if model.model_type == 'item_model':
+                    headers = ['label']
+                    rows = self.get_item_rows(model)
+                else:
+                    headers = model.index_fields + [model.value_field]
+                    tIO = AssessTableIO(model, self.delimiters)
+                    rows = tIO.get_rows(self.version)
+                # Show values with the model's decimal places, which in constant
+                # memory mode must be set before any row is written
+                if model.model_type == 'data_model':
+                    codec = NumberCodec.get_codec(model)
+                    number_format = workbook.add_format({'num_format': codec.excel_format})
+                    c = len(model.index_fields)
+                    worksheet.set_column(c, c, None, number_format)
+                worksheet.write_row(0, 0, headers, bold)
+                # Rows are written as they are fetched, Decimal values are
+                # written as numbers by xlsxwriter
+                for (r, row) in enumerate(rows, 1):
+                    # xlsxwriter returns an error rather than raising, e.g.
+                    # beyond the last row of a sheet, and a truncated file
+                    # must not be returned (or cached)
+                    if worksheet.write_row(r, 0, row) != 0:
+                        raise ValueError('Row ' + str(r + 1) + ' of table ' + name +
+                                         ' could not be written, an Excel sheet has at most ' +
+                                         str(worksheet.xls_rowmax) + ' rows')
+            self.metadata = self.get_metadata(version_ids)
+            self.write_metadata(workbook.add_worksheet('metadata'), bold)
+            # Set some reasonable formats
+            workbook.formats[0].set_bg_color('#dddddd')
+        except Exception:
+            workbook.close()
+            excel_file.close()
+            raise
+        workbook.close()
+        excel_file.seek(0)
+        return excel_file
+
+    def write_metadata(self, worksheet: object, header_format: object) -> None:
+        """Write list of metadata dicts to worksheet, a row per dict."""
+        # Columns are all the metadata keys, in order of first appearance
+        headers = []
+        for metadata_dict in self.metadata:
+            for key in metadata_dict:
+                if key not in headers:
+                    headers.append(key)
+        worksheet.write_row(0, 0, headers, header_format)
+        for (r, metadata_dict) in enumerate(self.metadata, 1):
+            for (c, header) in enumerate(headers):
+                if metadata_dict.get(header) is not None:
+                    worksheet.write(r, c, metadata_dict[header])
 
     def parse_save(self, excel_file) -> list:
         """Read Excel file into database for app returning list of errors."""
         delimiters = {'decimal': ',', 'thousands': '.', 'sep': '\t' }
         report_list = []
+        # The workbook is opened once in read-only mode, where each sheet
+        # is read row by row when iterated, rather than re-reading the
+        # whole workbook for each sheet
+        try:
+            workbook = openpyxl.load_workbook(excel_file, read_only=True, data_only=True)
+        except Exception as e:
+            workbook = None
+            workbook_error = str(e)
         for model in self.models:
             name = model.__name__
             report_dict = { 'read_errors': '', 'proposed': 0, 'parse_errors': ''}
             report_dict['name'] = name
-            try:
-                model_df = pandas.read_excel(excel_file, sheet_name=name, index_col=None)
-            except Exception as e:
+            if model.model_type == 'item_model':
+                # TODO: Allow importing of item_models from Excel
+                pass
+            elif workbook is None:
                 # TODO: Find out how to pass error messages to the uesr
-                report_dict['read_errors'] = str(e)
+                report_dict['read_errors'] = workbook_error
+            elif name not in workbook.sheetnames:
+                report_dict['read_errors'] = "Worksheet named '" + name + "' not found"
             else:
-                if model.model_type == 'item_model':
-                    # TODO: Allow importing of item_models from Excel
-                    pass
+                table = AssessTable(model,'proposed')
+                tableIO = AssessTableIO(model,delimiters,table.keys)
+                records = tableIO.parse_dataframes(self.read_sheet(workbook[name]))
+                # TODO: Check that the dataframe was error free
+                if tableIO.errors == []:
+                    table.load(False)
+                    table.save_changed_records(records)
+                    report_dict['proposed'] = table.count_db_records('proposed', True)
                 else:
-                    tableIO = AssessTableIO(model,delimiters)
-                    records = tableIO.parse_dataframe(model_df)
-                    # TODO: Check that the dataframe was error free
-                    if tableIO.errors == []:
-                        table = AssessTable(model,'proposed')
-                        table.load(False)
-                        table.save_changed_records(records)
-                        report_dict['proposed'] = table.proposed_count()
-                    else:
-                        # TODO: Find out how to pass error messages to the uesr
-                        report_dict['parse_errors'] = str(tableIO.errors)
+                    # TODO: Find out how to pass error messages to the uesr
+                    report_dict['parse_errors'] = str(tableIO.errors)
             report_list.append(report_dict)
+        if workbook is not None:
+            workbook.close()
         return report_list
+
+    def read_sheet(self, worksheet: object) -> object:
+        """Yield dataframes of batch_size rows of a worksheet, the first row
+        being headers."""
+        rows = worksheet.iter_rows(values_only=True)
+        try:
+            header = next(rows)
+        except StopIteration:
+            yield pandas.DataFrame()
+            return
+        # Name columns without header as pandas.read_excel() does
+        columns = []
+        for (n, column) in enumerate(header):
+            if column is None:
+                columns.append('Unnamed: ' + str(n))
+            else:
+                columns.append(column)
+        # Empty rows, e.g. formatted but blank rows, are skipped
+        rows = (row for row in rows if any(cell is not None for cell in row))
+        # The rows are read a batch at a time, so that a sheet is never held
+        # both as rows and as a dataframe. A sheet of headers only is one
+        # empty dataframe
+        data = list(islice(rows, self.batch_size))
+        yield pandas.DataFrame(data, columns=columns)
+        while True:
+            data = list(islice(rows, self.batch_size))
+            if data == []:
+                break
+            yield pandas.DataFrame(data, columns=columns)
+
+
+class ParquetIO():
+    """Read/write the tables of an app, or of one model, from/to Parquet."""
+        # Each data_model or mappings_model table is one Parquet file in the
+        # same long format as the Excel sheets: a column for each index
+        # field and one value column. Label columns are dictionary encoded
+        # (the item labels are stored once), and data_model values are
+        # floats as in AssessColumns. An app is a zip archive of the Parquet
+        # files of its tables, named by model, e.g. TestData.parquet
+        # Tables are written from and read into AssessColumns, so no Python
+        # object is made for each cell, and imported tables are parsed by
+        # parse_dataframe_columns() and saved as proposed records
+
+    available = pyarrow is not None
+
+    def __init__(self, app_name: str, ver_str: str, model=None) -> None:
+        """Initialise from the name of the app, or a model of the app."""
+        self.app_name = app_name
+        self.ver_str = ver_str                  # Version string, see Version
+        self.model = model                      # Model, None for whole app
+        if model is None:
+            models = apps.get_app_config(app_name).get_models()
+            self.models = [m for m in models if getattr(m, 'model_type', '')
+                                                in ['data_model','mappings_model']]
+        else:
+            self.models = [model]
+        self.delimiters = {'decimal': ',', 'thousands': '.', 'sep': '\t' }
+
+    def get_table(self, model: object) -> object:
+        """Return pyarrow table of model's table at the version."""
+        table = AssessTable(model, self.ver_str)
+        table.load(False)
+        columns = table.records
+        arrays = []
+        for field in model.index_fields:
+            # The positions of the records' items are the dictionary indices
+            indices = pyarrow.array(columns.get_positions(field), pyarrow.int32())
+            labels = pyarrow.array(columns.labels[field], pyarrow.string())
+            arrays.append(pyarrow.DictionaryArray.from_arrays(indices, labels))
+        if model.model_type == 'data_model':
+            arrays.append(pyarrow.array(columns.cell_values, pyarrow.float64()))
+        else:
+            values = pyarrow.array(columns.get_values(), pyarrow.string())
+            arrays.append(values.dictionary_encode())
+        names = model.index_fields + [model.value_field]
+        return pyarrow.Table.from_arrays(arrays, names=names)
+
+    def write_file(self) -> object:
+        """Write the Parquet file (or zip of files) returning opened file."""
+        parquet_file = tempfile.TemporaryFile()
+        if self.model is not None:
+            pyarrow.parquet.write_table(self.get_table(self.model), parquet_file)
+        else:
+            # Parquet files are compressed already, so they are stored
+            with zipfile.ZipFile(parquet_file, 'w', zipfile.ZIP_STORED) as archive:
+                for model in self.models:
+                    sink = pyarrow.BufferOutputStream()
+                    pyarrow.parquet.write_table(self.get_table(model), sink)
+                    archive.writestr(model.__name__ + '.parquet', sink.getvalue().to_pybytes())
+        parquet_file.seek(0)
+        return parquet_file
+
+    def get_response(self) -> object:
+        """Return response with the Parquet file (or zip of files)."""
+        if self.model is not None:
+            filename = self.model.__name__ + '.parquet'
+            ct = 'application/vnd.apache.parquet'
+        else:
+            filename = self.app_name + '.zip'
+            ct = 'application/zip'
+        return FileResponse(self.write_file(), as_attachment=True,
+                            filename=filename, content_type=ct)
+
+    def parse_save(self, uploaded_file) -> list:
+        """Read Parquet file (or zip of files) into database returning errors."""
+        if self.model is not None:
+            return [self.save_table(self.model, uploaded_file)]
+        report_list = []
+        try:
+            archive = zipfile.ZipFile(uploaded_file)
+        except zipfile.BadZipFile as e:
+            # TODO: Find out how to pass error messages to the uesr
+            return [{'name': self.app_name, 'read_errors': str(e), 'proposed': 0,
+                     'parse_errors': ''}]
+        with archive:
+            names = archive.namelist()
+            for model in self.models:
+                name = model.__name__ + '.parquet'
+                if name in names:
+                    source = pyarrow.BufferReader(archive.read(name))
+                    report_list.append(self.save_table(model, source))
+                else:
+                    report_list.append({'name': model.__name__, 'proposed': 0,
+                                        'read_errors': "File named '" + name + "' not found",
+                                        'parse_errors': ''})
+        return report_list
+
+    def save_table(self, model: object, source) -> dict:
+        """Parse and save Parquet file source as proposed records of model."""
+        report_dict = { 'read_errors': '', 'proposed': 0, 'parse_errors': ''}
+        report_dict['name'] = model.__name__
+        try:
+            model_df = pyarrow.parquet.read_table(source).to_pandas()
+        except Exception as e:
+            # TODO: Find out how to pass error messages to the uesr
+            report_dict['read_errors'] = str(e)
+            return report_dict
+        # Dictionary encoded label columns are categoricals in pandas, and
+        # are looked up once per label, not once per cell
+        table = AssessTable(model,'proposed')
+        tableIO = AssessTableIO(model, self.delimiters, table.keys)
+        records = tableIO.parse_dataframe_columns(model_df)
+        if tableIO.errors == []:
+            table.load(False)
+            table.save_changed_records(records)
+            report_dict['proposed'] = table.count_db_records('proposed', True)
+        else:
+            # TODO: Find out how to pass error messages to the uesr
+            report_dict['parse_errors'] = str(tableIO.errors)
+        return report_dict
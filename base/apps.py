@@ -1,5 +1,20 @@
-from django.apps import AppConfig
+from django.apps import AppConfig, apps
+from django.core.signals import request_started
+from django.db.models.signals import post_save, post_delete
 
 
 class BaseConfig(AppConfig):
     name = 'base'
+
+    def ready(self):
+        """Connect the receivers clearing cached items and version heads."""
+        from . keys import clear_items_cache
+        from . version import clear_heads
+        # Cached heads are not kept from one request to the next
+        request_started.connect(clear_heads)
+        # Connect to the item models only, so that deleting data records
+        # are still fast deletes without signals
+        for model in apps.get_models():
+            if getattr(model, 'model_type', None) == 'item_model':
+                post_save.connect(clear_items_cache, sender=model)
+                post_delete.connect(clear_items_cache, sender=model)
@@ -0,0 +1,132 @@
+from decimal import Decimal
+
+import numpy
+import pandas
+
+from . errors import NotDecimalError, DecimalPrecisionError
+
+
+class NumberCodec():
+    """Parse and format columns of decimal values of a data_model."""
+        # The codec is made once for each model from the model's delimiters
+        # and the precision of the value field (a DecimalField), so that
+        # nothing is looked up or rebuilt for each value:
+        # - parsing replaces the delimiters and converts whole columns of
+        #   strings with pandas, and validates the values against
+        #   max_digits and decimal_places of the value field
+        # - formatting uses one precompiled format string and one
+        #   translation table from the formatted number to user format
+        # Values are numpy float arrays, as in AssessColumns
+
+    # The codecs of all models, {model: codec}, see get_codec()
+    codecs = {}
+
+    def __init__(self, model: object) -> None:
+        """Compile the codec of model's delimiters and value field."""
+        self.model = model
+        self.delimiters = model.delimiters
+        field = model._meta.get_field(model.value_field)
+        self.max_digits = field.max_digits
+        self.decimal_places = field.decimal_places
+        # Values must be below this bound to fit the integer digits
+        self.max_value = 10.0 ** (self.max_digits - self.decimal_places)
+        # Format with , for thousands and . for decimal, then translate
+        # both in one go to the user format
+        if self.delimiters['thousands'] == '':
+            self.format_str = '{:.' + str(self.decimal_places) + 'f}'
+        else:
+            self.format_str = '{:,.' + str(self.decimal_places) + 'f}'
+        self.translation = str.maketrans({',': self.delimiters['thousands'],
+                                          '.': self.delimiters['decimal']})
+        # Parsing removes thousands delimiters and makes decimals a .
+        parse_map = {self.delimiters['decimal']: '.'}
+        if self.delimiters['thousands'] != '':
+            parse_map[self.delimiters['thousands']] = ''
+        self.parse_translation = str.maketrans(parse_map)
+        # Number format for spreadsheets, e.g. '#,##0.000'
+        if self.decimal_places > 0:
+            self.excel_format = '#,##0.' + '0' * self.decimal_places
+        else:
+            self.excel_format = '#,##0'
+
+    @classmethod
+    def get_codec(cls, model: object) -> object:
+        """Return the (cached) codec of model."""
+        try:
+            return cls.codecs[model]
+        except KeyError:
+            codec = cls(model)
+            cls.codecs[model] = codec
+            return codec
+
+    def format(self, values: object) -> list:
+        """Return list of values (array or list of numbers) as strings."""
+        if isinstance(values, numpy.ndarray):
+            values = values.tolist()
+        if len(values) == 0:
+            return []
+        # The formatted values are translated as one string, which is much
+        # faster than translating each value
+        text = '\n'.join(map(self.format_str.format, values))
+        return text.translate(self.translation).split('\n')
+
+    def get_decimal_strs(self, cells: object) -> object:
+        """Return pandas Series of cells with user delimiters replaced."""
+        cells = pandas.Series(cells)
+        if pandas.api.types.is_numeric_dtype(cells):
+            return cells
+        # Only string cells are replaced, others are kept as they are
+        if pandas.api.types.infer_dtype(cells, skipna=False) != 'string':
+            strings = cells.map(lambda cell: isinstance(cell, str))
+            decimal_strs = cells.astype(object).copy()
+            decimal_strs[strings] = self.get_decimal_strs(cells[strings].astype(str))
+            return decimal_strs
+        # As for formatting, the replacing is done on one joined string
+        text = '\n'.join(cells.tolist())
+        if text.count('\n') != len(cells) - 1:
+            # Cells with line breaks cannot be split from the joined string
+            text_cells = [cell.translate(self.parse_translation) for cell in cells.tolist()]
+        else:
+            text_cells = text.translate(self.parse_translation).split('\n')
+        return pandas.Series(text_cells, index=cells.index, dtype=object)
+
+    def parse(self, cells: object) -> (object, object):
+        """Return array of values of a column of cells and mask of bad cells.
+
+            cells (object): pandas Series or list of strings or numbers
+        """
+        decimal_strs = self.get_decimal_strs(cells)
+        # Converting all cells at once fails if one cell is bad, and only
+        # then the slower cell by cell conversion is needed
+        try:
+            values = numpy.array(decimal_strs.tolist(), dtype=numpy.float64)
+        except (ValueError, TypeError):
+            values = pandas.to_numeric(decimal_strs, errors='coerce')
+            values = numpy.array(values, dtype=numpy.float64)
+        bad = numpy.zeros(len(values), dtype=bool)
+        # Anything that Decimal() accepts is a value as in set_value, also
+        # where pandas gives up (e.g. '1_000')
+        for n in numpy.flatnonzero(numpy.isnan(values)).tolist():
+            try:
+                values[n] = float(Decimal(decimal_strs.iloc[n]))
+            except:
+                bad[n] = True
+        # Values must fit the digits of the value field, as checked by
+        # full_clean() when saving
+        with numpy.errstate(invalid='ignore'):
+            bad |= ~(numpy.abs(values) < self.max_value)
+            bad |= numpy.round(values, self.decimal_places) != values
+        return values, bad
+
+    def get_error(self, cell: object) -> object:
+        """Return the error of a bad cell, see parse()."""
+        decimal_str = str(self.get_decimal_strs([cell]).iloc[0])
+        try:
+            finite = Decimal(decimal_str).is_finite()
+        except:
+            finite = False
+        if finite:
+            return DecimalPrecisionError(decimal_str, self.max_digits,
+                                         self.decimal_places, self.model)
+        else:
+            return NotDecimalError(decimal_str, self.model)
@@ -0,0 +1,433 @@
+import io
+from collections.abc import MutableMapping
+from decimal import Decimal
+
+import numpy
+from django.db import connections
+
+from . codec import NumberCodec
+
+
+class AssessColumns(MutableMapping):
+    """Array-backed records of a data_model or mappings_model table."""
+        # The records are held column-wise as numpy arrays:
+        # - one array of item ids for each index field (the item codes)
+        # - one array of values (float for data_model, item id for mappings)
+        # - arrays of record ids, version_first ids and version_last ids
+        # Each record also has a cell code: the record's position in the
+        # cross product of the current items of the index fields, counted
+        # in model.index_fields order. The arrays are sorted by cell code
+        # and hold one record per cell, so finding, pivoting and comparing
+        # records work on the arrays without any Python object per cell.
+        # As a mapping, the columns look like the former dict of records:
+        # keys are tuples of item labels + value_field, and values are
+        # model objects, which are created on demand only
+
+    def __init__(self, model: object, keys: object) -> None:
+        """Set up empty columns and item code lookups from Keys.
+
+            model (object): Django model (data_model or mappings_model)
+            keys (object): Keys object with the model's item lookups
+        """
+        self.model = model
+        self.keys = keys
+        self.fields = model.index_fields        # Index fields in key order
+        self.is_data = model.model_type == 'data_model'
+        # Lookups for each index field dimension, the dimension's items
+        # are the Keys' current items in label order
+        self.labels = {}            # Dict of lists {field: [label, ]}
+        self.positions = {}         # Dict of dicts {field: {label: position}}
+        self.sorted_ids = {}        # Dict of arrays {field: sorted item ids}
+        self.sorted_positions = {}  # Dict of arrays {field: positions}
+        self.strides = {}           # Dict of ints {field: cell code stride}
+        stride = 1
+        for field in reversed(self.fields):
+            labels = keys.indices_labels[field]
+            ids = [keys.indices_labels_ids[field][label] for label in labels]
+            ids = numpy.array(ids, dtype=numpy.int64)
+            order = numpy.argsort(ids)
+            self.labels[field] = labels
+            self.positions[field] = dict(zip(labels, range(len(labels))))
+            self.sorted_ids[field] = ids[order]
+            self.sorted_positions[field] = order
+            self.strides[field] = stride
+            stride = stride * len(labels)
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        codes = {}
+        for field in self.fields:
+            codes[field] = empty
+        self.set_arrays(empty, codes, self.empty_values(), empty, empty)
+
+    def empty_values(self) -> object:
+        """Return an empty value array of the model's value type."""
+        if self.is_data:
+            return numpy.zeros(0, dtype=numpy.float64)
+        else:
+            return numpy.zeros(0, dtype=numpy.int64)
+
+    def set_arrays(self, record_ids, codes, values, firsts, lasts) -> None:
+        """Set columns from arrays of records in id order.
+
+            record_ids (array): record ids, 0 for records not in database
+            codes (dict): arrays of item ids by index field name
+            values (array): floats for data_model, item ids for mappings
+            firsts, lasts (array): version_first/last ids, 0 for None
+        """
+        cells = self.get_cells(codes)
+        # Records with items that are not current cannot be given a key,
+        # and only the last record (the highest id) is kept for each cell
+        keep = numpy.flatnonzero(cells >= 0)[::-1]
+        (self.cells, index) = numpy.unique(cells[keep], return_index=True)
+        keep = keep[index]
+        self.record_ids = record_ids[keep]      # Array of record ids
+        self.codes = {}                         # Dict {field: item ids}
+        for field in self.fields:
+            self.codes[field] = codes[field][keep]
+        self.cell_values = values[keep]         # Array of values
+        self.version_first = firsts[keep]       # Array of version ids
+        self.version_last = lasts[keep]         # Array of version ids
+
+    def get_arrays(self) -> tuple:
+        """Return arrays of the records, see set_arrays()."""
+        return (self.record_ids, self.codes, self.cell_values,
+                self.version_first, self.version_last)
+
+    def get_cells(self, codes: dict) -> object:
+        """Return array of cell codes of item id arrays, -1 if not current."""
+        length = len(codes[self.fields[0]])
+        cells = numpy.zeros(length, dtype=numpy.int64)
+        valid = numpy.ones(length, dtype=bool)
+        for field in self.fields:
+            sorted_ids = self.sorted_ids[field]
+            if len(sorted_ids) == 0:
+                valid[:] = False
+                continue
+            # Look up item ids in the sorted item ids of the dimension
+            index = numpy.searchsorted(sorted_ids, codes[field])
+            index = numpy.minimum(index, len(sorted_ids) - 1)
+            valid &= sorted_ids[index] == codes[field]
+            cells += self.sorted_positions[field][index] * self.strides[field]
+        cells[~valid] = -1
+        return cells
+
+    def load(self, query: object) -> None:
+        """Load records of a Django queryset into the columns."""
+        self.set_arrays(*self.fetch(query))
+
+    def fetch(self, query: object) -> tuple:
+        """Return arrays of records of a Django queryset, see set_arrays()."""
+        if self.is_data:
+            value_column = self.model.value_field
+        else:
+            value_column = self.model.value_field + '_id'
+        columns = ['id']
+        for field in self.fields:
+            columns.append(field + '_id')
+        columns += [value_column, 'version_first_id', 'version_last_id']
+        # Fetch plain tuples rather than model objects, in id order. The
+        # rows are fetched from the cursor, as Django's converters of each
+        # value (e.g. to Decimal) are not needed for the numpy arrays
+        rows = query.order_by('id').values_list(*columns)
+        (sql, params) = rows.query.sql_with_params()
+        with connections[rows.db].cursor() as cursor:
+            cursor.execute(sql, params)
+            data = list(zip(*cursor.fetchall()))
+        if data == []:
+            data = [()] * len(columns)
+        record_ids = numpy.array(data[0], dtype=numpy.int64)
+        codes = {}
+        for (n, field) in enumerate(self.fields):
+            codes[field] = numpy.array(data[n+1], dtype=numpy.int64)
+        if self.is_data:
+            values = numpy.array(data[-3], dtype=numpy.float64)
+        else:
+            values = numpy.array(data[-3], dtype=numpy.int64)
+        firsts = numpy.array([v or 0 for v in data[-2]], dtype=numpy.int64)
+        lasts = numpy.array([v or 0 for v in data[-1]], dtype=numpy.int64)
+        return record_ids, codes, values, firsts, lasts
+
+    def dump(self) -> bytes:
+        """Return the records as compressed bytes, see load_snapshot()."""
+        arrays = {}
+        arrays['record_ids'] = self.record_ids
+        for field in self.fields:
+            arrays['codes_' + field] = self.codes[field]
+        arrays['values'] = self.cell_values
+        arrays['firsts'] = self.version_first
+        arrays['lasts'] = self.version_last
+        buffer = io.BytesIO()
+        numpy.savez_compressed(buffer, **arrays)
+        return buffer.getvalue()
+
+    def load_snapshot(self, data: bytes, archived_ids: list, query: object) -> None:
+        """Load records of a snapshot, less archived and plus later records.
+
+            data (bytes): records dumped by dump()
+            archived_ids (list): ids of snapshot records archived since
+            query (object): Django queryset of records added since
+        """
+        arrays = numpy.load(io.BytesIO(data))
+        keep = ~numpy.isin(arrays['record_ids'], archived_ids)
+        (record_ids, codes, values, firsts, lasts) = self.fetch(query)
+        # The later records come last, so they replace snapshot records
+        record_ids = numpy.concatenate([arrays['record_ids'][keep], record_ids])
+        for field in self.fields:
+            codes[field] = numpy.concatenate([arrays['codes_' + field][keep], codes[field]])
+        values = numpy.concatenate([arrays['values'][keep], values])
+        firsts = numpy.concatenate([arrays['firsts'][keep], firsts])
+        lasts = numpy.concatenate([arrays['lasts'][keep], lasts])
+        self.set_arrays(record_ids, codes, values, firsts, lasts)
+
+    def get_cell(self, key: tuple) -> int:
+        """Return cell code of a record key, -1 if not a key of the table."""
+        if len(key) != len(self.fields) + 1:
+            return -1
+        if key[-1] != self.model.value_field:
+            return -1
+        cell = 0
+        for (field, label) in zip(self.fields, key):
+            try:
+                cell += self.positions[field][label] * self.strides[field]
+            except KeyError:
+                return -1
+        return cell
+
+    def find(self, key: tuple) -> int:
+        """Return array index of the record with key, -1 if not found."""
+        cell = self.get_cell(key)
+        if cell < 0:
+            return -1
+        i = int(numpy.searchsorted(self.cells, cell))
+        if i < len(self.cells) and self.cells[i] == cell:
+            return i
+        return -1
+
+    def get_key(self, i: int) -> tuple:
+        """Return record key (tuple of labels + value_field) of index i."""
+        cell = int(self.cells[i])
+        key = []
+        for field in self.fields:
+            labels = self.labels[field]
+            key.append(labels[(cell // self.strides[field]) % len(labels)])
+        key.append(self.model.value_field)
+        return tuple(key)
+
+    def get_value(self, i: int) -> str:
+        """Return value of index i as string for display and comparison."""
+        if self.is_data:
+            return self.get_values(numpy.array([i]))[0]
+        else:
+            item_id = int(self.cell_values[i])
+            try:
+                return self.keys.indices_ids_labels[self.model.value_field][item_id]
+            # Archived value items are not in the lookup dicts
+            except KeyError:
+                return str(self.get_record(i).get_value())
+
+    def get_positions(self, field: str) -> object:
+        """Return array of item positions of the records in field dimension."""
+        count = len(self.labels[field])
+        return (self.cells // self.strides[field]) % max(count, 1)
+
+    def get_values(self, index=None) -> list:
+        """Return list of values as strings, of all or index array records."""
+        if index is None:
+            index = numpy.arange(len(self.cells))
+        if self.is_data:
+            return NumberCodec.get_codec(self.model).format(self.cell_values[index])
+        else:
+            ids_labels = self.keys.indices_ids_labels[self.model.value_field]
+            values = []
+            for (i, item_id) in zip(index.tolist(), self.cell_values[index].tolist()):
+                try:
+                    values.append(ids_labels[item_id])
+                # Archived value items are not in the lookup dicts
+                except KeyError:
+                    values.append(self.get_value(i))
+            return values
+
+    def get_key_strings(self, index=None) -> list:
+        """Return list of record keys as strings, of all or index records."""
+        if index is None:
+            index = numpy.arange(len(self.cells))
+        label_columns = []
+        for field in self.fields:
+            labels = numpy.array(self.labels[field], dtype=object)
+            label_columns.append(labels[self.get_positions(field)[index]])
+        end = (self.model.value_field,)
+        return [str(key + end) for key in zip(*label_columns)]
+
+    def get_rows(self, index_headers: list) -> (int, object):
+        """Return count of table rows and array of row numbers of records.
+
+            index_headers (list): index fields of the rows, in key order
+        """
+        # Rows count the cross product of the index headers' items, with
+        # the first header varying slowest (as the cell code does)
+        row_count = 1
+        rows = numpy.zeros(len(self.cells), dtype=numpy.int64)
+        for field in reversed(index_headers):
+            rows += self.get_positions(field) * row_count
+            row_count = row_count * len(self.labels[field])
+        return row_count, rows
+
+    def count_stored_rows(self, index_headers: list) -> int:
+        """Return count of table rows having at least one record."""
+        (row_count, rows) = self.get_rows(index_headers)
+        return len(numpy.unique(rows))
+
+    def pivot(self, index_headers: list, value_headers: list,
+              column_field: str, start=0, stop=None, sparse=False) -> list:
+        """Return table rows, one for each combination of index items.
+
+            index_headers (list): index fields of the rows, in key order
+            value_headers (list): column_field items or [value_field]
+            column_field (str): index field of the columns, or value_field
+            start, stop (int): window of row numbers, default all rows
+            sparse (bool): only rows having records, start/stop count these
+        """
+        (row_count, rows) = self.get_rows(index_headers)
+        # The row numbers in the window: either all combinations of index
+        # items or only those with stored records, so that work in sparse
+        # mode scales with the stored records, not the table size
+        if sparse:
+            row_numbers = numpy.unique(rows)[start:stop]
+        else:
+            if stop is None or stop > row_count:
+                stop = row_count
+            row_numbers = numpy.arange(min(start, stop), stop, dtype=numpy.int64)
+        if column_field in self.fields:
+            columns = self.get_positions(column_field)
+        else:
+            columns = numpy.zeros(len(self.cells), dtype=numpy.int64)
+        # The grid holds the number of the record in the window (see below)
+        # in each table cell of the rows in the window
+        index = numpy.searchsorted(row_numbers, rows)
+        index = numpy.minimum(index, max(len(row_numbers) - 1, 0))
+        if len(row_numbers) > 0:
+            window = numpy.flatnonzero(row_numbers[index] == rows)
+        else:
+            window = numpy.zeros(0, dtype=numpy.int64)
+        grid = numpy.full((len(row_numbers), len(value_headers)), -1, dtype=numpy.int64)
+        grid[index[window], columns[window]] = numpy.arange(len(window))
+        # Index header labels of every row
+        row_labels = []
+        stride = row_count
+        for field in index_headers:
+            labels = numpy.array(self.labels[field], dtype=object)
+            count = len(self.labels[field])
+            stride = stride // max(count, 1)
+            positions = (row_numbers // stride) % max(count, 1)
+            row_labels.append(labels[positions].tolist())
+        # Strings and ids are made once for each record in the window
+        values = self.get_values(window)
+        key_strings = self.get_key_strings(window)
+        record_ids = self.record_ids[window].tolist()
+        row_list = []
+        for (labels, cells) in zip(zip(*row_labels), grid.tolist()):
+            row = dict(zip(index_headers, labels))
+            for (header, i) in zip(value_headers, cells):
+                if i < 0:
+                    row[header] = 'n.d.'
+                else:
+                    row[header] = values[i]
+                    row[header + '_id'] = record_ids[i]
+                    row[header + '_key'] = key_strings[i]
+            row_list.append(row)
+        return row_list
+
+    def get_index(self, cells: object) -> object:
+        """Return array indexes of the records of cells, -1 if no record."""
+        if len(self.cells) == 0:
+            return numpy.full(len(cells), -1, dtype=numpy.int64)
+        index = numpy.searchsorted(self.cells, cells)
+        index = numpy.minimum(index, len(self.cells) - 1)
+        return numpy.where(self.cells[index] == cells, index, -1)
+
+    def compare(self, other: object) -> (object, object):
+        """Return array indexes of the cells that differ, -1 if no record.
+
+            other (object): AssessColumns of the same model and Keys
+        """
+        # Cells of either columns, in cell code order. Both cell arrays are
+        # sorted and unique, so the union is the cells of self and the
+        # other's cells not in self, sorted
+        only_other = other.cells[self.get_index(other.cells) < 0]
+        cells = numpy.sort(numpy.concatenate([self.cells, only_other]))
+        index_self = self.get_index(cells)
+        index_other = other.get_index(cells)
+        # Cells with a record in both columns differ if the values differ
+        both = (index_self >= 0) & (index_other >= 0)
+        same = numpy.zeros(len(cells), dtype=bool)
+        values_self = self.cell_values[index_self[both]]
+        values_other = other.cell_values[index_other[both]]
+        same[both] = values_self == values_other
+        return index_self[~same], index_other[~same]
+
+    def get_record(self, i: int) -> object:
+        """Create model object for the record at index i."""
+        kwargs = {}
+        kwargs['id'] = int(self.record_ids[i]) or None
+        kwargs['version_first_id'] = int(self.version_first[i]) or None
+        kwargs['version_last_id'] = int(self.version_last[i]) or None
+        for field in self.fields:
+            kwargs[field + '_id'] = int(self.codes[field][i])
+        if self.is_data:
+            value = Decimal(repr(float(self.cell_values[i])))
+            kwargs[self.model.value_field] = value
+        else:
+            kwargs[self.model.value_field + '_id'] = int(self.cell_values[i])
+        return self.model(**kwargs)
+
+    def __getitem__(self, key: tuple) -> object:
+        i = self.find(key)
+        if i < 0:
+            raise KeyError(key)
+        return self.get_record(i)
+
+    def __setitem__(self, key: tuple, record: object) -> None:
+        cell = self.get_cell(key)
+        if cell < 0:
+            raise KeyError(key)
+        if self.is_data:
+            value = float(getattr(record, self.model.value_field))
+        else:
+            value = getattr(record, self.model.value_field + '_id')
+        i = int(numpy.searchsorted(self.cells, cell))
+        # Replace the record in an existing cell, or insert a new cell
+        if i == len(self.cells) or self.cells[i] != cell:
+            self.cells = numpy.insert(self.cells, i, cell)
+            self.record_ids = numpy.insert(self.record_ids, i, 0)
+            for field in self.fields:
+                self.codes[field] = numpy.insert(self.codes[field], i, 0)
+            self.cell_values = numpy.insert(self.cell_values, i, 0)
+            self.version_first = numpy.insert(self.version_first, i, 0)
+            self.version_last = numpy.insert(self.version_last, i, 0)
+        self.record_ids[i] = record.id or 0
+        for field in self.fields:
+            self.codes[field][i] = getattr(record, field + '_id')
+        self.cell_values[i] = value
+        self.version_first[i] = record.version_first_id or 0
+        self.version_last[i] = record.version_last_id or 0
+
+    def __delitem__(self, key: tuple) -> None:
+        i = self.find(key)
+        if i < 0:
+            raise KeyError(key)
+        self.cells = numpy.delete(self.cells, i)
+        self.record_ids = numpy.delete(self.record_ids, i)
+        for field in self.fields:
+            self.codes[field] = numpy.delete(self.codes[field], i)
+        self.cell_values = numpy.delete(self.cell_values, i)
+        self.version_first = numpy.delete(self.version_first, i)
+        self.version_last = numpy.delete(self.version_last, i)
+
+    def __contains__(self, key: tuple) -> bool:
+        return self.find(key) >= 0
+
+    def __iter__(self):
+        for i in range(len(self.cells)):
+            yield self.get_key(i)
+
+    def __len__(self) -> int:
+        return len(self.cells)
@@ -46,6 +46,24 @@ class NotDecimalError(AssessError):
     def __str__(self):
         return self.message
 
+class DecimalPrecisionError(AssessError):
+    """Exception raised for decimal not fitting the model's value field
+
+    Attributes
+        decimal_str: decimal string
+        max_digits: max count of digits of the value field
+        decimal_places: count of decimal places of the value field
+        model: model that should have had the value
+    """
+    def __init__(self,decimal_str,max_digits,decimal_places,model):
+        self.app_name = model.app_name
+        self.model_name = model.model_name
+        self.message = decimal_str + " has more than " + str(max_digits) + \
+                       " digits or " + str(decimal_places) + \
+                       " decimal places in " + self.model_name
+    def __str__(self):
+        return self.message
+
 # TODO: Find test for this
 class NotCleanRecord(AssessError): # pragma: no cover
     """Exception raised for for saving not clean record
@@ -143,6 +161,24 @@ class CSVfieldNotFound(AssessError):
     def __str__(self):
         return self.message
 
+class CSVtooManyErrors(AssessError):
+    """Exception raised after the last reported error of a CSV file
+
+    Attributes
+        count: count of the further errors, which are not reported
+        model: object of type AssessModel
+    """
+    def __init__(self, count, model):
+        self.app_name = model._meta.app_label
+        self.model_name = model.model_name
+        self.count = count
+        self.message = self.model_name + " / " + self.app_name + \
+                       ": " + str(count) + " more errors in the CSV file" + \
+                       " were not reported"
+
+    def __str__(self):
+        return self.message
+
 
 class KeyNotFound(AssessError):
     """Exception raised for key string in POST that did not match items
@@ -0,0 +1,80 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+
+class FileCache():
+    """Directory of cached files, evicting the least recently used files."""
+        # A cached file is never changed, only written once and later
+        # deleted, so its content must be fully determined by its key
+        # (e.g. the app name and version ids of an Excel file)
+        # Files are written to a temporary file in the directory and then
+        # renamed, so a file is either complete or not found
+        # Reading a file touches its modification time, and when the files
+        # take more than max_size bytes, the files least recently used are
+        # deleted first
+
+    def __init__(self, directory: str, max_size: int, suffix='') -> None:
+        """Initialise cache in directory of max_size bytes."""
+        self.directory = directory      # Directory holding the files
+        self.max_size = max_size        # Max total size of files in bytes
+        self.suffix = suffix            # File name suffix, e.g. '.xlsx'
+
+    def get_key(self, *parts) -> str:
+        """Return key (hex digest) of the parts identifying a file."""
+        return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+    def get_path(self, key: str) -> str:
+        """Return path of the file of key."""
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key: str) -> object:
+        """Return opened file of key, None if not cached."""
+        path = self.get_path(key)
+        try:
+            cached_file = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        # Mark the file as recently used, the file may just have been evicted
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return cached_file
+
+    def put(self, key: str, source_file: object) -> None:
+        """Copy the content of the opened source_file to the file of key."""
+        os.makedirs(self.directory, exist_ok=True)
+        source_file.seek(0)
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp',
+                                         delete=False) as temp_file:
+            shutil.copyfileobj(source_file, temp_file)
+        os.replace(temp_file.name, self.get_path(key))
+        source_file.seek(0)
+        self.evict()
+
+    def evict(self) -> None:
+        """Delete least recently used files until within max_size."""
+        files = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                # Temporary files being written are not cached files yet
+                if not entry.name.endswith(self.suffix) or entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        # The most recently used file is kept, even if larger than max_size
+        files.sort(reverse=True)
+        size = 0
+        for (n, (mtime, file_size, path)) in enumerate(files):
+            if n > 0 and size + file_size > self.max_size:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            else:
+                size += file_size
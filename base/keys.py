@@ -1,7 +1,25 @@
+import itertools
+from collections.abc import Sequence
+
 from base.errors import KeyInvalid, KeyNotFound, NoFieldError
+from base.version import Version, VersionHead
 
 class Keys():
     """Provide row keys, table headers and column item label/ud lookup dicts"""
+
+    # The lookups of an item model's current items are shared by all Keys
+    # objects in the process, so tables do not query the items each time:
+    # {item model: (head, (ids_labels, labels_ids, labels_objects, labels))}
+    # where head is the item model's VersionHead when the items were read.
+    # Item changes by AssessSet make a new version, so items cached before
+    # a change in any process are reloaded, as the head has moved. Items
+    # saved or deleted in this process also clear the cache right away,
+    # see clear_items_cache()
+    items_cache = {}
+    # Whether cached items are checked against the heads; parse workers
+    # keep a fixed copy of the items, see tableIO.init_parse_worker()
+    check_heads = True
+
     def __init__(self, model):
         """Set lookup dicts  for labels/ids """
         self.model = model
@@ -30,6 +48,7 @@ class Keys():
         # chekcing of user upload data integrity
         dimensions = []
         self.size = 1
+        column_models = {}
         for column_name in foreignkey_columns:
             try:
                 # Get the foreign key model items for each index in collection
@@ -39,21 +58,13 @@ class Keys():
                 # app_name / models.py does not reflect the model's columns
                 # ### OBS: Provide better error message from messages.py
                 self.errors = NoFieldError(column_name,self.model)
-            ids_labels = {}
-            labels_ids = {}
-            labels_objects = {}
-            labels = []
-            # Preferably the version filters should be imported from version.py
-            # but this depend on keys so we cant.
-            ### OBS!!! We restrict any table to use ONLY CURRENT VERSION ITEMS!
-            ### Presently it's unclear how to load only items for given version
-            fc = { 'version_first__isnull': False, 'version_last__isnull': True }
-            for item in column_model.objects.filter(**fc):
-                ids_labels[item.id] = item.label
-                labels_ids[item.label] = item.id
-                labels_objects[item.label] = item
-                labels.append(item.label)
-
+            column_models[column_name] = column_model
+        # The heads of all the item models are read in one query
+        heads = self.get_heads(column_models.values())
+        for column_name in foreignkey_columns:
+            column_model = column_models[column_name]
+            items = self.get_items(column_model, heads.get(column_model))
+            (ids_labels, labels_ids, labels_objects, labels) = items
             # Count dimension of the different indices
             s = len(labels)
             self.size = self.size*s
@@ -69,6 +80,63 @@ class Keys():
         # Text string for description of table dimension
         self.dimension = "{" + " x ".join(dimensions) + "}"
 
+    @classmethod
+    def get_heads(cls, item_models: list) -> dict:
+        """Return {item model: VersionHead version id, 0 if none}."""
+        if not cls.check_heads:
+            return {}
+        names = dict((Version.get_model_name(m), m) for m in item_models)
+        query = VersionHead.objects.filter(model_name__in=list(names)) \
+                                   .values_list('model_name', 'version_id')
+        heads = dict.fromkeys(names.values(), 0)
+        for (model_name, version_id) in query:
+            heads[names[model_name]] = version_id
+        return heads
+
+    @classmethod
+    def get_items(cls, item_model: object, head=None) -> tuple:
+        """Return (cached) lookup dicts and label list of current items.
+
+            item_model (object): the item model
+            head (int): the item model's head, see get_heads(), if known
+        """
+        if head is None and cls.check_heads:
+            head = cls.get_heads([item_model])[item_model]
+        try:
+            (cached_head, items) = cls.items_cache[item_model]
+        except KeyError:
+            pass
+        else:
+            if cached_head == head or not cls.check_heads:
+                return items
+        ids_labels = {}
+        labels_ids = {}
+        labels_objects = {}
+        labels = []
+        # Preferably the version filters should be imported from version.py
+        # but this depend on keys so we cant.
+        ### OBS!!! We restrict any table to use ONLY CURRENT VERSION ITEMS!
+        ### Presently it's unclear how to load only items for given version
+        fc = { 'version_first__isnull': False, 'version_last__isnull': True }
+        for item in item_model.objects.filter(**fc):
+            ids_labels[item.id] = item.label
+            labels_ids[item.label] = item.id
+            labels_objects[item.label] = item
+            labels.append(item.label)
+        items = (ids_labels, labels_ids, labels_objects, labels)
+        # The head was read before the items, so items changed meanwhile
+        # are read again next time
+        cls.items_cache[item_model] = (head, items)
+        return items
+
+    @classmethod
+    def clear_items_cache(cls, item_model=None) -> None:
+        """Clear cached items of item_model, or of all item models if None."""
+        if item_model is None:
+            cls.items_cache.clear()
+        else:
+            cls.items_cache.pop(item_model, None)
+
     def set_headers(self, column_field="") -> None:
         """Calculate headers according to user choice of column field."""
         # Reset index and value headers
@@ -96,7 +164,8 @@ class Keys():
                 self.index_headers.append(index_field)
             else:
             # A multi-value_column table has column_field's items
-                self.value_headers = self.indices_labels[index_field]
+                # Copy, as the label lists are shared by all Keys objects
+                self.value_headers = self.indices_labels[index_field].copy()
                 self.table_one_column = False
         # If one-value_column table, the only value header is value_field
         if self.column_field == self.model.value_field:
@@ -166,67 +235,63 @@ class Keys():
             raise NoFieldError(self.model.value_field,self.model)
         return table_index_headers, table_value_headers
 
-    def get_key_list(self):
-        """Return list of keys (key is a tuple of item labels) """
+    def get_key_list(self) -> object:
+        """Return lazy list of keys (key is a tuple of item labels) """
         # OBS: Implement ordering of indices at some point
-        order = self.index_headers
-        indices = {}
-        for field in order:
-            indices[field] = self.indices_labels[field].copy()
-        # combos: dict of list of all combinations of items by column name
-        # { col1_name: [item1,item2, ...], col2_name: [itemX,itemX, ...]}
-        key_combos = self.item_combos(order,indices,{})
-        # key list of tuples: [(item1,itemX), (item2,itemX), (item1,itemY), ..]
-        return list(zip(*key_combos.values()))
-
-
-    def item_combos(self,__order,__indices,__columns):
-        """Recursively span out all combination of indices to key dicts
-
-            Arguments:
-                order: list of str field names for ordering of the columns
-                indices: dict of list of items still to be arranged in columns
-                columns: dict of list of itmes already arranged in columns
+        labels = []
+        for field in self.index_headers:
+            labels.append(self.indices_labels[field])
+        # key list of tuples: [(item1,itemX), (item1,itemY), (item2,itemX), ..]
+        return KeyList(labels)
+
+
+def clear_items_cache(sender, **kwargs) -> None:
+    """Signal receiver clearing cached items when an item is saved/deleted."""
+    # Connected to the item models in BaseConfig.ready(). Changes by
+    # queryset .update() or .bulk_create() send no signals, so code using
+    # those must call Keys.clear_items_cache() itself
+    Keys.clear_items_cache(sender)
+
+
+class KeyList(Sequence):
+    """Lazy list of all combinations of index items, with random access."""
+
+    def __init__(self, labels: list) -> None:
+        """Set up key list from a list of item label lists, one per index.
+
+            labels (list): list of lists of labels, first varies slowest
         """
-        # indices1 = {c1: [iX,iY]}
-        # indices2 = {c2: [iA,iB]}
-        # keys3 = {c3: [i1,i2,i3]}
-        # indices12 = {c1: [iX,iY], c2: [iA,iB] }
-        # indices123 = {c1: [iX,iY], c2: [iA,iB], c3: [i1,i2,i3] }
-        # F(indices123,[]) = F(indices12,keys3)
-        # F(indices12,keys3) F(indices1,F(indices2,keys3))
-        # F(indices2,keys3) = keys23
-        # keys23 = {c2: [iA,iA,iA,iB,iB,iB], c3: [i1,i2,i3,i1,i2,i3]}
-
-        # The routine rearranges the inputs - make copies
-        order = __order.copy()
-        indices = __indices.copy()
-        columns = __columns.copy()
-        # Arrange to columns if there are more indices
-        if len(indices) > 0:
-            # Calculate the number of rows in already arranged columns
-            if len(columns) > 0:
-                # We must have a field name to select a dict item, use first
-                first_field_name = list(columns.keys())[0]
-                column_length = len(columns[first_field_name])
-            else:
-                column_length = 1
-            # Find next field to arrange, and get its items for a new column
-            field = order.pop()
-            items = indices.pop(field)
-            new_columns = { field: [] }
-            # In the new column, the items are repeated with the length of
-            # the already arranged columns
-            for i in items:
-                new_columns[field].extend([i]*column_length)
-            # The already arranged columns are duplicated with the number
-            # of items in the new column
-            for column_name in columns.keys():
-                new_columns[column_name] = columns[column_name]*len(items)
-            # Recursively call back
-            return self.item_combos(order,indices,new_columns)
-        # If no more indices, we're done doing the arranged columns
-        else:
-            return columns
+        self.labels = labels
+        # Key number n has the label number (n // stride) % len(labels)
+        # for each index, so no keys are stored in memory
+        self.strides = []
+        self.length = 1
+        for index_labels in reversed(labels):
+            self.strides.insert(0, self.length)
+            self.length = self.length * len(index_labels)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, index):
+        """Return key tuple at index, or list of key tuples for a slice."""
+        if isinstance(index, slice):
+            return [self[n] for n in range(*index.indices(self.length))]
+        if index < 0:
+            index = index + self.length
+        if index < 0 or index >= self.length:
+            raise IndexError('key list index out of range')
+        key = []
+        for (index_labels, stride) in zip(self.labels, self.strides):
+            key.append(index_labels[(index // stride) % len(index_labels)])
+        return tuple(key)
 
+    def __iter__(self):
+        # Iterating does not need the arithmetic of random access
+        if self.length > 0:
+            yield from itertools.product(*self.labels)
 
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Sequence) or len(self) != len(other):
+            return False
+        return all(a == b for (a, b) in zip(self, other))
@@ -1,8 +1,12 @@
 
 from django.db import models
+from django.db.models.signals import class_prepared
+from django.dispatch import receiver
 from decimal import Decimal
 
 from . version import Version
+from . keys import Keys
+from . codec import NumberCodec
 from . errors import NoFieldError, NotDecimalError, NoItemError
 
 class AssessModel(models.Model):
@@ -43,18 +47,16 @@ class AssessModel(models.Model):
 
     def set_fk_labels_objects(self):
         """Set lookup dict for foreign key objects by column name and label."""
-        # TODO: Refactor keys.py to use this method
-        fc = { 'version_first__isnull': False, 'version_last__isnull': True }
         self.fk_labels_objects = {}
         fields = self.index_fields.copy()
         # We need to be able to look up value_field in mappings_model
         if self.model_type == 'mappings_model':
             fields.append(self.value_field)
         for field in fields:
-            self.fk_labels_objects[field] = {}
             column_model = self._meta.get_field(field).remote_field.model
-            for item in column_model.objects.filter(**fc):
-                self.fk_labels_objects[field][item.label] = item
+            # The current items are shared with (and cached by) Keys
+            (ids_labels, labels_ids, labels_objects, labels) = Keys.get_items(column_model)
+            self.fk_labels_objects[field] = labels_objects
 
     # Consider moving this definition inside collection.py, only place its used
     # OBS: Now also used in tableIO.py ... perhaps smart choice, since we can
@@ -165,17 +167,13 @@ class DataModel(AssessModel):
                 if as_type == 'float':
                     return float(decimal_val)
                 else:
-                    # TODO: Figure out Python locale solution
-                    # that will also include CSV cell and line separators
-                    # First format to EN-US / EN-UK dot for decimal + comma for 1000
-                    dp = self._meta.get_field('value').decimal_places
-                    decimal_str = ('{:,.' + str(dp) + 'f}').format(decimal_val)
-                    # Temporarily store . as #.#
-                    decimal_str = decimal_str.replace('.','#.#')
-                    # Then replace to user custom format cf delimiters
-                    decimal_str = decimal_str.replace(',',self.delimiters['thousands'])
-                    decimal_str = decimal_str.replace('#.#',self.delimiters['decimal'])
-                    return decimal_str
+                    return self.format_value(decimal_val)
+
+    @classmethod
+    def format_value(cls, decimal_val) -> str:
+        """Return a Decimal or float as string according to user format."""
+        # Columns of values should be formatted with NumberCodec.format()
+        return NumberCodec.get_codec(cls).format([decimal_val])[0]
 
 
     class Meta:
@@ -238,6 +236,26 @@ class ItemModel(AssessModel):
         abstract = True
 
 
+@receiver(class_prepared)
+def add_indexes(sender, **kwargs) -> None:
+    """Add composite indexes on version and index fields to AssessModels."""
+    if not issubclass(sender, AssessModel):
+        return
+    # All queries filter on the version fields: current is version_last
+    # null and version_first not null, proposed is both null etc.
+    fields_list = [['version_last', 'version_first']]
+    # Data and mappings records are also looked up by key (index fields)
+    # and version, e.g. when committing replaces current records by key
+    if sender.model_type in ['data_model', 'mappings_model']:
+        fields_list.append(sender.index_fields + ['version_last', 'version_first'])
+    indexes = list(sender._meta.indexes)
+    for fields in fields_list:
+        index = models.Index(fields=fields)
+        index.set_name_with_model(sender)
+        indexes.append(index)
+    sender._meta.indexes = indexes
+
+
 ### Models in base for testing only purposes - do not delete, test.py depends!
  
 class TestItemA(ItemModel):
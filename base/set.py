@@ -1,3 +1,4 @@
+from . keys import Keys
 from . messages import Messages
 from . version import Version
 
@@ -45,6 +46,8 @@ class AssessSet():
             l = self.message.get(msg, msg_kwargs)
             v = Version.objects.create(label=l, model_name=self.name)
             self.model.objects.filter(id=item_id).update(version_last=v.id)
+            # Queryset updates send no signals, so clear cached items here
+            Keys.clear_items_cache(self.model)
         finally:
             # Provide success or error message and a list of items
             self.context['item_list_message'] = self.message.get(msg, msg_kwargs)
@@ -98,6 +101,7 @@ class AssessSet():
                 try:
                     item = self.model.objects.create(label=new_label,version_first=v)
                     item.save()
+                    Keys.clear_items_cache(self.model)
                 except: # pragma: no cover
                     self.context['item_list_message'] = self.message.get('item_create_failure',d) # pragma: no cover
         self.set_list_context()
@@ -130,10 +134,11 @@ class AssessSet():
         # For all new labels, load to database as current items
         if new_labels:
             l = self.message.get()
-            v = Version.objects.create(label=l)
+            v = Version.objects.create(label=l, model_name=self.name)
             for new_label in new_labels:
                 item = self.model.objects.create(label=new_label, version_first=v)
                 item.save()
+            Keys.clear_items_cache(self.model)
         self.set_list_context()
         d = {'new_labels': new_labels, 'duplicates': duplicates, 'model_name': self.name }
         self.context['item_list_heading'] = self.message.get("item_upload_heading",d)
@@ -158,9 +163,13 @@ class AssessSet():
             if new_label in self.labels:
                 self.context['item_list_message'] = self.message.get('item_update_failure',d)
             else:
+                # Renaming is registered as a new version of the items
+                l = self.message.get('item_update_success',d)
+                Version.objects.create(label=l, model_name=self.name)
                 item = self.model.objects.get(pk=item_id)
                 item.label = new_label
                 item.save()
+                Keys.clear_items_cache(self.model)
                 self.context['item_list_message'] = self.message.get('item_update_success',d)
         self.set_list_context()
         return self.context
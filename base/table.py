@@ -1,8 +1,10 @@
 from django.core.exceptions import ValidationError
 from django.db import IntegrityError, transaction
+from django.db.models import Avg, Count, Exists, Max, OuterRef
 
 from . keys import Keys
-from . version import Version
+from . columns import AssessColumns
+from . version import Version, VersionHead, Snapshot
 from . errors import NotCleanRecord, NoRecordIntegrity, AssessError
 from . messages import Messages
 from . tableIO import AssessTableIO
@@ -11,6 +13,18 @@ from . tableIO import AssessTableIO
 class AssessTable():
     """Abstract class for collections of AssessModel objects."""
 
+    rows_per_page = 100                         # Default rows on a page
+    rows_per_page_max = 10000                   # Maximum rows on a page
+    sparse_density = 0.05                       # Sparse display below this
+    history_per_page = 20                       # Versions shown in history
+    snapshot_interval = 0                       # Versions between snapshots
+    snapshot_retention = 3                      # Snapshots kept per model
+    save_batch_size = 10000                     # Records per bulk insert
+    # Metrics of proposed versions, by model name, and the fingerprint of
+    # the proposed records they were aggregated from:
+    # {model_name: (fingerprint dict, version metric dict)}
+    proposed_cache = {}
+
     def __init__(self,model: object, version: str) -> None:
         """Initialise the collection from AssessModel / Django model.
 
@@ -23,13 +37,29 @@ class AssessTable():
         self.version.set_version_id(version)
         self.keys = Keys(self.model)
         self.message = Messages()
-        # Records are kept in a dict with values of model objects
-        # The record dict keys are tuples of the index fields
-        self.records = {}                       # Dict of model objects
+        # Records are kept in array-backed columns, that map record keys
+        # (tuples of the index fields) to model objects created on demand
+        self.records = AssessColumns(self.model, self.keys)
         self.records_changed = {}               # Dict of changed model objects
         # Each row is a dict with keys from self.header and values from DB
         self.errors = []                        # List of errors from parsing
         self.rows = []                          # List of row dicts
+        # Tables are displayed one page (window of rows) at a time
+        self.page = 1                           # Page number, from 1
+        self.page_size = self.rows_per_page     # Rows on a page
+        self.page_count = 1                     # Number of pages
+        self.row_count = 0                      # Number of rows in table
+        # Sparse tables show only rows with records, selected by request
+        # or automatically if the records are few compared to table size
+        self.sparse = False                     # Show only rows with records
+        self.sparse_auto = True                 # Select sparse by density
+        self.history_size = self.history_per_page   # Versions shown
+        self.history_more = False               # More versions than shown
+        # Differences between two versions, see load_diff()
+        self.diff_versions = (0, 0)             # Older and newer version id
+        self.diff_old = None                    # Records only in older
+        self.diff_new = None                    # Records only in newer
+        self.diff_index = ([], [])              # Arrays of differing records
 
     def get_context(self):
         """Get context for printing table, history and navigation links."""
@@ -43,87 +73,339 @@ class AssessTable():
             context['header_list_index'] = self.keys.index_headers
             context['header_list_items'] = self.keys.value_headers
             context['history'] = self.get_history_context()
+            if self.history_more:
+                history = self.history_size + self.history_per_page
+                context['history_more_query'] = self.get_page_query(self.page, history=history)
             context['version_link_id'] = self.version.link_id
             context['errors'] = self.errors
+            context.update(self.get_page_context())
         return context
 
     def render_table_context(self, column_field: str, dif: bool, order=[]) -> dict:
-        """Render table to Django template."""
-        self.load(dif, order)
-        self.set_rows(column_field, 'display')
+        """Render the table's current page to Django template."""
+        self.keys.set_headers(column_field)
+        self.set_sparse(dif)
+        if self.sparse:
+            # Sparse rows are found from the records, so all are loaded
+            self.load(dif)
+        (start, stop) = self.get_page_rows()
+        if not self.sparse:
+            self.load_rows(dif, start, stop)
+        self.set_rows(column_field, 'display', start, stop)
         context = self.get_context()
         return context
 
-    def set_rows(self,column_field: str, table_type='display') -> None:
+    def set_page(self, GET: dict, sparse=None) -> None:
+        """Set page number, page size and sparse from request GET parameters.
+
+            GET (dict): request GET parameters page, size and sparse
+            sparse (bool): sparse mode if not in GET, None for automatic
+        """
+        try:
+            self.page = max(int(GET.get('page', 1)), 1)
+        except (TypeError, ValueError):
+            self.page = 1
+        try:
+            size = int(GET.get('size', self.rows_per_page))
+        except (TypeError, ValueError):
+            size = self.rows_per_page
+        if 0 < size <= self.rows_per_page_max:
+            self.page_size = size
+        try:
+            history = int(GET.get('history', self.history_per_page))
+        except (TypeError, ValueError):
+            history = self.history_per_page
+        if 0 < history <= self.rows_per_page_max:
+            self.history_size = history
+        sparse = { '1': True, '0': False }.get(GET.get('sparse'), sparse)
+        if sparse is not None:
+            self.sparse = sparse
+            self.sparse_auto = False
+
+    def set_sparse(self, changes: bool) -> None:
+        """Select sparse mode if automatic and the table has few records."""
+        if self.sparse_auto:
+            # The count of records to load is a cheap estimate of cells
+            # Empty tables are shown in full, to give something to edit
+            records = self.get_load_query(changes).count()
+            self.sparse = 0 < records < self.keys.size * self.sparse_density
+
+    def get_page_rows(self) -> (int, int):
+        """Return first and after-last row number of the page (headers set)."""
+        if self.sparse:
+            # Sparse rows are the rows with records, which must be loaded
+            index_headers = self.keys.index_headers
+            self.row_count = self.records.count_stored_rows(index_headers)
+        else:
+            self.row_count = len(self.keys.get_key_list())
+        return self.get_page_window()
+
+    def get_page_window(self) -> (int, int):
+        """Return first and after-last row number of the page (row_count set)."""
+        # Integer ceiling of row_count / page_size, at least one page
+        self.page_count = max(-(-self.row_count // self.page_size), 1)
+        self.page = min(self.page, self.page_count)
+        start = (self.page - 1) * self.page_size
+        stop = min(start + self.page_size, self.row_count)
+        return start, stop
+
+    def get_page_context(self) -> dict:
+        """Return context for page navigation links."""
+        context = {}
+        context['page'] = self.page
+        context['page_count'] = self.page_count
+        context['page_size'] = self.page_size
+        context['row_count'] = self.row_count
+        links = []
+        pages = [('First', 1), ('Previous', self.page - 1),
+                 ('Next', self.page + 1), ('Last', self.page_count)]
+        for (readable, page) in pages:
+            if 1 <= page <= self.page_count and page != self.page:
+                query = self.get_page_query(page)
+                links.append({ 'readable': readable, 'query': query })
+        context['page_links'] = links
+        # Link for switching between sparse and full table
+        context['sparse'] = self.sparse
+        context['sparse_query'] = self.get_page_query(1, not self.sparse)
+        return context
+
+    def get_page_query(self, page: int, sparse=None, history=None) -> str:
+        """Return GET query string for a page of the table.
+
+            page (int): page number
+            sparse (bool): sparse mode to select, None to keep the mode
+            history (int): number of versions shown, None to keep it
+        """
+        query = '?page=' + str(page) + '&size=' + str(self.page_size)
+        # Selected sparse mode is kept, automatic mode is left out
+        if sparse is None and not self.sparse_auto:
+            sparse = self.sparse
+        if sparse is not None:
+            query += '&sparse=' + str(int(sparse))
+        if history is None:
+            history = self.history_size
+        if history != self.history_per_page:
+            query += '&history=' + str(history)
+        return query
+
+    def set_rows(self,column_field: str, table_type='display', start=0, stop=None) -> None:
         """Pivot table and populate self.rows with table for Django template"""
         # Calculate the table's column headers and row keys
         self.keys.set_headers(column_field)
         # OBS: Perhaps implement ordering of index columns at some point
         # (or rely on jQuery functionality if implemented?)
-        key_list = self.keys.get_key_list()
-        # keys.get_key_list(): List of tuples - [(item1,itemX),(item2,itemX)]
-        for key in key_list:
-            # The row is a dict of header names and cell values for that row
-            # Add index_headers and index values (from key) to the row
-            row = dict(zip(self.keys.index_headers,key))
-            # Add value cells to row by looking up the value in self.records
-            for value_header in self.keys.value_headers:
-                # The record key also contains the value_header key, and its
-                # index_fields are always sorted by self.model.index_fields
-                record_key = ()
-                for index_field in self.model.index_fields:
-                    if index_field == self.keys.column_field:
-                        record_key += (value_header,)
-                    elif index_field in self.keys.index_headers:
-                        record_key += (row[index_field],)
-                # data_model: the value index field is value_field for all rows
-                record_key += (self.model.value_field,)
-                # Try to pick the record value from the loaded DB records
-                try:
-                    record = self.records[record_key]
-                # Do nothing (no value) if the key's record does not exist
-                except:
-                    row[value_header] = 'n.d.'
-                # Assign value to the cell in the table row to be displayed
-                else:
-                    # .get_value raises NotDecimal with corrupted self.records
-                    try:    
-                        row[value_header] = str(record.get_value())
-                    # TODO: Find a good test case triggering that
-                    except: # pragma: nocover
-                        row[value_header] = 'n.d.'
-                    row[value_header + '_id'] = record.id
-                    row[value_header + '_key'] = str(record.get_key())
-            # When all column_fields are done, the row is done
-            self.rows.append(row.copy())
+        # The pivot is done on the record columns: each row is a dict of
+        # header names and cell values, and each value cell also has the
+        # record id and record key (value_header + '_id' and + '_key')
+        # Only the rows from start to stop are made, default all rows
+        self.rows = self.records.pivot(self.keys.index_headers,
+                                       self.keys.value_headers,
+                                       self.keys.column_field, start, stop,
+                                       self.sparse)
 
     def load(self, changes: bool ,order=[]) -> None:
         """Load model object fields by version to self.records
 
         Arguments
-            order (list): list of Django field names for .order()
+            order (list): unused, records are kept in model.index_fields order
             changes (bool): True for version changes, False for full version
         """
 
-        # Order is the ordering list of fields, if empty use model.index_fields
-        if order == []:
-            order = self.model.index_fields
-        # Execute query according to version and load into data frame
-        fv = self.version.kwargs_filter_load(changes)
-        query = self.model.objects.filter(**fv).order_by(*order)
-        # Create record dict with key being tuple of index fields and
-        # values being model objects
-        # If records are sorted from lowest to highest id, the record
-        # dict will end up having only the one latest record for all versions
-        self.records = {}
-        for model_object in query:
-            key = model_object.get_key()
-            self.records[key] = model_object
+        # Execute query according to version and load into columns
+        query = self.get_load_query(changes)
+        # The columns hold the one latest (highest id) record for each key,
+        # and they are built from fk ids, so no related items are fetched
+        self.records = AssessColumns(self.model, self.keys)
+        snapshot = self.get_snapshot(changes)
+        if snapshot is None:
+            self.records.load(query)
+        else:
+            # Start from the snapshot and apply the changes since then
+            (archived, added) = self.get_diff_queries(snapshot.version_id,
+                                                      self.version.version_id)
+            archived_ids = list(archived.values_list('id', flat=True))
+            self.records.load_snapshot(bytes(snapshot.data), archived_ids, added)
+
+    def load_rows(self, changes: bool, start: int, stop: int) -> None:
+        """Load only records in the rows from start to stop (headers set).
+
+        Arguments
+            changes (bool): True for version changes, False for full version
+            start, stop (int): first and after-last row number to load
+        """
+        # Archived versions with a snapshot are loaded from the snapshot
+        if self.get_snapshot(changes) is not None:
+            self.load(changes)
+            return
+        query = self.get_load_query(changes)
+        key_list = self.keys.get_key_list()
+        # Filter on the items used in the rows of the window; the records
+        # of the rows in the window are a subset of the loaded records
+        if (start, stop) != (0, len(key_list)):
+            keys = key_list[start:stop]
+            for (n, field) in enumerate(self.keys.index_headers):
+                labels = set(key[n] for key in keys)
+                # No filter needed if all of an index' items are in the rows
+                if len(labels) < len(self.keys.indices_labels[field]):
+                    labels_ids = self.keys.indices_labels_ids[field]
+                    ids = [labels_ids[label] for label in labels]
+                    query = query.filter(**{ field + '__in': ids })
+        self.records = AssessColumns(self.model, self.keys)
+        self.records.load(query)
+
+    def get_snapshot(self, changes: bool) -> object:
+        """Return latest snapshot to load an archived version from, or None."""
+        # No snapshots are taken with snapshot_interval 0, so none are read
+        if changes or self.version.status != 'archived' or self.snapshot_interval <= 0:
+            return None
+        snapshots = Snapshot.objects.filter(model_name=self.model_name,
+                                            version_id__lte=self.version.version_id)
+        return snapshots.order_by('-version_id').first()
+
+    def take_snapshot(self, version_id=None) -> object:
+        """Save and return snapshot of the current records at version_id.
+
+            version_id (int): the latest version, default the model's head
+        """
+        # The head is read from the database, as cached heads may be old
+        if version_id is None:
+            version_id = VersionHead.get_head(self.model_name)
+        columns = AssessColumns(self.model, self.keys)
+        columns.load(self.model.objects.filter(**self.version.kwargs_filter('current')))
+        snapshot = Snapshot.objects.create(model_name=self.model_name,
+                                           version_id=version_id,
+                                           cells=len(columns),
+                                           data=columns.dump())
+        # Keep only the latest snapshot_retention snapshots of the model
+        snapshots = Snapshot.objects.filter(model_name=self.model_name)
+        old_ids = snapshots.order_by('-version_id').values_list('id', flat=True)
+        old_ids = list(old_ids[self.snapshot_retention:])
+        Snapshot.objects.filter(id__in=old_ids).delete()
+        return snapshot
+
+    def take_snapshot_if_due(self, version_id: int) -> None:
+        """Take snapshot if snapshot_interval versions since the last one."""
+        if self.snapshot_interval <= 0:
+            return
+        snapshots = Snapshot.objects.filter(model_name=self.model_name)
+        last = snapshots.aggregate(Max('version_id'))['version_id__max'] or 0
+        versions = Version.objects.filter(model_name=self.model_name, id__gt=last)
+        if versions.count() >= self.snapshot_interval:
+            self.take_snapshot(version_id)
+
+    def get_load_query(self, changes: bool, version=None) -> object:
+        """Return Django query of records for the table's (or a) version."""
+        if version is None:
+            version = self.version
+        fv = version.kwargs_filter_load(changes)
+        ev = version.kwargs_exclude_load(changes)
+        return self.model.objects.filter(**fv).exclude(**ev)
+
+    def get_cells_query(self, version=None) -> object:
+        """Return Django query of the table version's cells, one per key."""
+        query = self.get_load_query(False, version)
+        # As when loading, the record with the highest id is kept for a key,
+        # e.g. a proposed record rather than the current record it replaces
+        same_key = {}
+        for field in self.model.index_fields:
+            same_key[field] = OuterRef(field)
+        newer = Exists(query.filter(id__gt=OuterRef('id'), **same_key))
+        query = query.filter(~newer)
+        # Records with items that are not current are not in the table
+        for field in self.model.index_fields:
+            query = query.filter(**{ field + '__version_first__isnull': False,
+                                     field + '__version_last__isnull': True })
+        return query
+
+    def load_diff(self, ver_old: str, ver_new: str) -> None:
+        """Load the records that differ between two versions.
+
+        Arguments
+            ver_old, ver_new (str): version id or 'current', in any order
+        """
+        ids = []
+        for ver in [ver_old, ver_new]:
+            version = Version()
+            version.set_version_id(ver)
+            ids.append(version.version_id)
+        (old, new) = sorted(ids)
+        self.diff_versions = (old, new)
+        (only_old, only_new) = self.get_diff_queries(old, new)
+        self.diff_old = AssessColumns(self.model, self.keys)
+        self.diff_old.load(only_old)
+        self.diff_new = AssessColumns(self.model, self.keys)
+        self.diff_new.load(only_new)
+        # A key may have been changed and changed back to its old value
+        self.diff_index = self.diff_old.compare(self.diff_new)
+
+    def get_diff_queries(self, old: int, new: int) -> (object, object):
+        """Return queries of records only in old and only in new version."""
+        # Only records changed between the versions are loaded, both found
+        # with the version indexes: the records of the old version that
+        # were archived by the new version, and the records that were
+        # committed after the old and are still current at the new version
+        only_old = self.model.objects.filter(version_first__lte=old,
+                                             version_last__gt=old,
+                                             version_last__lte=new)
+        only_new = self.model.objects.filter(version_first__gt=old,
+                                             version_first__lte=new)
+        only_new = only_new.exclude(version_last__lte=new)
+        return only_old, only_new
+
+    def get_diff_rows(self, start=0, stop=None) -> list:
+        """Return rows start to stop of the loaded differences, as dicts."""
+        rows = []
+        index_old = self.diff_index[0][start:stop]
+        index_new = self.diff_index[1][start:stop]
+        # The values of the window are formatted as columns
+        values_old = iter(self.diff_old.get_values(index_old[index_old >= 0]))
+        values_new = iter(self.diff_new.get_values(index_new[index_new >= 0]))
+        for (i, j) in zip(index_old.tolist(), index_new.tolist()):
+            if i < 0:
+                key = self.diff_new.get_key(j)
+            else:
+                key = self.diff_old.get_key(i)
+            row = dict(zip(self.model.index_fields, key))
+            row['old'] = next(values_old) if i >= 0 else 'n.d.'
+            row['new'] = next(values_new) if j >= 0 else 'n.d.'
+            if i < 0:
+                row['change'] = 'added'
+            elif j < 0:
+                row['change'] = 'removed'
+            else:
+                row['change'] = 'changed'
+            rows.append(row)
+        return rows
+
+    def render_diff_context(self, ver_old: str, ver_new: str) -> dict:
+        """Render the current page of differences between two versions."""
+        self.load_diff(ver_old, ver_new)
+        self.row_count = len(self.diff_index[0])
+        (start, stop) = self.get_page_window()
+        context = self.get_page_context()
+        # Differences are never sparse or full, they are the changed cells
+        del context['sparse'], context['sparse_query']
+        context['table_model_name'] = self.model_name
+        context['header_list'] = self.model.index_fields + ['old', 'new', 'change']
+        context['row_list'] = self.get_diff_rows(start, stop)
+        (context['diff_old'], context['diff_new']) = self.diff_versions
+        return context
+
+    def get_diff_CSV(self, sep='\t', chunk_size=1000) -> object:
+        """Yield lines of the loaded differences as CSV, with a header line."""
+        header = self.model.index_fields + ['old', 'new', 'change']
+        yield sep.join(header) + '\n'
+        # The lines are made a chunk at a time for streaming responses
+        for start in range(0, len(self.diff_index[0]), chunk_size):
+            lines = []
+            for row in self.get_diff_rows(start, start + chunk_size):
+                lines.append(sep.join(row[field] for field in header) + '\n')
+            yield ''.join(lines)
 
     def save_POST(self, POST: dict) -> None:
         """Parse a POST dict from edit_view and save changes to DB."""
         delimiters = {'decimal': ',', 'thousands': '.', 'sep': '\t' }
-        tableIO = AssessTableIO(self.model, delimiters)
+        tableIO = AssessTableIO(self.model, delimiters, self.keys)
         records = tableIO.parse_POST(POST)
         self.errors = tableIO.errors
         # Load current records, so that we can save only changed records
@@ -133,13 +415,33 @@ class AssessTable():
     def save_CSV(self, POST: dict) -> None:
         """Parse CSV table data from upload_view and save changes to DB."""
         delimiters = {'decimal': ',', 'thousands': '.', 'sep': '\t' }
-        tableIO = AssessTableIO(self.model, delimiters)
-        records = tableIO.parse_csv(POST)
+        tableIO = AssessTableIO(self.model, delimiters, self.keys)
+        records = tableIO.parse_csv_columns(POST)
         self.errors = tableIO.errors
         # Load current records, so that we can save only changed records
         self.load(False)
         self.save_changed_records(records)
 
+    def save_CSV_file(self, csv_file: object, column_field: str) -> None:
+        """Parse uploaded CSV file in batches and save changes to DB."""
+        delimiters = {'decimal': ',', 'thousands': '.', 'sep': '\t' }
+        tableIO = AssessTableIO(self.model, delimiters, self.keys)
+        # Errors of the parser and of save_changed_records are collected
+        # in the same list
+        self.errors = tableIO.errors
+        # As for save_CSV, nothing is saved if any line has errors, so the
+        # batches are saved in one transaction that is rolled back on errors
+        with transaction.atomic():
+            # Load current records, so that we can save only changed records
+            self.load(False)
+            for records in tableIO.parse_csv_file(csv_file, column_field):
+                # Parsing continues after an error to report all errors,
+                # but there is no need to save the remaining batches
+                if self.errors == []:
+                    self.save_changed_records(records)
+            if self.errors != []:
+                transaction.set_rollback(True)
+
     def get_CSV_form_context(self) -> dict:
         """Return context for table upload form."""
         context = {}
@@ -160,21 +462,43 @@ class AssessTable():
     def save_changed_records(self,records: dict) -> None:
         """Filter records that were changed, and save them."""
         self.records_changed = {}
-        for (key,new_record) in records.items():
-            try:
+        # Parsed columns are compared with the loaded columns as arrays,
+        # and model objects are only made for the changed records
+        if isinstance(records, AssessColumns):
+            (index_old, index_new) = self.records.compare(records)
+            self.save_bulk(records, index_new[index_new >= 0])
+        else:
+            for (key,new_record) in records.items():
                 # We cannot be sure record[key] exist, may be new record
-                old_record = self.records[key]
-            except:
-                # If no old record with key, new record is new: save it
-                self.records_changed[key] = new_record
-            else:
-                # .get_value() may raise NotDecimal
-                try:
-                    if new_record.get_value() != old_record.get_value():
-                        self.records_changed[key] = new_record
-                except AssessError as e:
-                    self.errors.append(e)
-        self.save()
+                i = self.records.find(key)
+                if i < 0:
+                    # If no old record with key, new record is new: save it
+                    self.records_changed[key] = new_record
+                else:
+                    # .get_value() may raise NotDecimal
+                    try:
+                        new_value = str(new_record.get_value())
+                        if new_value != self.records.get_value(i):
+                            self.records_changed[key] = new_record
+                    except AssessError as e:
+                        self.errors.append(e)
+            self.save()
+
+    def save_bulk(self, columns: object, index: object) -> None:
+        """Save records of parsed columns at array indexes in bulk.
+
+            columns (object): AssessColumns of records from AssessTableIO
+            index (object): array of indexes of the records to save
+        """
+        # The parser has already validated the records: the items are
+        # current items and values fit the value field (see NumberCodec),
+        # so records are not cleaned and saved one by one as in save()
+        with transaction.atomic():
+            for start in range(0, len(index), self.save_batch_size):
+                batch = index[start:start+self.save_batch_size].tolist()
+                records = [columns.get_record(i) for i in batch]
+                self.model.objects.bulk_create(records)
+            self.proposed_cache.pop(self.model_name, None)
 
 
     def save(self) -> None:
@@ -191,6 +515,7 @@ class AssessTable():
                         raise NotCleanRecord(record,error)
                     else:
                         record.save()
+                self.proposed_cache.pop(self.model_name, None)
             # Integrity errors are caused by unique constraints and ??
             # TODO: This error branch is not tested
             except IntegrityError as error: # pragma: nocover
@@ -216,42 +541,98 @@ class AssessTable():
         for key in version_info.keys():
             if key in ['label','user','note']:
                 version_info_clean[key] = version_info[key]
-        # Add a new version to the Version table
-        version = Version.objects.create(**version_info_clean)
-        version.set_version_id("proposed")
-        # Iterate all proposed records and commit them (setting version_first
-        # to this version) and set the key identical record to archived
-        # (version_last to this version)
-        filter_dict = version.kwargs_filter('proposed')
-        for record in self.model.objects.filter(**filter_dict):
-            record.commit(version)
-        version.cells =  self.count_db_records('current')
-        version.save()
-
-    def get_version_metric(self) -> dict:
-        """Add info for version to dict."""
+        # The version and all record updates are committed in one go, so
+        # the table is never seen half committed
+        with transaction.atomic():
+            # Add a new version to the Version table
+            version = Version.objects.create(**version_info_clean)
+            version.set_version_id("proposed")
+            self.commit_bulk(version)
+            version.cells =  self.count_db_records('current')
+            version.save()
+            self.take_snapshot_if_due(version.id)
+        self.proposed_cache.pop(self.model_name, None)
+
+    def commit_bulk(self, version: object) -> None:
+        """Commit all proposed records using set-based UPDATE statements.
+
+            version (object): the Version object of the new commit
+        """
+        # Proposed records have neither version_first nor version_last
+        proposed = self.model.objects.filter(**version.kwargs_filter('proposed',True))
+        current = self.model.objects.filter(**version.kwargs_filter('current'))
+        # Correlate a record with other records having the same index key
+        same_key = {}
+        for field in self.model.index_fields:
+            same_key[field] = OuterRef(field)
+        # 1) Archive the current records that are replaced by a proposed
+        #    record with the same key (version_last to this version)
+        replaced = Exists(proposed.filter(**same_key))
+        current.filter(replaced).update(version_last=version)
+        # 2) A key may have been proposed more than once; as with committing
+        #    the records one by one, all but the newest are archived at once
+        superseded = Exists(proposed.filter(id__gt=OuterRef('id'), **same_key))
+        proposed.filter(superseded).update(version_first=version,
+                                           version_last=version)
+        # 3) The remaining proposed records are set to current by setting
+        #    their version_first to this version
+        proposed.update(version_first=version)
+
+    def get_version_metric(self, version=None) -> dict:
+        """Add info for the table's version (or version) to dict."""
+        if version is None:
+            version = self.version
         version_dict = {}
         version_dict['size'] = self.keys.size
         version_dict['dimension'] = self.keys.dimension
         version_dict['model_name'] = self.model_name
-        values = self.get_values_by_list()
-        version_dict['cells'] = len(values)
-        if len(values) > 0: 
-            version_dict['metric'] = sum(values) / len(values)
+        # Cells and mean value are aggregated by the database, so that no
+        # records need to be loaded
+        aggregates = { 'cells': Count('id') }
+        if self.model.model_type == 'data_model':
+            aggregates['metric'] = Avg(self.model.value_field)
+        values = self.get_cells_query(version).aggregate(**aggregates)
+        version_dict['cells'] = values['cells']
+        if values.get('metric') is not None:
+            version_dict['metric'] = float(values['metric'])
         else:
             version_dict['metric'] = 0
-        if self.version.status == 'proposed':
-            version_dict['changes'] = self.count_db_records('proposed')
+        if version.status == 'proposed':
+            # Changes are the proposed records only, not the current ones
+            filter_dict = version.kwargs_filter('proposed', True)
         else:
-            version_dict['changes'] = self.count_db_records('changes')
+            filter_dict = version.kwargs_filter('changes')
+        version_dict['changes'] = self.model.objects.filter(**filter_dict).count()
         return version_dict
 
+    def get_proposed_metric(self) -> dict:
+        """Return (cached) metrics of proposed version, None if no proposals."""
+        version = Version()
+        version.set_version_id('proposed')
+        filter_dict = version.kwargs_filter('proposed', True)
+        proposed = self.model.objects.filter(**filter_dict)
+        # Proposed records are only added or deleted, and commits make them
+        # current, so the count, the newest id and the latest version (of
+        # all models, as items may have changed) identify the proposal
+        fingerprint = proposed.aggregate(Count('id'), Max('id'))
+        if fingerprint['id__count'] == 0:
+            return None
+        fingerprint['current'] = Version().get_current_version()
+        try:
+            (cached_fingerprint, version_dict) = self.proposed_cache[self.model_name]
+        except KeyError:
+            cached_fingerprint = None
+        if cached_fingerprint != fingerprint:
+            version_dict = self.get_version_metric(version)
+            self.proposed_cache[self.model_name] = (fingerprint, version_dict)
+        return version_dict.copy()
+
     def get_history_context(self) -> dict:
         """Provide context for history informations of the table."""
         history_list = [] # List of version objects
         # Proposed version is calculated from the database proposed records
-        if self.count_db_records('proposed') > 0:
-            version_dict = self.get_version_metric()
+        version_dict = self.get_proposed_metric()
+        if version_dict is not None:
             proposed = Version(**version_dict)
             proposed.status = "Proposed"
             proposed.id = 0
@@ -261,17 +642,20 @@ class AssessTable():
             proposed.revert_link = self.model_name + "_revert"
             proposed.idlink = "proposed"
             history_list.append(proposed)
-        # All other versions than proposed can be loaded from the version table
-        versions = Version.objects.filter(model_name=self.model_name).order_by('-date')
+        # All other versions than proposed can be loaded from the version
+        # table, newest first and history_size at a time. One more version
+        # is fetched to tell if there are more to show
+        query = Version.objects.filter(model_name=self.model_name).order_by('-id')
+        versions = list(query[0:self.history_size + 1])
+        self.history_more = len(versions) > self.history_size
+        versions = versions[0:self.history_size]
         # The current version is the newest (ideally, we need to check that the data table
         # has not been totaly archived by setting a version last on all records)
-        if len(versions) > 0:
-            current = versions[0]
-        for version in versions:
+        for (n, version) in enumerate(versions):
             # It simplifies much in the datatable.load_model() to ask for "current" version
             # rather than the id of current version
-            if version.id  == current.id:
-                version.idlink = current.id
+            if n == 0:
+                version.idlink = version.id
                 version.status = "Current"
             else:
                 version.idlink = version.id
@@ -285,14 +669,7 @@ class AssessTable():
         """Delete all proposed rows (with empty version_begin and version_end)."""
         filter_dict = self.version.kwargs_filter('proposed')
         self.model.objects.filter(**filter_dict).delete()
-
-    def get_values_by_list(self):
-        """Return data model values as list of floats."""
-        values = []
-        if self.model.model_type == 'data_model':
-            for r in self.records.values():
-                values.append(r.get_value('float'))
-        return values
+        self.proposed_cache.pop(self.model_name, None)
 
     def count_db_records(self, status: str, changes=False) -> int:
         """Returns count of database rows with a selected status."""
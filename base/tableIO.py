@@ -1,7 +1,19 @@
+import codecs
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice, repeat
+
+import django
+import numpy
 import pandas
+from django.apps import apps
 from . keys import Keys
+from . columns import AssessColumns
+from . codec import NumberCodec
 from . errors import AssessError, CSVheaderMalformed, CSVwrongColumnCount, \
-                     CSVfieldNotFound
+                     CSVfieldNotFound, CSVtooManyErrors, NoFieldError, \
+                     NoItemError
 
 
 class AssessTableIO():
@@ -23,9 +35,21 @@ class AssessTableIO():
         # the object is stored in self.changed_records for later processing
         # OBS: We could have used DataFrames for processing, but we then would
         #      miss extensive error checking and detailed error reporting
+        # The parse_*_columns methods do process whole columns at a time
+        # with pandas/numpy, see parse_frame(), returning AssessColumns. The
+        # same detailed errors are made, but only for the cells with errors
+
+    batch_size = 10000                  # Lines per batch of parse_csv_file
+    processes = 0                       # Parse processes, 0 for CPU count
+    parallel_lines = 100000             # Lines to parse in parallel processes
+    max_errors = 1000                   # Errors kept of parse_csv_file
+
+    def __init__(self,model: object, delimiters: dict, keys=None) -> None:
+        """Process user supplied input data table into records.
 
-    def __init__(self,model: object, delimiters: dict) -> None:
-        """Process user supplied input data table into records."""
+            keys (object): Keys of the table the records are compared with,
+                           default new Keys of model
+        """
         self.model = model              # The data_model to be matched
         self.delimiters = delimiters    # Delimiters, user's or default
         # An IO datatable column is either a index or value column
@@ -33,9 +57,16 @@ class AssessTableIO():
         self.table_index_headers = []   # Index headers from table
         self.table_value_headers = []   # Value headers from table
         self.rows = []                  # Rows is a list of header/value dicts
-        self.keys = Keys(model)         # Model key lookup for the record dict
+        # The records' cell codes are positions in the Keys' items, so they
+        # are only comparable with the records of a table of the same Keys
+        if keys is None:
+            keys = Keys(model)
+        self.keys = keys                # Model key lookup for the record dict
         self.records = {}               # The table as dict (key/model_object)
         self.errors = []                # List of exceptions reporting errors
+        self.errors_skipped = 0         # Count of errors over max_errors
+        self.table_headers = []         # Expected headers for error reports
+        self.error_lines = []           # Line numbers of the errors
 
 
     def parse_POST(self, POST: dict) -> dict:
@@ -64,6 +95,26 @@ class AssessTableIO():
                     self.records[key] = record
         return self.records
 
+    def get_rows(self, version: object) -> object:
+        """Returns iterator of row tuples for the version of table."""
+        # As get_dataframe(), but the rows are fetched from the database
+        # in batches when iterated, rather than all loaded at once
+        # Archived versions are the rows as they were at the version, as
+        # in AssessTable.load(), otherwise the current rows
+        if version.status == 'archived':
+            query = self.model.objects.filter(**version.kwargs_filter_load(False)) \
+                                      .exclude(**version.kwargs_exclude_load(False))
+        else:
+            query = self.model.objects.filter(**version.kwargs_filter('current'))
+        val_lst = []
+        for field in self.model.index_fields:
+            val_lst.append(field + '__label')
+        if self.model.model_type == 'mappings_model':
+            val_lst.append(self.model.value_field + '__label')
+        else:
+            val_lst.append(self.model.value_field)
+        return query.values_list(*val_lst).iterator(chunk_size=self.batch_size)
+
     def get_dataframe(self, version: object) -> object:
         """Returns pandas dataframe for current version of table."""
         # We want current version of the table
@@ -120,55 +171,413 @@ class AssessTableIO():
         # TODO: Add try/exception
         csv_string = POST['csv_string']
         column_field = POST['column_field']
+        lines = csv_string.splitlines()
+        csv_headers = self.set_csv_headers(lines.pop(0), column_field)
+        if csv_headers is None:
+            return {}
+        for line in lines:
+            self.parse_csv_line(line, csv_headers, column_field, self.records)
+        if self.errors == []:
+            return self.records
+        else:
+            return {}
+
+    def parse_csv_columns(self, POST: dict) -> object:
+        """Parse CSV string vectorized, return AssessColumns of the records."""
+        column_field = POST['column_field']
+        lines = POST['csv_string'].splitlines()
+        self.records = AssessColumns(self.model, self.keys)
+        csv_headers = self.set_csv_headers(lines.pop(0), column_field)
+        if csv_headers is None:
+            return self.records
+        columns = self.parse_csv_lines(lines, csv_headers, column_field)
+        # As parse_csv, return no records if any line has errors
+        if self.errors == []:
+            self.records = columns
+        return self.records
+
+    def parse_csv_file(self, csv_file: object, column_field: str) -> object:
+        """Parse CSV file, yield AssessColumns of each batch_size lines.
+
+            csv_file (object): binary file object, e.g. a Django UploadedFile
+            column_field (str): index field of the value columns, or value_field
+        """
+        # The file is decoded and split into lines as it is read, and the
+        # records are handed over a batch at a time, so memory use does not
+        # grow with the size of the upload. Errors are collected in
+        # self.errors as for parse_csv; the caller must discard saved batches
+        # if any errors are found later in the file. Only the first
+        # max_errors errors are kept, the others are counted in a last
+        # CSVtooManyErrors, as a file of the wrong format has an error for
+        # every line
+        lines = codecs.iterdecode(csv_file, 'utf-8-sig')
+        try:
+            csv_header = next(lines).rstrip('\r\n')
+        except StopIteration:
+            return
+        csv_headers = self.set_csv_headers(csv_header, column_field)
+        if csv_headers is None:
+            return
+        lines = (line.rstrip('\r\n') for line in lines)
+        # Whether the file is large enough for parsing in parallel is known
+        # from reading ahead parallel_lines lines. Large files are parsed in
+        # groups of a batch for each process, small files a batch at a time
+        ahead = list(islice(lines, self.parallel_lines))
+        processes = self.get_processes(len(ahead))
+        size = self.batch_size * processes
+        lines = chain(ahead, lines)
+        # The worker processes are started once for the whole file
+        executor = None
+        if processes > 1:
+            executor = self.get_executor(processes)
+        try:
+            while True:
+                batch = list(islice(lines, size))
+                if batch == []:
+                    break
+                columns = self.parse_csv_lines(batch, csv_headers, column_field,
+                                               processes, executor)
+                self.limit_errors()
+                yield columns
+            if self.errors_skipped > 0:
+                self.errors.append(CSVtooManyErrors(self.errors_skipped, self.model))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def limit_errors(self) -> None:
+        """Keep the first max_errors errors, count the others."""
+        if len(self.errors) > self.max_errors:
+            self.errors_skipped += len(self.errors) - self.max_errors
+            del self.errors[self.max_errors:]
+
+    def parse_csv_lines(self, lines: list, csv_headers: list,
+                        column_field: str, processes=None, executor=None) -> object:
+        """Parse CSV data lines vectorized, return AssessColumns of records.
+
+            lines (list): CSV lines (str) without the header line
+            csv_headers (list): CSV headers, checked by set_csv_headers()
+            column_field (str): index field of the value columns, or value_field
+            processes (int): count of processes, default see get_processes()
+            executor (object): worker processes, see get_executor()
+        """
+        if processes is None:
+            processes = self.get_processes(len(lines))
+        if processes > 1:
+            args = (csv_headers, column_field)
+            (columns, bad) = self.parse_parallel(parse_csv_chunk, lines, processes,
+                                                 args, executor)
+            # The lines with errors are parsed again for the error objects
+            self.parse_csv_lines([lines[n] for n in bad], csv_headers, column_field, 1)
+            return columns
+        sep = self.delimiters['sep']
+        lines = pandas.Series(lines, dtype=object)
+        # Lines with the wrong column count cannot be put in the dataframe
+        counts = lines.str.count(re.escape(sep)) + 1
+        good = numpy.flatnonzero(counts.to_numpy() == len(csv_headers))
+        bad = numpy.flatnonzero(counts.to_numpy() != len(csv_headers))
+        errors = []
+        for n in bad.tolist():
+            cells = lines[n].split(sep)
+            errors.append((n, CSVwrongColumnCount(cells, csv_headers, '', self.model)))
+        if len(good) > 0:
+            frame = lines.iloc[good].str.split(sep, expand=True, regex=False)
+        else:
+            frame = pandas.DataFrame(columns=range(len(csv_headers)))
+        # A header may appear twice, the last column is used as in parse_csv
+        positions = dict(zip(csv_headers, range(len(csv_headers))))
+        frame = frame[list(positions.values())]
+        frame.columns = list(positions.keys())
+        (columns, cell_errors) = self.parse_frame(frame, column_field)
+        # Cell errors are reported as CSVfieldNotFound with the CSV row
+        for (row, e1) in cell_errors:
+            n = int(good[row])
+            CSVrow = list(dict(zip(csv_headers, lines[n].split(sep))).values())
+            e2 = CSVfieldNotFound(CSVrow, self.table_headers, str(e1), self.model)
+            errors.append((n, e2))
+        # Errors are reported in line order, as parse_csv does
+        errors.sort(key=lambda error: error[0])
+        self.errors += [e for (n, e) in errors]
+        self.error_lines = [n for (n, e) in errors]
+        return columns
+
+    def parse_dataframe_columns(self, dataframe) -> object:
+        """Parse dataframe vectorized, return AssessColumns of the records."""
+        self.keys.set_headers(self.model.value_field)
+        self.table_index_headers = self.keys.index_headers
+        self.table_value_headers = self.keys.value_headers
+        self.records = AssessColumns(self.model, self.keys)
+        # The dataframe must have exactly the index fields and value field
+        # as columns, parse_dataframe reports the same error for each row
+        fields = [self.model.value_field] + self.model.index_fields
+        for field in list(dataframe.columns) + fields:
+            if field not in fields or field not in dataframe.columns:
+                self.errors += [NoFieldError(field, self.model)] * len(dataframe)
+                return self.records
+        processes = self.get_processes(len(dataframe))
+        if processes > 1:
+            args = (self.model.value_field,)
+            (columns, bad) = self.parse_parallel(parse_frame_chunk, dataframe, processes, args)
+            # The rows with errors are parsed again for the error objects
+            rows = dataframe.iloc[bad]
+            (bad_columns, cell_errors) = self.parse_frame(rows, self.model.value_field)
+        else:
+            (columns, cell_errors) = self.parse_frame(dataframe, self.model.value_field)
+        self.errors += [e for (row, e) in cell_errors]
+        if self.errors == []:
+            self.records = columns
+        return self.records
+
+    def parse_dataframes(self, dataframes: object) -> object:
+        """Parse dataframes of consecutive rows of a table, return
+        AssessColumns of the records.
+
+            dataframes (object): iterable of dataframes as for
+                                 parse_dataframe_columns(), e.g. row chunks
+        """
+        # Each dataframe can be released once parsed, so only the record
+        # arrays are kept for the whole table. The arrays are merged in
+        # order, so that the last cell of a key wins as in one dataframe
+        arrays = []
+        for dataframe in dataframes:
+            columns = self.parse_dataframe_columns(dataframe)
+            if self.errors == []:
+                arrays.append(columns.get_arrays())
+        if self.errors == [] and arrays != []:
+            self.records = self.merge_arrays(arrays)
+        return self.records
+
+    def merge_arrays(self, arrays: list) -> object:
+        """Return AssessColumns of the records of a list of arrays tuples,
+        as of AssessColumns.get_arrays(), in order."""
+        record_ids = numpy.concatenate([a[0] for a in arrays])
+        codes = {}
+        for field in self.model.index_fields:
+            codes[field] = numpy.concatenate([a[1][field] for a in arrays])
+        values = numpy.concatenate([a[2] for a in arrays])
+        firsts = numpy.concatenate([a[3] for a in arrays])
+        lasts = numpy.concatenate([a[4] for a in arrays])
+        columns = AssessColumns(self.model, self.keys)
+        columns.set_arrays(record_ids, codes, values, firsts, lasts)
+        return columns
+
+    def get_processes(self, length: int) -> int:
+        """Return count of processes for parsing length lines or rows."""
+        # Starting processes and passing the data to them does not pay for
+        # small tables, which are parsed in this process
+        if length < self.parallel_lines:
+            return 1
+        return self.processes or os.cpu_count() or 1
+
+    def get_executor(self, processes: int) -> object:
+        """Return pool of processes worker processes for parse_parallel()."""
+        # Each worker gets a copy of the Keys label maps of the model's
+        # items, so that the workers need no database queries
+        items = {}
+        for field in self.keys.indices_labels_ids.keys():
+            item_model = self.model._meta.get_field(field).remote_field.model
+            # The item objects are not needed for parsing
+            items[item_model._meta.label] = (self.keys.indices_ids_labels[field],
+                                             self.keys.indices_labels_ids[field],
+                                             {}, self.keys.indices_labels[field])
+        return ProcessPoolExecutor(processes, initializer=init_parse_worker,
+                                   initargs=(items,))
+
+    def parse_parallel(self, function: object, data: object, processes: int,
+                       args: tuple, executor=None) -> (object, object):
+        """Parse data in chunks in worker processes, return AssessColumns
+        of the records and array of the line numbers with errors.
+
+            function (object): parse_csv_chunk or parse_frame_chunk
+            data (object): list of CSV lines or dataframe
+            processes (int): count of worker processes
+            args (tuple): further arguments of function
+            executor (object): worker processes, default a new get_executor()
+        """
+        headers = (self.table_index_headers, self.table_value_headers,
+                   self.table_headers)
+        size = -(-len(data) // processes)
+        starts = list(range(0, len(data), size))
+        chunks = [data[start:start+size] for start in starts]
+        arguments = [repeat(self.model._meta.label), repeat(self.delimiters),
+                     repeat(headers)] + [repeat(arg) for arg in args]
+        if executor is None:
+            with self.get_executor(processes) as executor:
+                results = list(executor.map(function, chunks, *arguments))
+        else:
+            results = list(executor.map(function, chunks, *arguments))
+        # The chunks are merged in order, so that the last cell of a key
+        # wins as when parsing in one go. AssessErrors cannot be pickled,
+        # so the workers return the numbers of the lines with errors only
+        columns = self.merge_arrays([arrays for (arrays, error_lines) in results])
+        bad = []
+        for (start, (arrays, error_lines)) in zip(starts, results):
+            bad.append(start + numpy.array(error_lines, dtype=numpy.int64))
+        return columns, numpy.unique(numpy.concatenate(bad))
+
+    def parse_frame(self, frame: object, column_field: str) -> (object, list):
+        """Parse dataframe of table columns, return AssessColumns and errors.
+
+            frame (object): dataframe with table_index_headers and
+                            table_value_headers columns
+            column_field (str): index field of the value columns, or value_field
+        """
+        # Each value header column is parsed as a whole: labels are looked
+        # up as categoricals of the current item labels and values parsed
+        # by the model's NumberCodec. Cells with errors are found from boolean masks, and
+        # only for these an error is made, the same as set_from_cell would
+        # raise. The cells are numbered row by row (as parse_csv reads
+        # them), so that the last cell of a key wins
+        columns = AssessColumns(self.model, self.keys)
+        value_headers = list(dict.fromkeys(self.table_value_headers))
+        rows = len(frame)
+        shape = (rows, len(value_headers))
+        codes = {}
+        bad_labels = {}
+        for field in self.model.index_fields:
+            if field == column_field:
+                # The column field items are the value headers
+                (ids, bad) = self.get_item_ids(field, value_headers)
+                codes[field] = numpy.tile(ids, rows)
+            else:
+                (ids, bad_labels[field]) = self.get_item_ids(field, frame[field])
+                codes[field] = numpy.repeat(ids, len(value_headers))
+        values = numpy.zeros(shape, dtype=columns.empty_values().dtype)
+        bad_values = numpy.zeros(shape, dtype=bool)
+        for (n, header) in enumerate(value_headers):
+            (values[:,n], bad_values[:,n]) = self.get_values(frame[header])
+        bad_cells = bad_values.copy()
+        for bad in bad_labels.values():
+            bad_cells |= bad[:,None]
+        # The value is checked before the index items, as in set_from_cell
+        errors = []
+        for (row, n) in zip(*numpy.nonzero(bad_cells)):
+            if bad_values[row, n]:
+                errors.append((row, self.get_value_error(frame[value_headers[n]].iloc[row])))
+            else:
+                for (field, bad) in bad_labels.items():
+                    if bad[row]:
+                        model = self.model._meta.get_field(field).remote_field.model
+                        errors.append((row, NoItemError(str(frame[field].iloc[row]), model)))
+                        break
+        keep = ~bad_cells.ravel()
+        for field in self.model.index_fields:
+            codes[field] = codes[field][keep]
+        record_ids = numpy.zeros(int(keep.sum()), dtype=numpy.int64)
+        columns.set_arrays(record_ids, codes, values.ravel()[keep], record_ids, record_ids)
+        return columns, errors
+
+    def get_item_ids(self, field: str, labels: object) -> (object, object):
+        """Return array of item ids of labels and mask of unknown labels."""
+        labels_ids = self.keys.indices_labels_ids[field]
+        positions = pandas.Categorical(labels, categories=list(labels_ids)).codes
+        # Unknown labels have position -1, which gets the last (dummy) id
+        ids = numpy.array(list(labels_ids.values()) + [0], dtype=numpy.int64)
+        return ids[positions], positions < 0
+
+    def get_values(self, cells: object) -> (object, object):
+        """Return array of values of a column of cells and mask of bad cells."""
+        if self.model.model_type == 'mappings_model':
+            return self.get_item_ids(self.model.value_field, cells)
+        else:
+            return NumberCodec.get_codec(self.model).parse(cells)
+
+    def get_value_error(self, cell: object) -> object:
+        """Return the error of a bad value cell, as raised by set_value."""
+        if self.model.model_type == 'mappings_model':
+            return NoItemError(str(cell), self.model)
+        else:
+            return NumberCodec.get_codec(self.model).get_error(cell)
+
+    def set_csv_headers(self, csv_header: str, column_field: str) -> list:
+        """Split and check CSV header line, return list of headers or None."""
         # keys.set_headers() will not fail but default to model.column_field
         # if an invalid column_field is supplied by POST
         self.keys.set_headers(column_field)
-        lines = csv_string.splitlines()
-        csv_header = lines.pop(0)
         # Split table fields into index fields and value fields
         csv_headers = csv_header.split(self.delimiters['sep'])
-        csv_column_count = len(csv_headers)
-        table_headers = self.keys.index_headers + self.keys.value_headers
+        self.table_headers = self.keys.index_headers + self.keys.value_headers
         # check_table_headers may raise NoFieldError - transform to a CSV error
-        try: 
+        try:
             (ti, tv) = self.keys.split_table_headers(csv_headers)
         except AssessError as e1:
             msg = str(e1)
-            e2 = CSVheaderMalformed(csv_headers, table_headers, msg, self.model)
+            e2 = CSVheaderMalformed(csv_headers, self.table_headers, msg, self.model)
             self.errors.append(e2)
-            return {}
+            return None
         self.table_index_headers = ti
         self.table_value_headers = tv
-        for line in lines:
-            cells = line.split(self.delimiters['sep'])
-            if len(cells) != csv_column_count:
-                e = CSVwrongColumnCount(cells,csv_headers,'',self.model)
-                self.errors.append(e)
-            else:
-                row_dict = dict(zip(csv_headers,cells))
-                key_dict = {}
-                for field in self.table_index_headers:
-                    # Try/except not necessary, since field is always a key of
-                    # row_dict, as this is zipped from csv_headers
-                    key_dict[field] = row_dict[field]
-                for header in self.table_value_headers:
-                    record = self.model()
-                    record.fk_labels_objects = self.keys.indices_labels_objects
-                    # Try/except not necessary, since header is always a key of
-                    # row_dict, as this is zipped from csv_headers
-                    cell = row_dict[header]
-                    try:
-                        # set_from_cell() may raise NoFieldError
-                        record.set_from_cell(key_dict, header, cell, column_field)
-                    except AssessError as e1:
-                        msg = str(e1)
-                        CSVrow = list(row_dict.values())
-                        e2 = CSVfieldNotFound(CSVrow, table_headers, msg, self.model)
-                        self.errors.append(e2)
-                    else:
-                        key = record.get_key()
-                        self.records[key] = record
-        if self.errors == []:
-            return self.records
+        return csv_headers
+
+    def parse_csv_line(self, line: str, csv_headers: list, column_field: str,
+                       records: dict) -> None:
+        """Parse one CSV line into records, append any errors to self.errors."""
+        cells = line.split(self.delimiters['sep'])
+        if len(cells) != len(csv_headers):
+            e = CSVwrongColumnCount(cells,csv_headers,'',self.model)
+            self.errors.append(e)
         else:
-            return {}
+            row_dict = dict(zip(csv_headers,cells))
+            key_dict = {}
+            for field in self.table_index_headers:
+                # Try/except not necessary, since field is always a key of
+                # row_dict, as this is zipped from csv_headers
+                key_dict[field] = row_dict[field]
+            for header in self.table_value_headers:
+                record = self.model()
+                record.fk_labels_objects = self.keys.indices_labels_objects
+                # Try/except not necessary, since header is always a key of
+                # row_dict, as this is zipped from csv_headers
+                cell = row_dict[header]
+                try:
+                    # set_from_cell() may raise NoFieldError
+                    record.set_from_cell(key_dict, header, cell, column_field)
+                except AssessError as e1:
+                    msg = str(e1)
+                    CSVrow = list(row_dict.values())
+                    e2 = CSVfieldNotFound(CSVrow, self.table_headers, msg, self.model)
+                    self.errors.append(e2)
+                else:
+                    key = record.get_key()
+                    records[key] = record
+
+
+def init_parse_worker(items: dict) -> None:
+    """Set up a parse worker process with a copy of the Keys label maps.
+
+        items (dict): {item model label: label maps as of Keys.get_items()}
+    """
+    # Processes that are spawned rather than forked must set up Django
+    if not apps.ready:
+        django.setup()
+    # The workers parse with the items of the parent's Keys, whatever the
+    # item versions in the database are by now
+    Keys.check_heads = False
+    for (label, maps) in items.items():
+        Keys.items_cache[apps.get_model(label)] = (None, maps)
+
+
+def get_worker_tableIO(model_label: str, delimiters: dict, headers: tuple,
+                       column_field: str) -> object:
+    """Return AssessTableIO of a worker process, set up with headers."""
+    tableIO = AssessTableIO(apps.get_model(model_label), delimiters)
+    tableIO.keys.set_headers(column_field)
+    (tableIO.table_index_headers, tableIO.table_value_headers,
+     tableIO.table_headers) = headers
+    return tableIO
+
+
+def parse_csv_chunk(lines: list, model_label: str, delimiters: dict,
+                    headers: tuple, csv_headers: list, column_field: str) -> tuple:
+    """Parse CSV lines in a worker, see AssessTableIO.parse_parallel()."""
+    tableIO = get_worker_tableIO(model_label, delimiters, headers, column_field)
+    columns = tableIO.parse_csv_lines(lines, csv_headers, column_field, 1)
+    return columns.get_arrays(), tableIO.error_lines
+
+
+def parse_frame_chunk(frame: object, model_label: str, delimiters: dict,
+                      headers: tuple, column_field: str) -> tuple:
+    """Parse dataframe rows in a worker, see AssessTableIO.parse_parallel()."""
+    tableIO = get_worker_tableIO(model_label, delimiters, headers, column_field)
+    (columns, cell_errors) = tableIO.parse_frame(frame, column_field)
+    return columns.get_arrays(), [row for (row, e) in cell_errors]
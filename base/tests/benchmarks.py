@@ -0,0 +1,434 @@
+"""Benchmarks of AssessTable operations on growing synthetic tables.
+
+The benchmarks are not part of the test suite, as the module name does not
+match the test*.py pattern. Run them explicitly with:
+
+    python manage.py test base.tests.benchmarks
+
+Each benchmark prints query count and wall time for each table size.
+"""
+import itertools
+import time
+import tracemalloc
+from unittest import skipUnless
+
+from django.db import connection
+from django.test import TestCase
+
+from base.keys import Keys
+from base.version import Snapshot
+from base.models import Version, TestData
+from base.table import AssessTable
+from base.tableIO import AssessTableIO
+from base.columns import AssessColumns
+from base.appIO import XlsIO, ParquetIO
+from data.models import SourceSorting
+
+
+def create_items(model, prefix: str, count: int, version: object) -> list:
+    """Bulk create count current items in model, return list of item ids."""
+    labels = [prefix + str(i) for i in range(count)]
+    items = [model(label=label, version_first=version) for label in labels]
+    model.objects.bulk_create(items)
+    # Bulk creation sends no signals to clear the cached items
+    Keys.clear_items_cache(model)
+    return list(model.objects.filter(label__in=labels).values_list('id', flat=True))
+
+
+def create_table(model: object, counts: list, version=None) -> list:
+    """Bulk create a full table with a record for every key.
+
+        model (object): data_model with ItemModel index fields
+        counts (list): count of items for each of model.index_fields
+        version (object): version_first of the records, None for proposed
+    """
+    v = Version.objects.create(label='benchmark items')
+    id_lists = []
+    for (field, count) in zip(model.index_fields, counts):
+        item_model = model._meta.get_field(field).remote_field.model
+        id_lists.append(create_items(item_model, field[0:4], count, v))
+    records = []
+    for ids in itertools.product(*id_lists):
+        record = model(value=1, version_first=version)
+        for (field, item_id) in zip(model.index_fields, ids):
+            setattr(record, field + '_id', item_id)
+        records.append(record)
+    model.objects.bulk_create(records, batch_size=10000)
+    return records
+
+
+def create_test_data(cells: int, version=None) -> list:
+    """Bulk create a TestData table with about cells records.
+
+        cells (int): number of records wanted, rounded to multiples of 100
+        version (object): version_first of the records, None for proposed
+    """
+    return create_table(TestData, [max(cells // 100, 1), 10, 10], version)
+
+
+def delete_table(model: object) -> None:
+    """Delete all records of model and the items of its index fields."""
+    model.objects.all().delete()
+    for field in model.index_fields:
+        model._meta.get_field(field).remote_field.model.objects.all().delete()
+
+
+def create_history(size: int, depth: int) -> list:
+    """Bulk create depth versions of a TestData table, return the versions.
+
+        size (int): number of cells, as in create_test_data
+        depth (int): number of versions, each replacing every record
+    """
+    versions = [Version.objects.create(label='benchmark', model_name='testdata')
+                for n in range(depth)]
+    records = create_test_data(size, versions[0])
+    # Each later version archives every record and adds a new, as if the
+    # whole table were committed with new values
+    for first in versions[1:]:
+        TestData.objects.filter(version_last__isnull=True).update(version_last=first)
+        records = [TestData(value=first.id % 100, version_first=first,
+                            testitema_id=r.testitema_id,
+                            testitemb_id=r.testitemb_id,
+                            testitemc_id=r.testitemc_id) for r in records]
+        TestData.objects.bulk_create(records, batch_size=10000)
+    return versions
+
+
+def propose_changes(records: list) -> None:
+    """Bulk create a proposed record for each record in records."""
+    proposed = []
+    for r in records:
+        record = r.__class__(value=2)
+        for field in r.index_fields:
+            setattr(record, field + '_id', getattr(r, field + '_id'))
+        proposed.append(record)
+    records[0].__class__.objects.bulk_create(proposed, batch_size=10000)
+
+
+def measure(function) -> (int, float):
+    """Run function, return count of queries and wall time in seconds."""
+    queries = []
+    # Count queries with an execute wrapper, as the query log is capped
+    def count(execute, sql, params, many, context):
+        queries.append(1)
+        return execute(sql, params, many, context)
+    with connection.execute_wrapper(count):
+        start = time.perf_counter()
+        function()
+        wall_time = time.perf_counter() - start
+    return len(queries), wall_time
+
+
+def report(name: str, size: int, queries: int, wall_time: float) -> None:
+    """Print one line of benchmark results."""
+    print('{:<28} {:>9} cells {:>9} queries {:>9.3f} s'.format(name, size, queries, wall_time))
+
+
+class CommitBenchmark(TestCase):
+    """Compare per-record commit with the set-based bulk commit."""
+
+    sizes = [1000, 4000, 16000]
+
+    def commit_per_record(self, version: object) -> None:
+        """The former commit path: AssessModel.commit for each record."""
+        filter_dict = version.kwargs_filter('proposed', True)
+        for record in TestData.objects.filter(**filter_dict):
+            record.commit(version)
+
+    def test_commit(self):
+        print()
+        for size in self.sizes:
+            for name in ['per record commit', 'bulk commit']:
+                v = Version.objects.create(label='benchmark', model_name='testdata')
+                records = create_test_data(size, v)
+                propose_changes(records)
+                t = AssessTable(TestData, 'proposed')
+                version = Version.objects.create(label=name, model_name='testdata')
+                version.set_version_id('proposed')
+                if name == 'bulk commit':
+                    (queries, wall_time) = measure(lambda: t.commit_bulk(version))
+                else:
+                    (queries, wall_time) = measure(lambda: self.commit_per_record(version))
+                report(name, size, queries, wall_time)
+                self.assertEqual(t.count_db_records('current'), size)
+                # Clean up for the next table size
+                delete_table(TestData)
+
+
+class PivotBenchmark(TestCase):
+    """Compare the record dict pivot with the vectorized column pivot."""
+
+    # Item counts of each index field, 3- and 4-dimensional tables
+    tables = [(TestData, [10, 10, 10]),
+              (TestData, [100, 10, 10]),
+              (TestData, [1000, 10, 10]),
+              (SourceSorting, [10, 10, 10, 10]),
+              (SourceSorting, [100, 10, 10, 10])]
+
+    def set_rows_by_records(self, t: object, records: dict) -> list:
+        """The former pivot: a dict lookup for each cell of the key list."""
+        rows = []
+        for key in t.keys.get_key_list():
+            row = dict(zip(t.keys.index_headers,key))
+            for value_header in t.keys.value_headers:
+                record_key = ()
+                for index_field in t.model.index_fields:
+                    if index_field == t.keys.column_field:
+                        record_key += (value_header,)
+                    elif index_field in t.keys.index_headers:
+                        record_key += (row[index_field],)
+                record_key += (t.model.value_field,)
+                try:
+                    record = records[record_key]
+                except KeyError:
+                    row[value_header] = 'n.d.'
+                else:
+                    row[value_header] = str(record.get_value())
+                    row[value_header + '_id'] = record.id
+                    row[value_header + '_key'] = str(record.get_key())
+            rows.append(row)
+        return rows
+
+    def test_pivot(self):
+        print()
+        for (model, counts) in self.tables:
+            v = Version.objects.create(label='benchmark')
+            create_table(model, counts, v)
+            t = AssessTable(model, 'current')
+            t.load(False)
+            t.keys.set_headers(model.column_field)
+            # The record dict of the former load, fks selected in one query
+            records = {}
+            query = model.objects.select_related(*model.index_fields)
+            for record in query:
+                records[record.get_key()] = record
+            name = model.__name__ + ' ' + str(len(counts)) + 'D'
+            (queries, wall_time) = measure(lambda: self.set_rows_by_records(t, records))
+            report(name + ' record dict', len(t.records), queries, wall_time)
+            (queries, wall_time) = measure(lambda: t.set_rows(model.column_field))
+            report(name + ' columns', len(t.records), queries, wall_time)
+            self.assertEqual(t.rows, self.set_rows_by_records(t, records))
+            delete_table(model)
+
+
+class HistoryBenchmark(TestCase):
+    """Compare loading the full history with the point-in-time query."""
+
+    # Table size in cells and the number of versions of every cell
+    tables = [(1000, 10), (1000, 40), (10000, 40)]
+
+    def test_archived_load(self):
+        print()
+        for (size, depth) in self.tables:
+            versions = create_history(size, depth)
+            # Load a version in the middle of the history
+            t = AssessTable(TestData, str(versions[depth // 2].id))
+            name = 'depth ' + str(depth)
+            # The former load: every record up to the version
+            query = TestData.objects.filter(**t.version.kwargs_filter_load(False))
+            columns = AssessColumns(TestData, t.keys)
+            (queries, wall_time) = measure(lambda: columns.load(query))
+            report(name + ' full history', query.count(), queries, wall_time)
+            (queries, wall_time) = measure(lambda: t.load(False))
+            report(name + ' point-in-time', t.get_load_query(False).count(), queries, wall_time)
+            self.assertEqual(t.records.record_ids.tolist(), columns.record_ids.tolist())
+            # A snapshot two versions before the loaded version
+            snapshot_version = versions[depth // 2 - 2]
+            snapshot_table = AssessTable(TestData, str(snapshot_version.id))
+            snapshot_table.load(False)
+            Snapshot.objects.create(model_name='testdata', version_id=snapshot_version.id,
+                                    data=snapshot_table.records.dump())
+            t.snapshot_interval = 1
+            (queries, wall_time) = measure(lambda: t.load(False))
+            report(name + ' snapshot', len(t.records), queries, wall_time)
+            self.assertEqual(t.records.record_ids.tolist(), columns.record_ids.tolist())
+            Snapshot.objects.all().delete()
+            delete_table(TestData)
+
+
+class IndexBenchmark(TestCase):
+    """Compare query plans and times with and without the AssessModel indexes."""
+
+    # Table size in cells and the number of versions of every cell; use
+    # e.g. (100000, 40) for a table with several million historical rows
+    tables = [(10000, 40)]
+
+    def set_indexes(self, add: bool) -> None:
+        """Add or drop the indexes that AssessModel adds to TestData."""
+        quote = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            for index in TestData._meta.indexes:
+                if add:
+                    columns = [TestData._meta.get_field(f).column for f in index.fields]
+                    cursor.execute('CREATE INDEX ' + quote(index.name) + ' ON '
+                                   + quote(TestData._meta.db_table) + ' ('
+                                   + ', '.join(quote(c) for c in columns) + ')')
+                else:
+                    cursor.execute('DROP INDEX ' + quote(index.name))
+
+    def get_queries(self, t: object, version: object) -> list:
+        """Return list of (name, function, query) of benchmarked queries."""
+        current = t.get_load_query(False)
+        archived = AssessTable(TestData, str(version.id)).get_load_query(False)
+        proposed = TestData.objects.filter(**t.version.kwargs_filter('proposed', True))
+        return [('load current', lambda: list(current.values_list('id')), current),
+                ('load archived', lambda: list(archived.values_list('id')), archived),
+                ('count proposed', lambda: proposed.count(), proposed)]
+
+    def test_query_plans(self):
+        print()
+        for (size, depth) in self.tables:
+            versions = create_history(size, depth)
+            t = AssessTable(TestData, '')
+            for state in ['no indexes', 'indexes']:
+                self.set_indexes(state == 'indexes')
+                # Propose a change of one percent of the records
+                current = TestData.objects.filter(version_last__isnull=True)
+                propose_changes(list(current[0:size // 100]))
+                for (name, function, query) in self.get_queries(t, versions[depth // 2]):
+                    (queries, wall_time) = measure(function)
+                    report(name + ', ' + state, TestData.objects.count(), queries, wall_time)
+                    print('    ' + query.explain().replace('\n', '\n    '))
+                version = Version.objects.create(label='benchmark', model_name='testdata')
+                version.set_version_id('proposed')
+                (queries, wall_time) = measure(lambda: t.commit_bulk(version))
+                report('commit, ' + state, TestData.objects.count(), queries, wall_time)
+            delete_table(TestData)
+
+
+class HistoryPanelBenchmark(TestCase):
+    """Time the history panel of a table with many versions and a proposal."""
+
+    sizes = [100, 1000, 5000]
+
+    def test_history_context(self):
+        print()
+        v = Version.objects.create(label='benchmark', model_name='testdata')
+        records = create_test_data(1000, v)
+        propose_changes(records[0:10])
+        count = 1
+        for size in self.sizes:
+            Version.objects.bulk_create([Version(label='benchmark', model_name='testdata')
+                                         for n in range(size - count)])
+            count = size
+            t = AssessTable(TestData, '')
+            (queries, wall_time) = measure(t.get_history_context)
+            report('history, first', size, queries, wall_time)
+            (queries, wall_time) = measure(t.get_history_context)
+            report('history, cached proposal', size, queries, wall_time)
+        delete_table(TestData)
+
+
+def create_csv_string(model: object, column_field: str) -> str:
+    """Return the current records of model as a tab separated CSV string."""
+    t = AssessTable(model, 'current')
+    t.load(False)
+    t.keys.set_headers(column_field)
+    rows = t.records.pivot(t.keys.index_headers, t.keys.value_headers, column_field)
+    headers = t.keys.index_headers + t.keys.value_headers
+    lines = ['\t'.join(headers)]
+    for row in rows:
+        lines.append('\t'.join(row[header] for header in headers))
+    return '\n'.join(lines)
+
+
+class IngestBenchmark(TestCase):
+    """Compare the per-cell CSV parser with the vectorized parser."""
+
+    sizes = [10000, 100000, 1000000]
+    processes = 4
+
+    def test_parse_csv(self):
+        print()
+        delimiters = {'decimal': ',', 'thousands': '.', 'sep': '\t' }
+        for size in self.sizes:
+            v = Version.objects.create(label='benchmark', model_name='testdata')
+            create_test_data(size, v)
+            POST = {'csv_string': create_csv_string(TestData, 'testitemc'),
+                    'column_field': 'testitemc'}
+            tIO = AssessTableIO(TestData, delimiters)
+            (queries, wall_time) = measure(lambda: tIO.parse_csv(POST))
+            report('parse per cell', size, queries, wall_time)
+            tIO_columns = AssessTableIO(TestData, delimiters)
+            (queries, wall_time) = measure(lambda: tIO_columns.parse_csv_columns(POST))
+            report('parse columns', size, queries, wall_time)
+            self.assertEqual(len(tIO_columns.records), len(tIO.records))
+            self.assertEqual(tIO_columns.errors, [])
+            # Parallel parsing of all sizes, even those parsed in one
+            # process by default
+            tIO_parallel = AssessTableIO(TestData, delimiters)
+            tIO_parallel.processes = self.processes
+            tIO_parallel.parallel_lines = 0
+            (queries, wall_time) = measure(lambda: tIO_parallel.parse_csv_columns(POST))
+            report('parse ' + str(self.processes) + ' processes', size, queries, wall_time)
+            self.assertEqual(len(tIO_parallel.records), len(tIO.records))
+            delete_table(TestData)
+
+
+class SaveBenchmark(TestCase):
+    """Time saving an unchanged and a one percent changed CSV upload."""
+
+    sizes = [10000, 100000, 1000000]
+
+    def test_save_CSV(self):
+        print()
+        for size in self.sizes:
+            v = Version.objects.create(label='benchmark', model_name='testdata')
+            create_test_data(size, v)
+            csv_string = create_csv_string(TestData, 'testitemc')
+            count = TestData.objects.count()
+            for (name, changes) in [('unchanged', 0), ('changed', size // 100)]:
+                # All values are 1, change the first values to 2
+                POST = {'csv_string': csv_string.replace('\t1,000', '\t2,000', changes),
+                        'column_field': 'testitemc'}
+                t = AssessTable(TestData, 'proposed')
+                (queries, wall_time) = measure(lambda: t.save_CSV(POST))
+                report('save ' + name, size, queries, wall_time)
+                self.assertEqual(TestData.objects.count(), count + changes)
+                TestData.objects.filter(version_first__isnull=True).delete()
+            delete_table(TestData)
+
+
+class ExportBenchmark(TestCase):
+    """Time and peak traced memory of writing the base app to Excel."""
+
+    sizes = [10000, 100000]
+
+    def test_get_response(self):
+        print()
+        for size in self.sizes:
+            v = Version.objects.create(label='benchmark', model_name='testdata')
+            create_test_data(size, v)
+            xlsio = XlsIO('base', {}, 'current')
+            tracemalloc.start()
+            (queries, wall_time) = measure(lambda: xlsio.write_excel(xlsio.get_version_ids()).close())
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            report('export', size, queries, wall_time)
+            print('{:<28} {:>9} cells {:>9.1f} MB peak'.format('export', size, peak / 2**20))
+            delete_table(TestData)
+
+
+@skipUnless(ParquetIO.available, 'Parquet files need pyarrow')
+class ParquetBenchmark(TestCase):
+    """Time writing and reading back a table as a Parquet file."""
+
+    sizes = [100000, 1000000, 10000000]
+
+    def test_round_trip(self):
+        print()
+        for size in self.sizes:
+            v = Version.objects.create(label='benchmark', model_name='testdata')
+            create_test_data(size, v)
+            parquet_file = None
+            def write():
+                nonlocal parquet_file
+                parquet_file = ParquetIO('base', 'current', TestData).write_file()
+            (queries, wall_time) = measure(write)
+            report('parquet write', size, queries, wall_time)
+            # The unchanged table is parsed and compared, nothing is saved
+            (queries, wall_time) = measure(lambda: ParquetIO('base', '', TestData).parse_save(parquet_file))
+            report('parquet read unchanged', size, queries, wall_time)
+            self.assertEqual(TestData.objects.filter(version_first__isnull=True).count(), 0)
+            parquet_file.close()
+            delete_table(TestData)
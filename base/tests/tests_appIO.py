@@ -0,0 +1,284 @@
+import os
+import tempfile
+import zipfile
+from decimal import Decimal
+from io import BytesIO
+from unittest import skipUnless
+from unittest.mock import patch
+
+import openpyxl
+import xlsxwriter
+from django.test import TestCase, override_settings
+
+from base.models import Version, TestItemA, TestItemB, TestItemC, TestData, TestMappings
+from base.appIO import XlsIO, ParquetIO
+from base.set import AssessSet
+
+
+class XlsIOTestCase(TestCase):
+    """Testing XlsIO()."""
+
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.cache_dir = cache_dir.name
+        cache_settings = override_settings(XLS_CACHE_DIR=cache_dir.name)
+        cache_settings.enable()
+        self.addCleanup(cache_settings.disable)
+        v = Version.objects.create()
+        for label in ['a1','a2']:
+            TestItemA.objects.create(label=label,version_first=v)
+        for label in ['b1','b2']:
+            TestItemB.objects.create(label=label,version_first=v)
+        for label in ['c1','c2']:
+            TestItemC.objects.create(label=label,version_first=v)
+
+    def get_excel_file(self, sheets: dict) -> object:
+        """Return in-memory Excel file of {sheet name: rows}."""
+        workbook = openpyxl.Workbook()
+        workbook.remove(workbook.active)
+        for (name, rows) in sheets.items():
+            worksheet = workbook.create_sheet(name)
+            for row in rows:
+                worksheet.append(row)
+        excel_file = BytesIO()
+        workbook.save(excel_file)
+        excel_file.seek(0)
+        return excel_file
+
+    def test_parse_save(self):
+        """Test reading all sheets of a workbook in one pass."""
+        # Current records are not counted as proposed
+        v = Version.objects.get()
+        TestMappings.objects.create(testitema=TestItemA.objects.get(label='a2'),
+                                    testitemb=TestItemB.objects.get(label='b2'),
+                                    testitemc=TestItemC.objects.get(label='c1'),
+                                    version_first=v)
+        excel_file = self.get_excel_file({
+            'TestData': [['testitema','testitemb','testitemc','value'],
+                         ['a1','b1','c1',1],
+                         ['a1','b1','c2',2],
+                         [None,None,None,None],
+                         ['a2','b2','c1',3.5],
+                         ['a2','b2','c2',4]],
+            'TestMappings': [['testitema','testitemb','testitemc'],
+                             ['a1','b1','c2']] })
+        report = XlsIO('base', {}, 'current').parse_save(excel_file)
+        report_dict = dict((r['name'], r) for r in report)
+        self.assertEqual(report_dict['TestData']['proposed'],4)
+        self.assertEqual(report_dict['TestData']['read_errors'],'')
+        self.assertEqual(report_dict['TestMappings']['proposed'],1)
+        self.assertEqual(report_dict['TestItemA']['proposed'],0)
+        values = TestData.objects.order_by('id').values_list('value', flat=True)
+        self.assertEqual([float(v) for v in values],[1,2,3.5,4])
+        self.assertEqual(TestMappings.objects.get(version_first__isnull=True).testitemc.label,'c2')
+
+    def test_parse_save_missing_sheet(self):
+        """Test missing worksheets are reported, not read."""
+        excel_file = self.get_excel_file({'TestMappings': [['testitema','testitemb','testitemc']]})
+        report = XlsIO('base', {}, 'current').parse_save(excel_file)
+        report_dict = dict((r['name'], r) for r in report)
+        self.assertEqual(report_dict['TestData']['read_errors'],"Worksheet named 'TestData' not found")
+        self.assertEqual(report_dict['TestMappings']['read_errors'],'')
+        self.assertEqual(TestData.objects.count(),0)
+
+    def test_parse_save_batches(self):
+        """Test worksheets read and parsed batch_size rows at a time."""
+        rows = [['testitema','testitemb','testitemc','value'],
+                ['a1','b1','c1',1],
+                ['a1','b1','c2',2],
+                [None,None,None,None],
+                ['a1','b1','c1',5]]
+        xlsio = XlsIO('base', {}, 'current')
+        xlsio.batch_size = 2
+        workbook = openpyxl.load_workbook(self.get_excel_file({'TestData': rows}), read_only=True)
+        self.assertEqual([len(df) for df in xlsio.read_sheet(workbook['TestData'])],[2,1])
+        workbook.close()
+        # The last cell of a key wins, as when parsed in one dataframe
+        report = xlsio.parse_save(self.get_excel_file({'TestData': rows}))
+        report_dict = dict((r['name'], r) for r in report)
+        self.assertEqual(report_dict['TestData']['proposed'],2)
+        record = TestData.objects.get(testitemc__label='c1')
+        self.assertEqual(record.value,Decimal('5'))
+        # Errors in any batch stop the sheet from being saved
+        TestData.objects.all().delete()
+        report = xlsio.parse_save(self.get_excel_file({'TestData': rows + [['BAD','b1','c1',6]]}))
+        report_dict = dict((r['name'], r) for r in report)
+        self.assertIn('BAD',report_dict['TestData']['parse_errors'])
+        self.assertEqual(TestData.objects.count(),0)
+
+    def test_get_response(self):
+        """Test writing current tables, with headers, to an Excel file."""
+        v = Version.objects.get()
+        a1 = TestItemA.objects.get(label='a1')
+        b2 = TestItemB.objects.get(label='b2')
+        c1 = TestItemC.objects.get(label='c1')
+        TestData.objects.create(testitema=a1,testitemb=b2,testitemc=c1,value='1.5',version_first=v)
+        TestMappings.objects.create(testitema=a1,testitemb=b2,testitemc=c1,version_first=v)
+        # Proposed records are not written
+        TestData.objects.create(testitema=a1,testitemb=b2,testitemc=c1,value=2)
+        xlsio = XlsIO('base', {}, 'current')
+        xlsio.batch_size = 1
+        response = xlsio.get_response()
+        self.assertEqual(response['Content-Disposition'],'attachment; filename="base.xlsx"')
+        excel_file = BytesIO(b''.join(response.streaming_content))
+        response.close()
+        workbook = openpyxl.load_workbook(excel_file)
+        rows = list(workbook['TestData'].iter_rows(values_only=True))
+        self.assertEqual(rows,[('testitema','testitemb','testitemc','value'),('a1','b2','c1',1.5)])
+        self.assertEqual(workbook['TestData']['D2'].number_format,'#,##0.000')
+        rows = list(workbook['TestMappings'].iter_rows(values_only=True))
+        self.assertEqual(rows,[('testitema','testitemb','testitemc'),('a1','b2','c1')])
+        rows = list(workbook['TestItemB'].iter_rows(values_only=True))
+        self.assertEqual(rows,[('label',),('b1',),('b2',)])
+        rows = list(workbook['metadata'].iter_rows(values_only=True))
+        self.assertEqual(rows[0],('name','error'))
+        self.assertEqual(len(rows),6)
+
+    def test_get_response_full_sheet(self):
+        """Test rows xlsxwriter cannot write fail the file, not truncate it."""
+        a1 = TestItemA.objects.get(label='a1')
+        b1 = TestItemB.objects.get(label='b1')
+        c1 = TestItemC.objects.get(label='c1')
+        v = Version.objects.create(model_name='testdata')
+        TestData.objects.create(testitema=a1,testitemb=b1,testitemc=c1,value=1,version_first=v)
+        # Writing beyond the last row of a sheet returns -1
+        with patch.object(xlsxwriter.worksheet.Worksheet, 'write_row', return_value=-1):
+            with self.assertRaises(ValueError):
+                XlsIO('base', {}, 'current').get_response()
+        self.assertEqual(os.listdir(self.cache_dir),[])
+
+    def test_get_metadata(self):
+        """Test metadata of tables from their versions, in fixed queries."""
+        v1 = Version.objects.create(model_name='testdata',cells=8,size=8,metric='0.5')
+        v2 = Version.objects.create(model_name='testmappings',cells=4)
+        v3 = Version.objects.create(model_name='testdata',label='v3',cells=9)
+        AssessSet(TestItemB).create('b3')
+        v4 = Version.objects.get(model_name='TestItemB')
+        xlsio = XlsIO('base', {}, 'current')
+        with self.assertNumQueries(3):
+            metadata = xlsio.get_metadata(xlsio.get_version_ids())
+        metadata_dict = dict((m['name'], m) for m in metadata)
+        self.assertEqual(metadata_dict['TestData']['version'],v3.id)
+        self.assertEqual(metadata_dict['TestData']['label'],'v3')
+        self.assertEqual(metadata_dict['TestData']['cells'],9)
+        self.assertNotIn('metric',metadata_dict['TestData'])
+        self.assertEqual(metadata_dict['TestMappings']['version'],v2.id)
+        self.assertEqual(metadata_dict['TestItemA'],{'name': 'TestItemA', 'error': ''})
+        # Item models have the metadata of their versions by AssessSet
+        self.assertEqual(metadata_dict['TestItemB']['version'],v4.id)
+        self.assertEqual(metadata_dict['TestItemB']['lastuser'],v4.user)
+        # Archived versions have the metadata of the table at the version
+        xlsio = XlsIO('base', {}, str(v2.id))
+        with self.assertNumQueries(2):
+            metadata = xlsio.get_metadata(xlsio.get_version_ids())
+        metadata_dict = dict((m['name'], m) for m in metadata)
+        self.assertEqual(metadata_dict['TestData']['version'],v1.id)
+        self.assertEqual(metadata_dict['TestData']['metric'],0.5)
+
+    def get_workbook(self, ver: str) -> object:
+        """Return workbook of Excel file downloaded for version string."""
+        response = XlsIO('base', {}, ver).get_response()
+        excel_file = BytesIO(b''.join(response.streaming_content))
+        response.close()
+        return openpyxl.load_workbook(excel_file)
+
+    def test_get_response_cache(self):
+        """Test caching Excel files by the version ids of the tables."""
+        a1 = TestItemA.objects.get(label='a1')
+        b1 = TestItemB.objects.get(label='b1')
+        c1 = TestItemC.objects.get(label='c1')
+        v1 = Version.objects.create(model_name='testdata')
+        TestData.objects.create(testitema=a1,testitemb=b1,testitemc=c1,value=1,version_first=v1)
+        self.get_workbook('current')
+        self.assertEqual(len(os.listdir(self.cache_dir)),1)
+        # Current and the current version id resolve to the same file
+        with patch.object(XlsIO, 'write_excel') as write_excel:
+            rows = list(self.get_workbook('current')['TestData'].values)
+            self.get_workbook(str(v1.id))
+            write_excel.assert_not_called()
+        self.assertEqual(rows[1],('a1','b1','c1',1))
+        # Proposed records are not in the file of the current version
+        TestData.objects.create(testitema=a1,testitemb=b1,testitemc=c1,value=2)
+        with patch.object(XlsIO, 'write_excel') as write_excel:
+            self.get_workbook('current')
+            write_excel.assert_not_called()
+        # Committing makes a new file, while the archived file is kept
+        v2 = Version.objects.create(model_name='testdata')
+        TestData.objects.filter(value=1).update(version_last=v2)
+        TestData.objects.filter(value=2).update(version_first=v2)
+        rows = list(self.get_workbook('current')['TestData'].values)
+        self.assertEqual(rows[1],('a1','b1','c1',2))
+        rows = list(self.get_workbook(str(v1.id))['TestData'].values)
+        self.assertEqual(rows[1],('a1','b1','c1',1))
+        self.assertEqual(len(os.listdir(self.cache_dir)),2)
+        # Proposed tables may change, so they are not cached
+        self.get_workbook('proposed')
+        self.assertEqual(len(os.listdir(self.cache_dir)),2)
+
+    def test_get_response_cache_items(self):
+        """Test item changes, versioned by AssessSet, miss the cache."""
+        v1 = Version.objects.create(model_name='testdata')
+        rows = list(self.get_workbook('current')['TestItemA'].values)
+        self.assertEqual(rows,[('label',),('a1',),('a2',)])
+        AssessSet(TestItemA).create('a3')
+        v2 = Version.objects.get(model_name='TestItemA')
+        rows = list(self.get_workbook('current')['TestItemA'].values)
+        self.assertEqual(rows,[('label',),('a1',),('a2',),('a3',)])
+        # Archived versions before and after the item change differ too
+        rows = list(self.get_workbook(str(v1.id))['TestItemA'].values)
+        self.assertEqual(rows,[('label',),('a1',),('a2',)])
+        rows = list(self.get_workbook(str(v2.id))['TestItemA'].values)
+        self.assertEqual(rows[-1],('a3',))
+        # Current is the same versions as the item change, so the same file
+        self.assertEqual(len(os.listdir(self.cache_dir)),2)
+
+
+
+@skipUnless(ParquetIO.available, 'Parquet files need pyarrow')
+class ParquetIOTestCase(TestCase):
+    """Testing ParquetIO()."""
+
+    def setUp(self):
+        v = Version.objects.create()
+        self.v = v
+        for label in ['a1','a2']:
+            TestItemA.objects.create(label=label,version_first=v)
+        for label in ['b1','b2']:
+            TestItemB.objects.create(label=label,version_first=v)
+        for label in ['c1','c2']:
+            TestItemC.objects.create(label=label,version_first=v)
+        a1 = TestItemA.objects.get(label='a1')
+        b2 = TestItemB.objects.get(label='b2')
+        c1 = TestItemC.objects.get(label='c1')
+        c2 = TestItemC.objects.get(label='c2')
+        TestData.objects.create(testitema=a1,testitemb=b2,testitemc=c1,value='1.5',version_first=v)
+        TestData.objects.create(testitema=a1,testitemb=b2,testitemc=c2,value=4,version_first=v)
+        TestMappings.objects.create(testitema=a1,testitemb=b2,testitemc=c2,version_first=v)
+
+    def test_get_table(self):
+        """Test tables with dictionary encoded labels and float values."""
+        table = ParquetIO('base', 'current').get_table(TestData)
+        self.assertEqual(table.column_names,['testitema','testitemb','testitemc','value'])
+        self.assertEqual(str(table.schema.field('testitemc').type),'dictionary<values=string, indices=int32, ordered=0>')
+        self.assertEqual(table.column('testitemc').to_pylist(),['c1','c2'])
+        self.assertEqual(table.column('value').to_pylist(),[1.5,4])
+        table = ParquetIO('base', 'current').get_table(TestMappings)
+        self.assertEqual(table.column('testitemc').to_pylist(),['c2'])
+
+    def test_round_trip(self):
+        """Test downloaded files upload as proposed changes only."""
+        parquet_file = ParquetIO('base', 'current', TestData).write_file()
+        report = ParquetIO('base', '', TestData).parse_save(parquet_file)
+        self.assertEqual(report[0]['parse_errors'],'')
+        self.assertEqual(report[0]['proposed'],0)
+        self.assertEqual(TestData.objects.filter(version_first__isnull=True).count(),0)
+        # An app is a zip of the tables' files
+        archive_file = ParquetIO('base', 'current').write_file()
+        names = zipfile.ZipFile(archive_file).namelist()
+        self.assertEqual(names,['TestData.parquet','TestMappings.parquet'])
+        TestData.objects.filter(value=4).update(value=5)
+        report = ParquetIO('base', '').parse_save(archive_file)
+        self.assertEqual([r['name'] for r in report],['TestData','TestMappings'])
+        self.assertEqual([r['proposed'] for r in report],[1,0])
+        self.assertEqual(TestData.objects.get(version_first__isnull=True).value,4)
@@ -0,0 +1,32 @@
+from decimal import Decimal
+
+import numpy
+from django.test import TestCase
+
+from base.models import TestData
+from base.codec import NumberCodec
+from base.errors import NotDecimalError, DecimalPrecisionError
+
+
+class NumberCodecTestCase(TestCase):
+    """Testing NumberCodec()."""
+
+    def test_format(self):
+        """Test formatting of values in the model's user format."""
+        codec = NumberCodec.get_codec(TestData)
+        self.assertIs(NumberCodec.get_codec(TestData),codec)
+        self.assertEqual(codec.format(numpy.array([1.5,10,-0.25])),['1,500','10,000','-0,250'])
+        self.assertEqual(codec.format([Decimal('2')]),['2,000'])
+        self.assertEqual(TestData.format_value(Decimal('12.5')),'12,500')
+        self.assertEqual(codec.excel_format,'#,##0.000')
+
+    def test_parse(self):
+        """Test parsing and validating columns of cells."""
+        codec = NumberCodec.get_codec(TestData)
+        (values, bad) = codec.parse(['1,5','12','1_0','XX','','100','0,0001',Decimal('3')])
+        self.assertEqual(bad.tolist(),[False,False,False,True,True,True,True,False])
+        self.assertEqual(values[~bad].tolist(),[1.5,12,10,3])
+        # Cells with digits beyond the value field precision are errors
+        self.assertEqual(str(codec.get_error('100')),str(DecimalPrecisionError('100',5,3,TestData)))
+        self.assertEqual(str(codec.get_error('0,0001')),str(DecimalPrecisionError('0.0001',5,3,TestData)))
+        self.assertEqual(str(codec.get_error('XX')),str(NotDecimalError('XX',TestData)))
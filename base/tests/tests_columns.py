@@ -0,0 +1,105 @@
+from decimal import Decimal
+
+from django.test import TestCase
+
+from base.models import Version, TestItemA, TestItemB, TestItemC, TestData, TestMappings
+from base.keys import Keys
+from base.columns import AssessColumns
+
+
+class ColumnsTestCase(TestCase):
+    """Testing AssessColumns()."""
+
+    def setUp(self):
+        v1 = Version.objects.create()
+        v2 = Version.objects.create()
+        self.v1 = v1
+        self.v2 = v2
+        self.a1 = TestItemA.objects.create(label='a1',version_first=v1)
+        self.a2 = TestItemA.objects.create(label='a2',version_first=v1)
+        self.b1 = TestItemB.objects.create(label='b1',version_first=v1)
+        self.b2 = TestItemB.objects.create(label='b2',version_first=v1)
+        self.c1 = TestItemC.objects.create(label='c1',version_first=v1)
+        self.c2 = TestItemC.objects.create(label='c2',version_first=v1)
+        # Archived item - records with this item cannot be keyed
+        self.c3 = TestItemC.objects.create(label='c3',version_first=v1,version_last=v2)
+
+        TestData.objects.create(testitema=self.a2,testitemb=self.b2,testitemc=self.c2,value=8,version_first=v1)
+        TestData.objects.create(testitema=self.a1,testitemb=self.b1,testitemc=self.c1,value=1,version_first=v1)
+        TestData.objects.create(testitema=self.a1,testitemb=self.b1,testitemc=self.c1,value='1.5',version_first=v2)
+        TestData.objects.create(testitema=self.a1,testitemb=self.b2,testitemc=self.c3,value=9,version_first=v1)
+        TestMappings.objects.create(testitema=self.a2,testitemb=self.b1,testitemc=self.c2,version_first=v1)
+
+    def test_load(self):
+        """Test loading, one record per key in index order."""
+        columns = AssessColumns(TestData, Keys(TestData))
+        columns.load(TestData.objects.all())
+        self.assertEqual(len(columns),2)
+        self.assertEqual(list(columns),[('a1','b1','c1','value'),('a2','b2','c2','value')])
+        # The record with the highest id is kept for a key
+        self.assertEqual(columns.cell_values.tolist(),[1.5,8])
+        self.assertEqual(columns.version_first.tolist(),[self.v2.id,self.v1.id])
+        self.assertEqual(columns.codes['testitemc'].tolist(),[self.c1.id,self.c2.id])
+
+    def test_find_get(self):
+        """Test looking up records by key."""
+        columns = AssessColumns(TestData, Keys(TestData))
+        columns.load(TestData.objects.all())
+        i = columns.find(('a2','b2','c2','value'))
+        self.assertEqual(i,1)
+        self.assertEqual(columns.get_key(i),('a2','b2','c2','value'))
+        self.assertEqual(columns.get_value(0),'1,500')
+        self.assertEqual(columns.find(('a1','b2','c2','value')),-1)
+        self.assertEqual(columns.find(('a1','b2','c3','value')),-1)
+        self.assertEqual(columns.find(('a1','b2','value')),-1)
+        self.assertNotIn(('bad','b2','c2','value'),columns)
+        # Model objects are created on demand
+        record = columns[('a2','b2','c2','value')]
+        self.assertEqual(record,TestData.objects.get(value=8))
+        self.assertEqual(record.value,Decimal('8'))
+        self.assertEqual(record.testitema_id,self.a2.id)
+        self.assertEqual(record.version_last,None)
+        with self.assertRaises(KeyError):
+            columns[('a1','b2','c2','value')]
+
+    def test_set_del(self):
+        """Test inserting, replacing and deleting records."""
+        columns = AssessColumns(TestData, Keys(TestData))
+        columns.load(TestData.objects.all())
+        record = TestData(testitema=self.a1,testitemb=self.b2,testitemc=self.c1,value=3)
+        columns[record.get_key()] = record
+        self.assertEqual(list(columns)[1],('a1','b2','c1','value'))
+        self.assertEqual(columns.cell_values.tolist(),[1.5,3,8])
+        record.value = 4
+        columns[record.get_key()] = record
+        self.assertEqual(columns.cell_values.tolist(),[1.5,4,8])
+        columns.pop(('a1','b1','c1','value'))
+        self.assertEqual(columns.cell_values.tolist(),[4,8])
+        with self.assertRaises(KeyError):
+            del columns[('a1','b1','c1','value')]
+
+    def test_mappings(self):
+        """Test mappings model columns, values are item ids."""
+        columns = AssessColumns(TestMappings, Keys(TestMappings))
+        columns.load(TestMappings.objects.all())
+        self.assertEqual(list(columns),[('a2','b1','testitemc')])
+        self.assertEqual(columns.cell_values.tolist(),[self.c2.id])
+        self.assertEqual(columns.get_value(0),'c2')
+        self.assertEqual(columns[('a2','b1','testitemc')].testitemc,self.c2)
+
+    def test_pivot_sparse(self):
+        """Test pivot of only the rows with records."""
+        columns = AssessColumns(TestData, Keys(TestData))
+        columns.load(TestData.objects.all())
+        headers = (['testitema','testitemb'], ['c1','c2'], 'testitemc')
+        self.assertEqual(len(columns.pivot(*headers)),4)
+        self.assertEqual(columns.count_stored_rows(headers[0]),2)
+        rows = columns.pivot(*headers, sparse=True)
+        self.assertEqual([(r['testitema'],r['testitemb']) for r in rows],[('a1','b1'),('a2','b2')])
+        self.assertEqual(rows[0]['c1'],'1,500')
+        self.assertEqual(rows[0]['c2'],'n.d.')
+        self.assertEqual(rows[1]['c2_key'],"('a2', 'b2', 'c2', 'value')")
+        # Windows count the rows with records
+        rows = columns.pivot(*headers, 1, 2, True)
+        self.assertEqual(len(rows),1)
+        self.assertEqual(rows[0]['c2'],'8,000')
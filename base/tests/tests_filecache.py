@@ -0,0 +1,48 @@
+import os
+import tempfile
+from io import BytesIO
+
+from django.test import TestCase
+
+from base.filecache import FileCache
+
+
+class FileCacheTestCase(TestCase):
+    """Testing FileCache()."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def test_get_put(self):
+        """Test files are found by key, and not found before put."""
+        cache = FileCache(self.directory, 100, '.txt')
+        key = cache.get_key('app', [('model', 1)])
+        self.assertEqual(key,cache.get_key('app', [('model', 1)]))
+        self.assertNotEqual(key,cache.get_key('app', [('model', 2)]))
+        self.assertEqual(cache.get(key),None)
+        source_file = BytesIO(b'content')
+        cache.put(key, source_file)
+        self.assertEqual(source_file.tell(),0)
+        with cache.get(key) as cached_file:
+            self.assertEqual(cached_file.read(),b'content')
+        self.assertEqual(os.listdir(self.directory),[key + '.txt'])
+
+    def test_evict(self):
+        """Test least recently used files are deleted beyond max size."""
+        cache = FileCache(self.directory, 35, '.txt')
+        keys = [cache.get_key(n) for n in range(3)]
+        for (n, key) in enumerate(keys):
+            cache.put(key, BytesIO(b'1234567890'))
+            # Order the use of files regardless of the timer resolution
+            os.utime(cache.get_path(key), (n, n))
+        # Using the oldest file makes the second the least recently used
+        cache.get(keys[0]).close()
+        cache.put(cache.get_key(3), BytesIO(b'1234567890'))
+        self.assertEqual(cache.get(keys[1]),None)
+        for key in [keys[0], keys[2], cache.get_key(3)]:
+            cache.get(key).close()
+        # The file just put is kept, even if larger than max size
+        cache.put(cache.get_key(4), BytesIO(b'1' * 30))
+        self.assertEqual(os.listdir(self.directory),[cache.get_key(4) + '.txt'])
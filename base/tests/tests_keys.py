@@ -1,6 +1,7 @@
 from django.test import TestCase
 from base.models import Version,TestItemA, TestItemB, TestItemC, TestData, TestMappings
-from base.keys import Keys
+from base.keys import Keys, KeyList
+from base.set import AssessSet
 from base.errors import NoFieldError, NoItemError
 
 class KeysTestCase(TestCase):
@@ -57,6 +58,48 @@ class KeysTestCase(TestCase):
         self.assertEqual(keys_data.get_key_list(),key_list)
 
 
+    def test_key_list_random_access(self):
+        """Testing the lazy key list's random access and slicing."""
+        keys_data = Keys(TestData)
+        keys_data.set_headers('value')
+        key_list = keys_data.get_key_list()
+        self.assertEqual(len(key_list),4)
+        self.assertEqual(key_list[2],('a2','b1','c1'))
+        self.assertEqual(key_list[-1],('a2','b1','c2'))
+        self.assertEqual(key_list[1:3],[('a1','b1','c2'),('a2','b1','c1')])
+        with self.assertRaises(IndexError):
+            key_list[4]
+        # Keys are computed, not stored, so size does not cost memory
+        labels = [[str(i) for i in range(1000)]] * 4
+        key_list = KeyList(labels)
+        self.assertEqual(len(key_list),10**12)
+        self.assertEqual(key_list[10**12-2],('999','999','999','998'))
+        self.assertEqual(key_list[1001001],('0','1','1','1'))
+
+    def test_items_cache(self):
+        """Testing that current items are cached and cleared on changes."""
+        Keys(TestData)
+        # Warm Keys make no item queries, only one query of the item heads
+        with self.assertNumQueries(1):
+            keys_data = Keys(TestData)
+        self.assertEqual(keys_data.indices_labels['testitema'],['a1','a2'])
+        # Saving an item clears its model's cached items
+        v = Version.objects.create()
+        TestItemA.objects.create(label='a3',version_first=v)
+        with self.assertNumQueries(2):
+            keys_data = Keys(TestData)
+        self.assertEqual(keys_data.indices_labels['testitema'],['a1','a2','a3'])
+        # Deleting through AssessSet archives by queryset update
+        AssessSet(TestItemA).delete(str(keys_data.indices_labels_ids['testitema']['a3']))
+        keys_data = Keys(TestData)
+        self.assertEqual(keys_data.indices_labels['testitema'],['a1','a2'])
+        # Items changed by another process, which sends no signals here,
+        # are read again when the item model's version head has moved
+        TestItemA.objects.filter(label='a2').update(label='a2x')
+        self.assertEqual(Keys(TestData).indices_labels['testitema'],['a1','a2'])
+        v = Version.objects.create(model_name='TestItemA')
+        self.assertEqual(Keys(TestData).indices_labels['testitema'],['a1','a2x'])
+
     def test_key_headers_mappings(self):
         """Testing the AssessData meta model's interaction with Keys()."""
 
@@ -1,4 +1,5 @@
 from decimal import Decimal
+from django.db import connection
 from django.test import TestCase
 from base.errors import NoFieldError, NoItemError
 from base.models import Version,TestItemA, TestItemB, TestItemC, TestData, TestMappings
@@ -62,6 +63,16 @@ class TableModelTestCase(TestCase):
         current_records = list(TestData.objects.filter(**fc))
         self.assertEqual(current_records, [self.r1,self.r2,self.r3b])
 
+    def test_indexes(self):
+        """Test composite indexes on version and index fields in database."""
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, TestData._meta.db_table)
+        columns = [c['columns'] for c in constraints.values() if c['index']]
+        self.assertIn(['version_last_id','version_first_id'],columns)
+        self.assertIn(['testitema_id','testitemb_id','testitemc_id','version_last_id','version_first_id'],columns)
+        # Items are not looked up by key, only by version
+        self.assertEqual(len(TestItemA._meta.indexes),1)
+
     def test_set_from_cell_success(self):
         """Test that cell values can be set from single and multi-column"""
         t = TestData()
@@ -1,10 +1,14 @@
 from decimal import Decimal
+from unittest.mock import patch
 
 from django.test import TestCase
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.exceptions import ValidationError
 
+from base.version import Snapshot
 from base.models import Version,TestItemA, TestItemB, TestItemC, TestData
 from base.table import AssessTable
+from base.tableIO import AssessTableIO
 from base.errors import NotDecimalError, NoFieldError, KeyNotFound, NotCleanRecord
 
 
@@ -60,11 +64,158 @@ class TableTestCase(TestCase):
 
 
     def test_set_rows(self):
-        pass   
-    
+        pass
+
     def test_load(self):
         pass
 
+    def test_load_query_count(self):
+        """Test that load runs a constant number of queries."""
+        t = AssessTable(TestData, "")
+        with self.assertNumQueries(1):
+            t.load(False,[])
+        self.assertEqual(len(t.records),8)
+        self.assertEqual(t.records[('a2','b2','c2','value')].value, Decimal('8'))
+        # Twice the records must not add queries
+        for r in TestData.objects.all():
+            r.pk = None
+            r.version_first = None
+            r.save()
+        t = AssessTable(TestData, "proposed")
+        with self.assertNumQueries(1):
+            t.load(False,[])
+        self.assertEqual(len(t.records),8)
+
+    def test_load_archived(self):
+        """Test that archived versions load one record per key from DB."""
+        t = AssessTable(TestData, "1")
+        self.assertEqual(t.get_load_query(False).count(),8)
+        t.load(False)
+        self.assertEqual(t.records[('a1','b2','c1','value')].value, Decimal('13'))
+        # Records replaced at version 2 are not loaded
+        t = AssessTable(TestData, "2")
+        self.assertEqual(t.get_load_query(False).count(),8)
+        t.load(False)
+        self.assertEqual(t.records[('a1','b2','c1','value')].value, Decimal('3'))
+        self.assertEqual(t.records[('a1','b1','c1','value')].value, Decimal('1'))
+
+    def test_diff(self):
+        """Test differences between any two versions."""
+        t = AssessTable(TestData, "")
+        t.load_diff(str(self.v2.id),str(self.v1.id))
+        self.assertEqual(t.diff_versions,(self.v1.id,self.v2.id))
+        rows = t.get_diff_rows()
+        self.assertEqual(len(rows),4)
+        self.assertEqual(rows[0],{'testitema': 'a1', 'testitemb': 'b2', 'testitemc': 'c1',
+                                  'old': '13,000', 'new': '3,000', 'change': 'changed'})
+        # Records archived without a replacement are removed, and records
+        # in cells without records in the old version are added
+        v3 = Version.objects.create()
+        c3 = TestItemC.objects.create(label='c3',version_first=v3)
+        TestData.objects.filter(testitema=self.a1,testitemb=self.b1,testitemc=self.c1).update(version_last=v3)
+        TestData.objects.create(testitema=self.a1,testitemb=self.b1,testitemc=self.c1,value=2,version_first=v3)
+        TestData.objects.create(testitema=self.a1,testitemb=self.b1,testitemc=c3,value=7,version_first=v3)
+        TestData.objects.filter(testitema=self.a2,testitemb=self.b1,testitemc=self.c1).update(version_last=v3)
+        t = AssessTable(TestData, "")
+        t.load_diff(str(self.v2.id),'current')
+        rows = t.get_diff_rows()
+        self.assertEqual([r['change'] for r in rows],['changed','added','removed'])
+        self.assertEqual(rows[1]['old'],'n.d.')
+        self.assertEqual(rows[2]['new'],'n.d.')
+        lines = list(t.get_diff_CSV(chunk_size=1))
+        self.assertEqual(lines[0],'testitema\ttestitemb\ttestitemc\told\tnew\tchange\n')
+        self.assertEqual(lines[3],'a2\tb1\tc1\t5,000\tn.d.\tremoved\n')
+
+    def test_snapshot(self):
+        """Test loading archived versions from snapshots."""
+        # Snapshots are taken at the table's head, of the table's versions
+        Version.objects.filter(id__in=[self.v1.id,self.v2.id]).update(model_name='testdata')
+        t = AssessTable(TestData, "")
+        snapshot = t.take_snapshot()
+        self.assertEqual((snapshot.version_id,snapshot.cells),(self.v2.id,8))
+        v3 = Version.objects.create()
+        TestData.objects.filter(testitema=self.a1,testitemb=self.b1,testitemc=self.c1).update(version_last=v3)
+        TestData.objects.create(testitema=self.a1,testitemb=self.b1,testitemc=self.c1,value=9,version_first=v3)
+        # Without snapshot_interval no snapshot is looked up: one query
+        t = AssessTable(TestData, str(v3.id))
+        with self.assertNumQueries(1):
+            t.load(False)
+        # Snapshot, archived ids and added records: three queries
+        t.snapshot_interval = 1
+        with self.assertNumQueries(3):
+            t.load(False)
+        self.assertEqual(t.records[('a1','b1','c1','value')].value,Decimal('9'))
+        self.assertEqual(t.records[('a2','b2','c2','value')].value,Decimal('8'))
+        loaded = dict((key,t.records.get_value(t.records.find(key))) for key in t.records)
+        # Loading from the snapshot is the same as loading the history
+        Snapshot.objects.all().delete()
+        t.load(False)
+        self.assertEqual(loaded,dict((key,t.records.get_value(t.records.find(key))) for key in t.records))
+        # Versions before the snapshot are loaded from the history
+        t = AssessTable(TestData, str(self.v1.id))
+        t.snapshot_interval = 1
+        t.take_snapshot(v3.id)
+        self.assertEqual(t.get_snapshot(False),None)
+
+    def test_snapshot_retention(self):
+        """Test snapshots taken at commits and their retention."""
+        t = AssessTable(TestData, "proposed")
+        t.snapshot_interval = 1
+        t.snapshot_retention = 2
+        for value in ['10','11','12']:
+            t.save_POST({"('a1', 'b1', 'c1', 'value')": value})
+            t.commit_rows({'label': value})
+        snapshots = Snapshot.objects.order_by('version_id')
+        self.assertEqual(len(snapshots),2)
+        # The latest version is loaded from its snapshot alone
+        version_id = Version.objects.filter(label='12').get().id
+        self.assertEqual(snapshots[1].version_id,version_id)
+        t = AssessTable(TestData, str(version_id - 1))
+        t.snapshot_interval = 1
+        t.load(False)
+        self.assertEqual(t.records[('a1','b1','c1','value')].value,Decimal('11'))
+
+    def test_load_rows(self):
+        """Test loading only the records of a window of rows."""
+        t = AssessTable(TestData, "")
+        t.set_page({'page': '2', 'size': '1'})
+        t.keys.set_headers('testitemc')
+        self.assertEqual(t.get_page_rows(),(1,2))
+        self.assertEqual(t.page_count,4)
+        t.load_rows(False,1,2)
+        self.assertEqual(list(t.records),[('a1','b2','c1','value'),('a1','b2','c2','value')])
+        t.set_rows('testitemc','display',1,2)
+        self.assertEqual(len(t.rows),1)
+        self.assertEqual(t.rows[0]['c2'],'4,000')
+        # A page beyond the last page shows the last page
+        t.set_page({'page': '9', 'size': '3'})
+        self.assertEqual(t.get_page_rows(),(3,4))
+        self.assertEqual(t.page,2)
+
+    def test_sparse(self):
+        """Test sparse tables showing only rows with records."""
+        # Full table: auto selects the full display
+        t = AssessTable(TestData, "")
+        context = t.render_table_context('testitemc',False)
+        self.assertFalse(t.sparse)
+        self.assertEqual(context['row_count'],4)
+        # Few changes: auto selects sparse display of the changed rows
+        t = AssessTable(TestData, "2")
+        t.sparse_density = 0.6
+        context = t.render_table_context('testitemc',True)
+        self.assertTrue(t.sparse)
+        self.assertEqual(context['row_count'],2)
+        self.assertEqual([r['testitemb'] for r in context['row_list']],['b2','b2'])
+        self.assertEqual(context['sparse_query'],'?page=1&size=100&sparse=0')
+        # Selected sparse display is kept in page links
+        t = AssessTable(TestData, "")
+        t.set_page({'page': '2', 'size': '1', 'sparse': '1'})
+        TestData.objects.filter(testitema=self.a2).delete()
+        context = t.render_table_context('testitemc',False)
+        self.assertEqual(context['row_count'],2)
+        self.assertEqual(context['row_list'][0]['testitemb'],'b2')
+        self.assertEqual(context['page_links'][0]['query'],'?page=1&size=1&sparse=1')
+
     def test_table_save_POST_success(self):
         """Test saving data using POST edit method."""
         t = AssessTable(TestData, "")
@@ -114,6 +265,55 @@ class TableTestCase(TestCase):
         self.assertEqual(t.errors,[])
         self.assertEqual(t.records[('a1','b1','c1','value')].get_value(), '10,000')
 
+    def test_table_save_CSV_file(self):
+        """Test saving of data model through CSV file, rolled back on errors."""
+        t = AssessTable(TestData, "")
+        csv_bytes = b"testitema\ttestitemb\ttestitemc\tvalue\r\na1\tb1\tc1\t10\r\na1\tb1\tc2\t11\r\n"
+        t.save_CSV_file(SimpleUploadedFile('table.csv', csv_bytes), 'value')
+        self.assertEqual(t.errors,[])
+        t = AssessTable(TestData, "proposed")
+        t.load(False,[])
+        self.assertEqual(t.records[('a1','b1','c1','value')].get_value(), '10,000')
+        self.assertEqual(t.records[('a1','b1','c2','value')].get_value(), '11,000')
+        # A bad line after the first batch discards the saved batches
+        count = TestData.objects.count()
+        csv_bytes = b"testitema\ttestitemb\ttestitemc\tvalue\na1\tb1\tc1\t20\na1\tb1\tc2\t21\nBAD\tb1\tc1\t22\n"
+        t = AssessTable(TestData, "")
+        with patch.object(AssessTableIO, 'batch_size', 1):
+            t.save_CSV_file(SimpleUploadedFile('table.csv', csv_bytes), 'value')
+        self.assertEqual(len(t.errors),1)
+        self.assertEqual(TestData.objects.count(),count)
+
+    def test_table_save_CSV_unchanged(self):
+        """Test that only changed records of a CSV upload are saved."""
+        t = AssessTable(TestData, "")
+        t.load(False,[])
+        count = TestData.objects.count()
+        csv_string = "testitema\ttestitemb\ttestitemc\tvalue\na1\tb1\tc1\t" + \
+                     t.records.get_value(t.records.find(('a1','b1','c1','value'))) + \
+                     "\na1\tb1\tc2\t11"
+        t = AssessTable(TestData, "proposed")
+        t.save_CSV({ 'csv_string': csv_string, 'column_field': 'value' })
+        self.assertEqual(t.errors,[])
+        self.assertEqual(TestData.objects.count(),count + 1)
+        t = AssessTable(TestData, "proposed")
+        t.save_CSV({ 'csv_string': csv_string, 'column_field': 'value' })
+        self.assertEqual(TestData.objects.count(),count + 1)
+        record = TestData.objects.filter(version_first__isnull=True).get()
+        self.assertEqual(record.value,Decimal('11'))
+
+    def test_table_save_CSV_new_item(self):
+        """Test CSV records are compared under the table's items."""
+        t = AssessTable(TestData, "proposed")
+        # An item added after the table was made shifts the cell codes of
+        # new Keys, but the upload is parsed with the table's Keys
+        TestItemC.objects.create(label='c0',version_first=self.v1)
+        count = TestData.objects.count()
+        csv_string = "testitema\ttestitemb\ttestitemc\tvalue\na2\tb2\tc1\t7\na2\tb2\tc2\t8"
+        t.save_CSV({ 'csv_string': csv_string, 'column_field': 'value' })
+        self.assertEqual(t.errors,[])
+        self.assertEqual(TestData.objects.count(),count)
+
     def test_table_get_CSV_form_context(self):
         """Test get CSV form context."""
         t = AssessTable(TestData, "")
@@ -201,6 +401,27 @@ class TableTestCase(TestCase):
         self.assertEqual(t.records[('a1','b1','c1','value')].value, Decimal('10'))
         self.assertEqual(t.records[('a1','b1','c2','value')].value, Decimal('11'))
 
+    def test_table_commit_bulk(self):
+        """Test set-based commit, including a key proposed twice."""
+        TestData.objects.create(testitema=self.a1,testitemb=self.b1,testitemc=self.c1,value=20)
+        TestData.objects.create(testitema=self.a1,testitemb=self.b1,testitemc=self.c1,value=21)
+        TestData.objects.create(testitema=self.a2,testitemb=self.b1,testitemc=self.c2,value=22)
+        v3 = Version.objects.create(label='v3')
+        v3.set_version_id('proposed')
+        t = AssessTable(TestData, "proposed")
+        t.commit_bulk(v3)
+        # The newest proposal is current, the older proposal is archived
+        r = TestData.objects.get(value=21)
+        self.assertEqual((r.version_first, r.version_last), (v3, None))
+        r = TestData.objects.get(value=20)
+        self.assertEqual((r.version_first, r.version_last), (v3, v3))
+        # The replaced records are archived, the others are left as is
+        self.assertEqual(TestData.objects.get(id=1).version_last, v3)
+        self.assertEqual(TestData.objects.get(id=8).version_last, v3)
+        self.assertEqual(TestData.objects.get(id=2).version_last, None)
+        self.assertEqual(t.count_db_records('current'), 8)
+        self.assertEqual(t.count_db_records('proposed', True), 0)
+
     def test_get_version_metric(self):
         """Test the history context (list of versions)."""
         t = AssessTable(TestData, "current")
@@ -213,8 +434,44 @@ class TableTestCase(TestCase):
         self.assertEqual(vd['cells'],8)
         self.assertEqual(vd['changes'],4)
 
+    def test_get_version_metric_proposed(self):
+        """Test version metrics aggregated by the database."""
+        TestData.objects.create(testitema=self.a1,testitemb=self.b1,testitemc=self.c1,value=9)
+        TestData.objects.create(testitema=self.a1,testitemb=self.b1,testitemc=self.c1,value=10)
+        # No records are loaded: one aggregate and one count query
+        t = AssessTable(TestData, "proposed")
+        with self.assertNumQueries(2):
+            vd = t.get_version_metric()
+        # The newest proposed record replaces the current record
+        self.assertEqual(vd['metric'],sum([10,2,3,4,5,6,7,8])/8)
+        self.assertEqual(vd['cells'],8)
+        self.assertEqual(vd['changes'],2)
+
     def test_get_history_context(self):
-        pass
+        """Test the history context (list of versions)."""
+        for n in range(3):
+            Version.objects.create(model_name='testdata')
+        TestData.objects.create(testitema=self.a1,testitemb=self.b1,testitemc=self.c1,value=9)
+        t = AssessTable(TestData, "")
+        t.set_page({'history': '2'})
+        history = t.get_history_context()
+        self.assertEqual([v.status for v in history],['Proposed','Current','Archived'])
+        self.assertEqual(history[0].changes,1)
+        self.assertEqual(history[0].metric,sum([9,2,3,4,5,6,7,8])/8)
+        self.assertTrue(t.history_more)
+        self.assertEqual(t.get_page_query(1),'?page=1&size=100&history=2')
+        # Proposed metrics are cached: fingerprint, version head (cached
+        # outside transactions) and versions queries only
+        with self.assertNumQueries(3):
+            history = t.get_history_context()
+        self.assertEqual(history[0].changes,1)
+        # A new proposal is seen by its fingerprint
+        TestData.objects.create(testitema=self.a1,testitemb=self.b1,testitemc=self.c2,value=10)
+        history = t.get_history_context()
+        self.assertEqual(history[0].changes,2)
+        t.set_page({'history': '3'})
+        t.get_history_context()
+        self.assertFalse(t.history_more)
 
     def test_revert_proposed(self):
         """Test revert table functionality."""
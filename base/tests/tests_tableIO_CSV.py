@@ -1,5 +1,8 @@
+from unittest.mock import patch
+
 from django.test import TestCase
-from base.errors import AssessError, NoItemError, NoFieldError, CSVheaderMalformed, CSVwrongColumnCount, CSVfieldNotFound
+from django.core.files.uploadedfile import SimpleUploadedFile
+from base.errors import AssessError, NoItemError, NoFieldError, CSVheaderMalformed, CSVwrongColumnCount, CSVfieldNotFound, CSVtooManyErrors
 from base.models import Version,TestItemA, TestItemB, TestItemC, TestData, TestMappings
 from base.tableIO import AssessTableIO
 
@@ -141,6 +144,114 @@ class TableIOTestCase(TestCase):
         self.assertEqual(values,values_data_val)
 
 
+    def test_parse_csv_file(self):
+        """Test parsing of csv files in batches in TableIO """
+        tIO = AssessTableIO(TestData,delimiters)
+        tIO.batch_size = 3
+        csv_file = SimpleUploadedFile('data.csv', csv_data_string_b.encode())
+        batches = list(tIO.parse_csv_file(csv_file, 'testitemb'))
+        self.assertEqual([len(records) for records in batches],[3,1])
+        values = []
+        for records in batches:
+            for record in records.values():
+                values.append(record.get_value())
+        self.assertEqual(tIO.errors,[])
+        self.assertEqual(values,values_data_b)
+        # Errors are reported as for parse_csv
+        tIO = AssessTableIO(TestData,delimiters)
+        csv_file = SimpleUploadedFile('data.csv', csv_data_string_bb.encode())
+        list(tIO.parse_csv_file(csv_file, 'testitemb'))
+        POST = {'column_field': 'testitemb', 'csv_string': csv_data_string_bb }
+        tIO_string = AssessTableIO(TestData,delimiters)
+        tIO_string.parse_csv(POST)
+        self.assertEqual([str(e) for e in tIO.errors],[str(e) for e in tIO_string.errors])
+        # Errors over max_errors are only counted
+        tIO = AssessTableIO(TestData,delimiters)
+        tIO.batch_size = 2
+        tIO.max_errors = 2
+        csv_string = "testitema\ttestitemb\tc1\tc2" + "\na1;b1;1;2" * 5
+        csv_file = SimpleUploadedFile('data.csv', csv_string.encode())
+        list(tIO.parse_csv_file(csv_file, 'testitemc'))
+        self.assertEqual([type(e) for e in tIO.errors],
+                         [CSVwrongColumnCount,CSVwrongColumnCount,CSVtooManyErrors])
+        self.assertEqual(tIO.errors[2].count,3)
+
+    def test_parse_csv_file_parallel(self):
+        """Test parsing of large csv files in worker processes """
+        tIO = AssessTableIO(TestData,delimiters)
+        tIO.batch_size = 1
+        tIO.processes = 2
+        tIO.parallel_lines = 2
+        csv_file = SimpleUploadedFile('data.csv', csv_data_string_b.encode())
+        with patch.object(AssessTableIO, 'parse_parallel', wraps=tIO.parse_parallel) as parse_parallel, \
+             patch.object(AssessTableIO, 'get_executor', wraps=tIO.get_executor) as get_executor:
+            batches = list(tIO.parse_csv_file(csv_file, 'testitemb'))
+        # A batch for each of the processes at a time, by the same processes
+        self.assertEqual(parse_parallel.call_count,2)
+        self.assertEqual(get_executor.call_count,1)
+        self.assertEqual([len(records) for records in batches],[2,2])
+        values = []
+        for records in batches:
+            for record in records.values():
+                values.append(record.get_value())
+        self.assertEqual(tIO.errors,[])
+        self.assertEqual(values,values_data_b)
+
+    def test_parse_csv_columns(self):
+        """Test vectorized parsing of csv strings against parse_csv """
+        csv_data_string_c_bad = """testitema\ttestitemb\tc1\tc2
+a1\tb1\t1\t2\t99
+BADITEM\tb1\tXX\t6
+a2\tb1\t1,5\tYY"""
+        cases = [(TestData, 'testitemc', csv_data_string_c),
+                 (TestData, 'testitema', csv_data_string_a),
+                 (TestData, 'value', csv_data_string_val),
+                 (TestData, 'testitemb', csv_data_string_bb),
+                 (TestData, 'testitemc', csv_data_string_c_bad),
+                 (TestMappings, 'testitemb', csv_mappings_string_b),
+                 (TestMappings, 'testitemb', "testitema\tb1\na1\tBADITEM\n")]
+        for (model, column_field, csv_string) in cases:
+            POST = {'column_field': column_field, 'csv_string': csv_string }
+            tIO = AssessTableIO(model,delimiters)
+            records = tIO.parse_csv(POST)
+            tIO_columns = AssessTableIO(model,delimiters)
+            columns = tIO_columns.parse_csv_columns(POST)
+            # Same errors in the same order, and the same records by key
+            self.assertEqual([str(e) for e in tIO_columns.errors],[str(e) for e in tIO.errors])
+            values = sorted((key, str(record.get_value())) for (key, record) in records.items())
+            self.assertEqual(sorted((key, str(record.get_value())) for (key, record) in columns.items()),values)
+        self.assertEqual(len(tIO.errors),1)
+        self.assertEqual(columns.cell_values.tolist(),[])
+
+    def test_parse_csv_parallel(self):
+        """Test parsing of csv strings in worker processes """
+        csv_data_string_c_bad = """testitema\ttestitemb\tc1\tc2
+a1\tb1\t1\t2\t99
+BADITEM\tb1\tXX\t6
+a1\tb1\t3\t4
+a2\tb1\t1,5\tYY
+a2\tb1\t7"""
+        for csv_string in [csv_data_string_c, csv_data_string_c_bad]:
+            POST = {'column_field': 'testitemc', 'csv_string': csv_string }
+            tIO = AssessTableIO(TestData,delimiters)
+            columns = tIO.parse_csv_columns(POST)
+            tIO_parallel = AssessTableIO(TestData,delimiters)
+            tIO_parallel.processes = 2
+            tIO_parallel.parallel_lines = 2
+            columns_parallel = tIO_parallel.parse_csv_columns(POST)
+            self.assertEqual([str(e) for e in tIO_parallel.errors],[str(e) for e in tIO.errors])
+            self.assertEqual(list(columns_parallel),list(columns))
+            self.assertEqual(columns_parallel.get_values(),columns.get_values())
+        self.assertEqual(len(tIO.errors),5)
+        # Records are the same, also when errors discard them
+        lines = csv_data_string_c_bad.splitlines()
+        tIO = AssessTableIO(TestData,delimiters)
+        csv_headers = tIO.set_csv_headers(lines[0], 'testitemc')
+        columns = tIO.parse_csv_lines(lines[1:], csv_headers, 'testitemc', 1)
+        columns_parallel = tIO.parse_csv_lines(lines[1:], csv_headers, 'testitemc', 3)
+        self.assertEqual(columns_parallel.cell_values.tolist(),columns.cell_values.tolist())
+        self.assertEqual(columns.cell_values.tolist(),[3,4,1.5])
+
     def test_parse_csv_mappings(self):
         """Test parsing of csv strings for mappings_model in TableIO """
         
@@ -1,5 +1,5 @@
 import pandas 
-from pandas.util.testing import assert_frame_equal
+from pandas.testing import assert_frame_equal
 import traceback
 from decimal import Decimal
 from django.test import TestCase
@@ -111,6 +111,38 @@ class TableIOTestCase(TestCase):
         e2 = str(NoItemError('BADITEM',TestMappings))
         self.assertEqual(e1,e2)
 
+    def test_parse_dataframe_columns(self):
+        """Test vectorized parsing of dataframes against parse_dataframe"""
+        dfe = pandas.DataFrame({'testitema': ['a1','a2'], 'testitemb': ['b1','b1'], 'testitemc': ['BADITEM','c1'], 'value': ['XX','1']})
+        for df in [dfd, dfe]:
+            tIO = AssessTableIO(TestData,delimiters)
+            records = tIO.parse_dataframe(df)
+            tIO_columns = AssessTableIO(TestData,delimiters)
+            columns = tIO_columns.parse_dataframe_columns(df)
+            self.assertEqual([str(e) for e in tIO_columns.errors],[str(e) for e in tIO.errors])
+            # The columns are in key order, and empty if there are errors
+            DF = [(key, record.get_value()) for key,record in records.items()]
+            DF_columns = [(key, record.get_value()) for key,record in columns.items()]
+            if tIO.errors == []:
+                self.assertEqual(DF_columns,sorted(DF))
+            else:
+                self.assertEqual(DF_columns,[])
+
+    def test_parse_dataframe_parallel(self):
+        """Test parsing of dataframes in worker processes"""
+        dfe = pandas.DataFrame({'testitema': ['a1','a2','a2'], 'testitemb': ['b1','b1','b2'], 'testitemc': ['BADITEM','c1','c2'], 'value': ['1','XX','3']})
+        for df in [dfd, dfe]:
+            tIO = AssessTableIO(TestData,delimiters)
+            columns = tIO.parse_dataframe_columns(df)
+            tIO_parallel = AssessTableIO(TestData,delimiters)
+            tIO_parallel.processes = 2
+            tIO_parallel.parallel_lines = 2
+            columns_parallel = tIO_parallel.parse_dataframe_columns(df)
+            self.assertEqual([str(e) for e in tIO_parallel.errors],[str(e) for e in tIO.errors])
+            self.assertEqual(list(columns_parallel),list(columns))
+            self.assertEqual(columns_parallel.get_values(),columns.get_values())
+        self.assertEqual(len(tIO.errors),2)
+
     # Parse dataframe to records
 
     def test_get_dataframe_success(self):
@@ -1,5 +1,6 @@
-from django.test import TestCase
-from .. version import Version
+from django.core.signals import request_started
+from django.test import TestCase, TransactionTestCase
+from .. version import Version, VersionHead
 from .. models import TestItemA, TestItemB, TestItemC, TestData
 
 class VersionTestCase(TestCase):
@@ -84,6 +85,25 @@ class VersionTestCase(TestCase):
         self.assertEqual(v2.version_id,5)
         self.assertEqual(v2.status,"current")
 
+    def test_version_head(self):
+        """Testing the heads moved by creating versions."""
+        self.assertEqual(VersionHead.objects.get(model_name='TestData').version_id,4)
+        self.assertEqual(VersionHead.objects.get(model_name='Not TestData').version_id,5)
+        self.assertEqual(VersionHead.objects.get(model_name='__all__').version_id,5)
+        # Current version is one lookup of a head
+        v = Version(model_name='TestData')
+        with self.assertNumQueries(1):
+            v.set_version_id('')
+        self.assertEqual(v.version_id,4)
+        # Missing heads are found from the versions
+        VersionHead.objects.all().delete()
+        v.set_version_id('')
+        self.assertEqual(v.version_id,4)
+        self.assertEqual(VersionHead.objects.get(model_name='TestData').version_id,4)
+        # Saving an existing version does not move heads
+        self.v2.save()
+        self.assertEqual(VersionHead.objects.get(model_name='TestData').version_id,4)
+
     def test_kwargs_filter_load(self):
         """Test the version kwargs filters."""
         v = Version(model_name='TestData')
@@ -132,6 +152,22 @@ class VersionTestCase(TestCase):
         exp = { 'version_first__isnull': True, 'version_last__isnull': True }
         self.assertEqual(act,exp)
 
+    def test_kwargs_exclude_load(self):
+        """Test the version kwargs excluding archived records."""
+        v = Version(model_name='TestData')
+        v.set_version_id('2')
+        self.assertEqual(v.kwargs_exclude_load(False),{ 'version_last__lte': 2 })
+        self.assertEqual(v.kwargs_exclude_load(True),{ 'version_last__lte': 2 })
+        v.set_version_id('current')
+        self.assertEqual(v.kwargs_exclude_load(False),{})
+        v.set_version_id('proposed')
+        self.assertEqual(v.kwargs_exclude_load(False),{})
+        # Version 2 of TestData holds the record with version_first 2
+        v.set_version_id('2')
+        query = TestData.objects.filter(**v.kwargs_filter_load(False))
+        query = query.exclude(**v.kwargs_exclude_load(False))
+        self.assertEqual([r.value for r in query],[12])
+
     def test_kwargs_filter_misc(self):
         """Test the version kwargs filters, misc methods."""
         v = Version(model_name='TestData')
@@ -154,4 +190,28 @@ class VersionTestCase(TestCase):
         self.assertEqual(act,exp)
 
 
-            
\ No newline at end of file
+            
+
+class VersionHeadTestCase(TransactionTestCase):
+    """Testing the cached heads, outside of a test transaction."""
+
+    def tearDown(self):
+        Version.heads.clear()
+
+    def test_heads_cache(self):
+        """Test that current versions are cached until a version is created."""
+        Version.objects.create(model_name='TestData')
+        v = Version(model_name='TestData')
+        v.set_version_id('')
+        with self.assertNumQueries(0):
+            v.set_version_id('')
+        v3 = Version.objects.create(model_name='TestData')
+        v.set_version_id('')
+        self.assertEqual(v.version_id,v3.id)
+        # Heads moved by other processes are read again by the next request
+        VersionHead.objects.filter(model_name='TestData').update(version_id=v3.id + 1)
+        v.set_version_id('')
+        self.assertEqual(v.version_id,v3.id)
+        request_started.send(sender=None)
+        v.set_version_id('')
+        self.assertEqual(v.version_id,v3.id + 1)
@@ -1,6 +1,7 @@
 from django.test import TestCase
 from .. models import Version,TestItemA, TestItemB, TestItemC, TestData
 from .. messages import Messages
+from .. appIO import ParquetIO
 
 class DataModelTestCase(TestCase):
     """Testing Table()."""
@@ -70,6 +71,45 @@ class DataModelTestCase(TestCase):
         act_1st_row = response.context['row_list'][0]
         self.assertEqual(act_1st_row,exp_1st_row)
         
+    def test_TableDisplayView_page(self):
+        """Test TableDisplayView with page and page size."""
+        response = self.client.get('/test/testdata/?page=2&size=3', follow=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, 'table_display.html')
+        self.assertEqual(response.context['page'],2)
+        self.assertEqual(response.context['page_count'],2)
+        self.assertEqual(response.context['row_count'],4)
+        exp_row= {'testitema':'a2', 'testitemb':'b2', 
+                  'c1': '7,000', 'c1_id': 7, 'c1_key': "('a2', 'b2', 'c1', 'value')", 
+                  'c2': '8,000', 'c2_id': 8, 'c2_key': "('a2', 'b2', 'c2', 'value')" }
+        self.assertEqual(response.context['row_list'],[exp_row])
+        links = [{'readable': 'First', 'query': '?page=1&size=3'},
+                 {'readable': 'Previous', 'query': '?page=1&size=3'}]
+        self.assertEqual(response.context['page_links'],links)
+        self.assertContains(response, 'Page 2 of 2')
+        # Bad page parameters fall back to first page and default size
+        response = self.client.get('/test/testdata/edit/?page=x&size=-1', follow=True)
+        self.assertTemplateUsed(response, 'table_edit.html')
+        self.assertEqual(response.context['page'],1)
+        self.assertEqual(len(response.context['row_list']),4)
+
+    def test_TableDiffView(self):
+        """Test TableDiffView and TableDiffCSVView."""
+        v3 = Version.objects.create()
+        TestData.objects.filter(value=1).update(version_last=v3)
+        TestData.objects.create(testitema=self.a1,testitemb=self.b1,testitemc=self.c1,value=9,version_first=v3)
+        url = '/test/testdata/diff/' + str(self.v1.id) + '/' + str(v3.id) + '/'
+        response = self.client.get(url, follow=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, 'table_diff.html')
+        self.assertEqual(response.context['row_count'],1)
+        self.assertEqual(response.context['row_list'][0]['new'],'9,000')
+        self.assertContains(response, 'from version ' + str(self.v1.id) + ' to version ' + str(v3.id))
+        response = self.client.get(url + 'csv/')
+        self.assertEqual(response['Content-Type'],'text/csv')
+        content = b''.join(response.streaming_content).decode()
+        self.assertEqual(content.splitlines()[1],'a1\tb1\tc1\t1,000\t9,000\tchanged')
+
     def test_TableEditView_GET(self):
         """Test TableEditView"""
         response = self.client.get('/test/testdata/edit', follow=True)
@@ -136,6 +176,22 @@ a1\tb1\t10\t2"""
         act_1st_row = response.context['row_list'][0]
         self.assertEqual(act_1st_row,exp_1st_row)
 
+    def test_TableParquetViews(self):
+        """Test Parquet views, which need the optional pyarrow package."""
+        if ParquetIO.available:
+            response = self.client.get('/test/testdata/parquetupload/', follow=True)
+            self.assertEqual(response.status_code, 200)
+            self.assertTemplateUsed(response, 'file_upload_form.html')
+            self.assertEqual(response.context['file_field'],'parquet_file')
+            response = self.client.get('/test/testdata/parquetdownload/')
+            self.assertEqual(response.status_code, 200)
+            response.close()
+        else:
+            response = self.client.get('/test/testdata/parquetdownload/')
+            self.assertEqual(response.status_code, 501)
+            response = self.client.get('/test/parquetupload/')
+            self.assertEqual(response.status_code, 501)
+
     def test_TableCommitView_GET_success(self):
         """Test TableCommitView GET."""
         # First test with no proposed records, we should get table_display
@@ -1,4 +1,5 @@
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import Max
 
 
 class Version(models.Model):
@@ -17,9 +18,42 @@ class Version(models.Model):
     changes = models.IntegerField(null=True, blank=True)
     metric = models.DecimalField(max_digits=16, decimal_places=6,null=True, blank=True)
 
+    class Meta:
+        # The history of a model is its versions, newest first
+        indexes = [models.Index(fields=['model_name', 'id'])]
+
+    # Current version ids by model_name, cached from VersionHead in this
+    # process, and cleared when a version is created by this process. As
+    # other processes may also create versions, the heads are cleared at
+    # the start of each request too, see clear_heads()
+    heads = {}
+
     def __str__(self) -> str:
         return self.label
 
+    @staticmethod
+    def get_model_name(model: object) -> str:
+        """Return the model_name that the versions of model are saved with."""
+        # Tables (AssessTable) save their versions by lowercase model name,
+        # while item sets (AssessSet) save them by the model's class name
+        if model.model_type == 'item_model':
+            return model.__name__
+        return model.__name__.lower()
+
+    def save(self, *args, **kwargs) -> None:
+        """Save version, and move the heads to a newly created version."""
+        created = self._state.adding
+        # The version and its heads are saved together or not at all
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if created:
+                VersionHead.set_head(self.model_name, self.id)
+                VersionHead.set_head(VersionHead.all_models, self.id)
+        if created:
+            Version.heads.clear()
+            # Clear again, as the heads may be read before a commit
+            transaction.on_commit(Version.heads.clear)
+
     # TODO: Rename to set_version_status - add to "docs/explanation" status
     def set_version_id(self,version_string="") -> None:
         """Use URL version string to calculate version_id, status and link"""
@@ -44,15 +78,19 @@ class Version(models.Model):
     def get_current_version(self) -> int:
         """Returns current (latest committed) version number for self.model"""
         if self.model_name != 'unknown':
-            fm = { 'model_name': self.model_name }
-            q = Version.objects.filter(**fm).values('id').order_by('-id')
+            model_name = self.model_name
         else:
             # if self.model_name is not set, return latest for all models
-            q = Version.objects.values('id').order_by('-id')
-        if len(q) > 0:
-            return q[0]['id']
-        else:
-            return 0
+            model_name = VersionHead.all_models
+        try:
+            return Version.heads[model_name]
+        except KeyError:
+            version_id = VersionHead.get_head(model_name)
+        # Heads read inside a transaction might be rolled back, so only
+        # heads read outside transactions are cached
+        if not connection.in_atomic_block:
+            Version.heads[model_name] = version_id
+        return version_id
     
     def kwargs_filter_load(self, changes: bool) -> dict:
         """Return kwargs dict for load model version, full or changes only."""
@@ -100,6 +138,19 @@ class Version(models.Model):
             kwargs['version_first__lte'] = self.version_id
         return kwargs
 
+    def kwargs_exclude_load(self, changes: bool) -> dict:
+        """Return kwargs dict for excluding records archived by the version."""
+        kwargs = { }
+        # An archived version holds the records that were current at that
+        # version: records with version_first <= id, except those that had
+        # been archived (replaced) at or before the version id. Committing
+        # archives the replaced record, so this leaves one record per key
+        # and the database, not AssessTable, sorts out the older entries.
+        # Excluding keeps records with null version_last
+        if self.status == 'archived':
+            kwargs['version_last__lte'] = self.version_id
+        return kwargs
+
     def kwargs_filter(self,status,changes=False):
         """Return kwargs filter for Django object queries."""
         # Proposed all-records target proposed and current
@@ -127,3 +178,63 @@ class Version(models.Model):
             r = { 'version_first__isnull': False, 'version_last__isnull': True}
         return r
         
+
+
+class VersionHead(models.Model):
+    """Django table holding the latest version id of each model_name."""
+    # One row for each model_name, and one for the latest of all versions,
+    # so finding the current version is a lookup of a unique row
+    all_models = '__all__'
+    model_name = models.CharField(max_length=64, unique=True)
+    version_id = models.IntegerField(default=0)
+
+    def __str__(self) -> str:
+        return self.model_name + ': ' + str(self.version_id)
+
+    @classmethod
+    def set_head(cls, model_name: str, version_id: int) -> None:
+        """Move head of model_name to version_id, if that is later."""
+        heads = cls.objects.filter(model_name=model_name, version_id__lt=version_id)
+        if heads.update(version_id=version_id) == 0:
+            cls.objects.get_or_create(model_name=model_name,
+                                      defaults={'version_id': version_id})
+
+    @classmethod
+    def get_head(cls, model_name: str) -> int:
+        """Return latest version id of model_name, 0 if no versions."""
+        try:
+            return cls.objects.get(model_name=model_name).version_id
+        except cls.DoesNotExist:
+            pass
+        # Versions created before heads were kept: find and keep the head
+        if model_name == cls.all_models:
+            versions = Version.objects.all()
+        else:
+            versions = Version.objects.filter(model_name=model_name)
+        version_id = versions.aggregate(Max('id'))['id__max'] or 0
+        if version_id > 0:
+            cls.set_head(model_name, version_id)
+        return version_id
+
+
+class Snapshot(models.Model):
+    """Django table holding compacted images of a model's table at a version."""
+    # The records of the table at the version, dumped by AssessColumns, so
+    # archived versions can be loaded from the snapshot and later changes
+    model_name = models.CharField(max_length=64)
+    version_id = models.IntegerField()
+    cells = models.IntegerField(default=0)
+    data = models.BinaryField()
+
+    class Meta:
+        indexes = [models.Index(fields=['model_name', 'version_id'])]
+
+    def __str__(self) -> str:
+        return self.model_name + ': ' + str(self.version_id)
+
+
+def clear_heads(sender, **kwargs) -> None:
+    """Signal receiver clearing the cached heads when a request starts."""
+    # Connected to request_started in BaseConfig.ready(), so a request sees
+    # versions created by other processes before the request
+    Version.heads.clear()
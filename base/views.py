@@ -1,10 +1,11 @@
 from django.shortcuts import render
+from django.http import HttpResponse, StreamingHttpResponse
 from django.apps import apps
 from django.urls import path
 
 from . set import AssessSet
 from . table import AssessTable
-from . appIO import XlsIO
+from . appIO import XlsIO, ParquetIO
 from . models import TestData, TestMappings, TestItemA, TestItemB, TestItemC 
 
 def get_url_paths(app_name):
@@ -15,6 +16,9 @@ def get_url_paths(app_name):
     paths.append(path( 'xlsdownload/',                      AppXlsDownloadView, kwargs1, name=app_name+'_xlsdownload' ) )
     paths.append(path( 'xlsdownload/<str:ver>/',            AppXlsDownloadView, kwargs1, name=app_name+'_xlsdownload' ) )
     paths.append(path( 'xlsupload/',                        AppXlsUploadView,   kwargs1, name=app_name+'_xlsupload' ) )
+    paths.append(path( 'parquetdownload/',                  AppParquetDownloadView, kwargs1, name=app_name+'_parquetdownload' ) )
+    paths.append(path( 'parquetdownload/<str:ver>/',        AppParquetDownloadView, kwargs1, name=app_name+'_parquetdownload' ) )
+    paths.append(path( 'parquetupload/',                    AppParquetUploadView,   kwargs1, name=app_name+'_parquetupload' ) )
     
     # Get list of models in app; special case for test
     # TODO: Ensure that test branch of if is only run in testcases
@@ -44,8 +48,13 @@ def get_url_paths(app_name):
             paths.append(path( nL+'/commit/',               TableCommitView,    kwargs1, name=nL+'_commit'  ) )
             paths.append(path( nL+'/revert/',               TableRevertView,    kwargs1, name=nL+'_revert'  ) )
             paths.append(path( nL+'/upload/',               TableUploadView,    kwargs1, name=nL+'_upload'  ) )
+            paths.append(path( nL+'/parquetdownload/',      TableParquetDownloadView, kwargs1, name=nL+'_parquetdownload' ) )
+            paths.append(path( nL+'/parquetdownload/<str:ver>/', TableParquetDownloadView, kwargs1, name=nL+'_parquetdownload' ) )
+            paths.append(path( nL+'/parquetupload/',        TableParquetUploadView, kwargs1, name=nL+'_parquetupload' ) )
             paths.append(path( nL+'/edit/',                 TableEditView,      kwargs1, name=nL+'_edit'    ) )
             paths.append(path( nL+'/edit/<str:col>/',       TableEditView,      kwargs1, name=nL+'_edit'    ) )
+            paths.append(path( nL+'/diff/<str:ver>/<str:ver2>/',     TableDiffView,      kwargs1, name=nL+'_diff'    ) )
+            paths.append(path( nL+'/diff/<str:ver>/<str:ver2>/csv/', TableDiffCSVView,   kwargs1, name=nL+'_diffcsv' ) )
             paths.append(path( nL+'/',                      TableDisplayView,   kwargs2, name=nL+'_table'   ) )
             paths.append(path( nL+'/<str:ver>/',            TableDisplayView,   kwargs2, name=nL+'_version' ) )
             paths.append(path( nL+'/<str:ver>/change/',     TableDisplayView,   kwargs3, name=nL+'_change'  ) )
@@ -74,6 +83,15 @@ def get_xls_links(app_name):
               { 'readable': 'Upload', 'urlname': app_name + '_xlsupload' }, ]
 
 
+def get_parquet_links(app_name):
+    """Return links for uploading and downloading Parquet files."""
+    # Parquet files need the optional pyarrow package
+    if not ParquetIO.available:
+        return []
+    return  [ { 'readable': 'Download', 'urlname': app_name + '_parquetdownload' },
+              { 'readable': 'Upload', 'urlname': app_name + '_parquetupload' }, ]
+
+
 def get_top_bar_links(app_name):
     """Return top bar nagivation links for each app."""
 
@@ -92,6 +110,7 @@ def get_navigation_links(app_name):
     context['mappings_links'] = get_model_name_dicts(app_name,'_table','mappings_model')
     context['topbar_links'] = get_top_bar_links(app_name)
     context['xls_links'] = get_xls_links(app_name)
+    context['parquet_links'] = get_parquet_links(app_name)
     return context
 
 
@@ -138,22 +157,96 @@ def AppXlsUploadView(request: object, app_name: str) -> object:
         return render(request, 'file_upload_form.html', context)
 
 
+def ParquetUnavailableResponse() -> object:
+    """Return response telling that Parquet files are not available."""
+    return HttpResponse('Parquet files need the pyarrow package, which is not installed.',
+                        content_type='text/plain', status=501)
+
+
+def AppParquetDownloadView(request: object, app_name: str, ver='') -> object:
+    """View for downloading app tables as a zip archive of Parquet files."""
+    if not ParquetIO.available:
+        return ParquetUnavailableResponse()
+    return ParquetIO(app_name,ver).get_response()
+
+
+def AppParquetUploadView(request: object, app_name: str) -> object:
+    """View for uploading app tables as a zip archive of Parquet files."""
+    if not ParquetIO.available:
+        return ParquetUnavailableResponse()
+    if request.method == "POST":
+        ParquetIO(app_name,"").parse_save(request.FILES["parquet_file"])
+        return IndexView(request, app_name)
+    else:
+        context = get_navigation_links(app_name)
+        context['file_format'] = 'Parquet'
+        context['file_field'] = 'parquet_file'
+        return render(request, 'file_upload_form.html', context)
+
+
+def TableParquetDownloadView(request,model,app_name,ver=""):
+    """View for downloading data table content as a Parquet file."""
+    if not ParquetIO.available:
+        return ParquetUnavailableResponse()
+    return ParquetIO(app_name,ver,model).get_response()
+
+
+def TableParquetUploadView(request,model,app_name):
+    """View for uploading data table content as a Parquet file."""
+    if not ParquetIO.available:
+        return ParquetUnavailableResponse()
+    if request.method == 'POST':
+        ParquetIO(app_name,"",model).parse_save(request.FILES['parquet_file'])
+        datatable = AssessTable(model,"proposed")
+        context = datatable.render_table_context("",False,[])
+        return AssessRender(request, 'table_display.html', context, app_name)
+    else:
+        context = get_navigation_links(app_name)
+        context['file_format'] = 'Parquet'
+        context['file_field'] = 'parquet_file'
+        return render(request, 'file_upload_form.html', context)
+
+
 def TableDisplayView(request,model,app_name,col="",ver="",dif=""):
     """View for displaying data table content."""
     datatable = AssessTable(model,ver)
+    datatable.set_page(request.GET)
     context = datatable.render_table_context(col,dif,[])
     return AssessRender(request, 'table_display.html', context, app_name)
 
 
+def TableDiffView(request,model,app_name,ver,ver2):
+    """View for displaying the differences between two table versions."""
+    datatable = AssessTable(model,ver2)
+    datatable.set_page(request.GET)
+    context = datatable.render_diff_context(ver,ver2)
+    return AssessRender(request, 'table_diff.html', context, app_name)
+
+
+def TableDiffCSVView(request,model,app_name,ver,ver2):
+    """View for downloading the differences between two versions as CSV."""
+    datatable = AssessTable(model,ver2)
+    datatable.load_diff(ver,ver2)
+    (old, new) = datatable.diff_versions
+    response = StreamingHttpResponse(datatable.get_diff_CSV(), content_type='text/csv')
+    filename = datatable.model_name + '_' + str(old) + '_' + str(new) + '.csv'
+    response['Content-Disposition'] = 'attachment; filename="' + filename + '"'
+    return response
+
+
 def TableEditView(request,model,app_name,col=""):
     """View for editing data table content."""
     if request.method == 'POST':
         datatable = AssessTable(model,"proposed")
         datatable.save_POST(request.POST)
+        # The edit form posts to the URL of its page
+        datatable.set_page(request.GET)
         context = datatable.render_table_context(col,False,[])
         return AssessRender(request, 'table_display.html', context, app_name)
     else:
         datatable = AssessTable(model,'current')
+        # Show all rows for editing, unless sparse is requested
+        datatable.set_page(request.GET, False)
         context = datatable.render_table_context(col,False,[])
         return AssessRender(request, 'table_edit.html', context, app_name)
 
@@ -162,7 +255,12 @@ def TableUploadView(request,model,app_name):
     """View for uploading data table content."""
     datatable = AssessTable(model,"proposed")
     if request.method == 'POST':
-        datatable.save_CSV(request.POST)
+        # Large tables are uploaded as a file, which is parsed as a stream
+        if 'csv_file' in request.FILES:
+            column_field = request.POST.get('column_field', '')
+            datatable.save_CSV_file(request.FILES['csv_file'], column_field)
+        else:
+            datatable.save_CSV(request.POST)
         context = datatable.render_table_context("",False,[])
         return AssessRender(request, 'table_display.html', context, app_name)
     else: